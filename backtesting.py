@@ -1,114 +1,211 @@
 # backtests trading strategies and evaluates metrics
+import argparse
 import pandas as pd
 import numpy as np
-import plotting
+import compact
+import instrumentation
+import ledger
+import membership
+import metrics
+import price_store
+import results_store
 from constants import *
 from helpers import *
 
-MAKE_CSVS = True
+# the per symbol frames, portfolio and trades of a run go into one bundle in RESULTS_DIR_NAME,
+# MAKE_CSVS also writes them as csv files
+SAVE_RESULTS = True
+MAKE_CSVS = False
 MAKE_PNGS = True
 PLOT_PORTFOLIO = True
 
 # optimized strategy parameters (optimized on 2010 - 2020 data)
-if STRATEGY == 'sma':
-    params = {'fast_period': 23, 'slow_period': 77}
-elif STRATEGY == 'macd':
-    params = {'fast_period': 49, 'slow_period': 57, 'signal_period': 22}
-elif STRATEGY == 'bb':
-    params = {'period': 35, 'buy_threshold': 41, 'sell_threshold': 96}
-elif STRATEGY == 'rsi_sma':
-    params = {'ma_period': 76, 'rsi_period': 23, 'oversold': 46}
-else:
+optimized_params = {'sma': {'fast_period': 23, 'slow_period': 77},
+                    'macd': {'fast_period': 49, 'slow_period': 57, 'signal_period': 22},
+                    'bb': {'period': 35, 'buy_threshold': 41, 'sell_threshold': 96},
+                    'rsi_sma': {'ma_period': 76, 'rsi_period': 23, 'oversold': 46}}
+if STRATEGY not in optimized_params:
     raise ValueError("Invalid strategy")
+params = optimized_params[STRATEGY]
 
 
-# populate and format dataframes with data from csvs
-def get_data():
-    # stock metadata
-    metadata = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}",
-                           parse_dates=["date_added_sp"], index_col=0)
+# per ticker Adj Close and Volume dataframes from the multi-index stock price csv
+def read_csv_tickers(trade_start_date=TRADE_START_DATE):
     # dataframe with price stock data
     df = pd.read_csv(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}",
                      parse_dates=True, index_col=[0], header=[0, 1])
+    # get a list of all the dates in the data
+    index = df[(df.index >= trade_start_date) & (df.index <= TRADE_END_DATE)].index
+    all_symbols = list(set([t[0] for t in df.columns]))
+    tickers = ((ticker, df[ticker].drop(['Open', 'High', 'Low', 'Close'], axis=1))
+               for ticker in all_symbols)
+    return index, tickers
+
+
+# per ticker Adj Close and Volume dataframes from the price store, only the dates
+# between DATA_START_DATE and TRADE_END_DATE are read from disk
+def read_store_tickers(store_dir, trade_start_date=TRADE_START_DATE):
+    store = price_store.slice_store(price_store.open_store(store_dir),
+                                    DATA_START_DATE, TRADE_END_DATE)
+    dates = store['dates']
+    # get a list of all the dates in the data
+    index = dates[dates >= trade_start_date]
+    adj_close, volume = store['fields']['Adj Close'], store['fields']['Volume']
+    tickers = ((ticker, pd.DataFrame({'Adj Close': adj_close[:, j], 'Volume': volume[:, j]},
+                                     index=dates))
+               for j, ticker in enumerate(store['symbols']))
+    return index, tickers
+
+
+# populate and format dataframes with data from csvs, the stock price data is read from
+# the price store instead of the csv when one has been built with price_store.py,
+# the trading dates in index start at trade_start_date, with compact the prices are
+# float32 and the volumes uint32
+@instrumentation.timed('get_data')
+def get_data(use_store=True, trade_start_date=TRADE_START_DATE, compact_dtypes=COMPACT):
+    # stock metadata
+    metadata = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}",
+                           parse_dates=["date_added_sp"], index_col=0)
+    # rows are traded from the first membership interval on, not from the latest addition
+    metadata['date_added_sp'] = membership.first_added_dates(
+        metadata, membership.load_intervals(metadata))
     # S&P 500 data
     indexdata = pd.read_csv(f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}",
                             parse_dates=True, index_col=[0])
 
-    # get a list of all the dates in the data
-    index = df[(df.index >= TRADE_START_DATE) & (df.index <= TRADE_END_DATE)].index
+    store_dir = f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}"
+    with instrumentation.stage('get_data.read_prices'):
+        if use_store and price_store.store_exists(store_dir):
+            index, tickers = read_store_tickers(store_dir, trade_start_date)
+        elif BAR_INTERVAL != DAILY_BAR_INTERVAL:
+            raise ValueError(f"No price store of {BAR_INTERVAL} bars in {store_dir}")
+        else:
+            index, tickers = read_csv_tickers(trade_start_date)
 
-    # drop empty dfs, empty rows, useless columns, and shorten to preserve memory
-    all_symbols = list(set([t[0] for t in df.columns]))
+    # drop empty dfs, empty rows, and shorten to preserve memory,
+    # the per ticker frames of the price store are only built in this loop
     dfs = {}
-    for ticker in all_symbols:
-        ticker_df = df[ticker].dropna(subset=['Adj Close'])
-        ticker_df = ticker_df.drop(['Open', 'High', 'Low', 'Close'], axis=1)
-        ticker_df = ticker_df.loc[(ticker_df.index >= DATA_START_DATE) &
-                                  (ticker_df.index <= TRADE_END_DATE)]
-        if not ticker_df.empty:
-            # if the stock data has too many repeating values or very low volume,
-            # its probably bad data
-            constant_returns_ratio = ticker_df['Adj Close'].\
-                pct_change().value_counts(normalize=True).max()
-            mean_volume = ticker_df['Volume'].mean()
-            is_bad_data = constant_returns_ratio >= 0.3 or mean_volume <= 5000
-            if not is_bad_data:
-                dfs[ticker] = ticker_df
+    with instrumentation.stage('get_data.clean'):
+        for ticker, ticker_df in tickers:
+            # tickers without a metadata row have no index membership, they are not traded
+            if ticker not in metadata.index:
+                continue
+            ticker_df = ticker_df.dropna(subset=['Adj Close'])
+            ticker_df = ticker_df.loc[(ticker_df.index >= DATA_START_DATE) &
+                                      (ticker_df.index <= TRADE_END_DATE)]
+            if not ticker_df.empty:
+                # if the stock data has too many repeating values or very low volume,
+                # its probably bad data
+                constant_returns_ratio = ticker_df['Adj Close'].\
+                    pct_change().value_counts(normalize=True).max()
+                mean_volume = ticker_df['Volume'].mean()
+                is_bad_data = constant_returns_ratio >= 0.3 or mean_volume <= 5000
+                if not is_bad_data:
+                    dfs[ticker] = compact.compact_prices(ticker_df) if compact_dtypes \
+                        else ticker_df
     all_symbols = sorted(list(dfs.keys()))
     return dfs, index, all_symbols, metadata, indexdata
 
 
-# populate column for universe selection
-def filter_universe(dfs, index, all_symbols, mdf):
-    for symbol in all_symbols:
-        df = dfs[symbol]
-        df['in_universe'] = False
-        dfs[symbol] = df
-
-    for date in index:
-        today_symbols = []
-        # drop all the symbols that do not have data
+# build the date x symbol universe membership matrix, each date holds the universe_size
+# highest volume symbols that have data and are S&P constituents on that date, the membership
+# intervals are the ones saved by data_collection.py unless they are passed in
+def universe_membership(dfs, index, all_symbols, mdf, universe_size=UNIVERSE_SIZE,
+                        intervals=None):
+    volume = np.full((len(index), len(all_symbols)), np.nan)
+    has_data = np.zeros(volume.shape, dtype=bool)
+    for j, symbol in enumerate(all_symbols):
+        rows = index.get_indexer(dfs[symbol].index)
+        known = rows >= 0
+        volume[rows[known], j] = dfs[symbol]['Volume'].to_numpy()[known]
+        has_data[rows[known], j] = True
+
+    # make sure that you don't consider stocks that are not in the S&P on a date
+    if intervals is None:
+        intervals = membership.load_intervals(mdf)
+    is_member = membership.membership_mask(membership.interval_table(intervals), index,
+                                           all_symbols)
+    in_universe = top_volume(volume, has_data & is_member, universe_size)
+    return pd.DataFrame(in_universe, index=index, columns=all_symbols)
+
+
+# date x symbol mask of the universe_size highest volumes among the eligible symbols of
+# every date, missing volumes rank last
+def top_volume(volume, eligible, universe_size):
+    volume = np.where(eligible & ~np.isnan(volume), volume, -np.inf)
+    universe_size = min(universe_size, volume.shape[1])
+    if universe_size == 0:
+        return np.zeros(volume.shape, dtype=bool)
+    # the volume of the last symbol that still makes it into the universe on each date
+    cutoff = -np.partition(-volume, universe_size - 1, axis=1)[:, [universe_size - 1]]
+    above_cutoff = eligible & (volume > cutoff)
+    # symbols with a volume equal to the cutoff are taken in symbol order
+    at_cutoff = eligible & (volume == cutoff)
+    free_spots = universe_size - above_cutoff.sum(axis=1, keepdims=True)
+    return above_cutoff | (at_cutoff & (np.cumsum(at_cutoff, axis=1) <= free_spots))
+
+
+# populate column for universe selection, a membership matrix from a previous call
+# can be passed in to skip the computation
+@instrumentation.timed('filter_universe')
+def filter_universe(dfs, index, all_symbols, mdf, universe=None,
+                    universe_size=UNIVERSE_SIZE, intervals=None):
+    if universe is None:
+        with instrumentation.stage('filter_universe.membership'):
+            universe = universe_membership(dfs, index, all_symbols, mdf, universe_size,
+                                           intervals)
+    with instrumentation.stage('filter_universe.assign'):
         for symbol in all_symbols:
-            # make sure that you don't consider stocks not yet in S&P
-            added_date = mdf.loc[symbol, "date_added_sp"]
-            # checking if there is data for the given date
-            if date in dfs[symbol].index and not date < added_date:
-                today_symbols += [symbol]
-
-        # get the volume of a particular symbol based on the current date
-        def get_vol(stock_symbol):
-            return dfs[stock_symbol]['Volume'].loc[date]
-        today_symbols.sort(reverse=True, key=get_vol)
-
-        today_symbols = today_symbols[:UNIVERSE_SIZE]
-        # sets the in_universe column for all the symbols that are in the universe today
-        for symbol in today_symbols:
-            dfs[symbol].loc[date, 'in_universe'] = True
-
-
-# backtest trading strategy and strategy parameters
-def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_percentage):
+            df = dfs[symbol]
+            df['in_universe'] = universe[symbol].reindex(df.index, fill_value=False)
+    return universe
+
+
+# return a copy of a symbol's dataframe with the strategy indicators and the buy signal,
+# cut down to the rows that can be traded between start_date and end_date, the indicators
+# are computed over the whole dataframe so earlier rows still warm them up, with compact
+# the new columns are float32, bool and int8
+def add_signals(df, symbol, mdf, strategy, params, start_date=TRADE_START_DATE,
+                end_date=None, compact_dtypes=COMPACT):
+    # the new columns only go into the copy, the price data itself is shared, not copied
+    df = df.copy(deep=False)
+    df['position_size'] = np.nan
+    with instrumentation.stage('strategy'):
+        df = strategy(df, params, symbol)
+    # populate a column that is only true when buy condition
+    # explicitly changes from false to true
+    df['buy_signal'] = df['buy_condition'] & (~df['buy_condition']).shift(1)
+    if not df.empty and df.loc[df.index[0], 'buy_signal']:
+        df.loc[df.index[0], 'buy_signal'] = False
+    # drop rows that were just used as data for indicators
+    df = df[df.index >= start_date]
+    if end_date is not None:
+        df = df[df.index <= end_date]
+    # drop rows of data that happened before a symbol first became an index constituent,
+    # get_data sets date_added_sp to the start of the first membership interval
+    added_date = mdf.loc[symbol, "date_added_sp"]
+    if added_date > start_date:
+        df = df[df.index >= added_date]
+    if compact_dtypes:
+        df = compact.compact_signals(df)
+    return df
+
+
+# backtest trading strategy and strategy parameters, dfs is not modified,
+# pass a dict as frames to get the per symbol dataframes with indicators and trades
+@instrumentation.timed('backtest')
+def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_percentage,
+             frames=None):
     stoploss_factor = (100 - stoploss_percentage) / 100
     start_time_of_backtest = dt.datetime.now()
+    if frames is None:
+        frames = {}
     # adds necessary indicators, populates the has_position and has_stoploss dict
     has_position, has_stoploss = {}, {}
-    for symbol in all_symbols:
-        has_position[symbol], has_stoploss[symbol] = False, False
-        df = dfs[symbol]
-        df['position_size'] = np.nan
-        df = strategy(df, params)
-        # populate a column that is only true when buy condition
-        # explicitly changes from false to true
-        df['buy_signal'] = df['buy_condition'] & (~df['buy_condition']).shift(1)
-        if not df.empty and df.loc[df.index[0], 'buy_signal']:
-            df.loc[df.index[0], 'buy_signal'] = False
-        # drop rows that were just used as data for indicators
-        df = df[df.index >= TRADE_START_DATE]
-        # drop rows of data that happened before a symbol became an index constituent
-        added_date = mdf.loc[symbol, "date_added_sp"]
-        if added_date > TRADE_START_DATE:
-            df = df[df.index >= added_date]
-        dfs[symbol] = df
+    with instrumentation.stage('backtest.signals'):
+        for symbol in all_symbols:
+            has_position[symbol], has_stoploss[symbol] = False, False
+            frames[symbol] = add_signals(dfs[symbol], symbol, mdf, strategy, params)
 
     # a dataframe to keep track of the portfolio
     portfolio = pd.DataFrame(columns=COLUMNS)
@@ -119,73 +216,76 @@ def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_perc
     # keep track of all the trades that took place
     trades = []
     for i, date in enumerate(index):
-        # if it's the first day, set the usd holdings to starting capital
-        if i == 0:
-            portfolio.loc[date, 'usd_holdings'] = STARTING_CAPITAL
-        else:
-            portfolio.loc[date, 'usd_holdings'] = portfolio.loc[index[i-1], 'usd_holdings']
-        portfolio.loc[date, 'stock_holdings_value'] = 0.0
+        with instrumentation.stage('backtest.portfolio'):
+            # if it's the first day, set the usd holdings to starting capital
+            if i == 0:
+                portfolio.loc[date, 'usd_holdings'] = STARTING_CAPITAL
+            else:
+                portfolio.loc[date, 'usd_holdings'] = portfolio.loc[index[i-1], 'usd_holdings']
+            portfolio.loc[date, 'stock_holdings_value'] = 0.0
 
         # evaluate list of symbols that are long or in the universe
-        current_symbols = []
-        for s in all_symbols:
-            if date in dfs[s].index and (has_position[s] or
-                                         dfs[s].loc[date, 'in_universe']):
-                current_symbols += [s]
+        with instrumentation.stage('backtest.current_symbols'):
+            current_symbols = []
+            for s in all_symbols:
+                if date in frames[s].index and (has_position[s] or
+                                                frames[s].loc[date, 'in_universe']):
+                    current_symbols += [s]
 
         # compute the trades
-        for symbol in current_symbols:
-            df = dfs[symbol]
-            row = df.loc[date]
-            it_is_the_last_day = date == dfs[symbol].index[-1]
-
-            # check for buys
-            has_enough_cash = portfolio.loc[date, 'usd_holdings'] >= POSITION_SIZE_QUOTE
-            allow_buys = not has_position[symbol] and not it_is_the_last_day
-            if allow_buys and row['buy_signal'] and has_enough_cash:
-                df.loc[date, 'position_size'] = 1
-                # adjust usd holdings and position size keeping fees in mind
-                portfolio.loc[date, 'usd_holdings'] -= POSITION_SIZE_QUOTE
-                has_position[symbol] = (POSITION_SIZE_QUOTE / df.loc[date, 'Adj Close']) *\
-                                        FEE_FACTOR
-                has_stoploss[symbol] = df.loc[date, 'Adj Close'] * stoploss_factor
-
-                trades += [{'symbol': symbol,
-                            'side': 'buy',
-                            'price': df.loc[date, 'Adj Close'],
-                            'size': df.loc[date, 'position_size'],
-                            'date': date}]
-
-                # keep track of all the symbols that have had a trade
-                if symbol not in all_traded_stocks:
-                    all_traded_stocks += [symbol]
-
-            # handle sells
-            if has_stoploss[symbol]:
-                trigger_stoploss_sell = has_stoploss[symbol] >= df.loc[date, 'Adj Close']
-            else:
-                trigger_stoploss_sell = False
-            force_sell = it_is_the_last_day and has_position[symbol]
-            if trigger_stoploss_sell or force_sell or \
-                    (has_position[symbol] and row['sell_condition']):
-                df.loc[date, 'position_size'] = -1
-                # adjust usd holdings and position size keeping fees in mind
-                portfolio.loc[date, 'usd_holdings'] += (has_position[symbol] *
-                                                        df.loc[date, 'Adj Close']) * \
-                                                        FEE_FACTOR
-                has_position[symbol] = False
-                has_stoploss[symbol] = False
-
-                trades += [{'symbol': symbol,
-                            'side': 'sell',
-                            'price': df.loc[date, 'Adj Close'],
-                            'size': df.loc[date, 'position_size'],
-                            'date': date}]
-
-            # handle the usd value of owned stock
-            if has_position[symbol]:
-                portfolio.loc[date, 'stock_holdings_value'] += \
-                              has_position[symbol] * df.loc[date, 'Adj Close']
+        with instrumentation.stage('backtest.trades'):
+            for symbol in current_symbols:
+                df = frames[symbol]
+                row = df.loc[date]
+                it_is_the_last_day = date == frames[symbol].index[-1]
+
+                # check for buys
+                has_enough_cash = portfolio.loc[date, 'usd_holdings'] >= POSITION_SIZE_QUOTE
+                allow_buys = not has_position[symbol] and not it_is_the_last_day
+                if allow_buys and row['buy_signal'] and has_enough_cash:
+                    df.loc[date, 'position_size'] = 1
+                    # adjust usd holdings and position size keeping fees in mind
+                    portfolio.loc[date, 'usd_holdings'] -= POSITION_SIZE_QUOTE
+                    has_position[symbol] = (POSITION_SIZE_QUOTE / df.loc[date, 'Adj Close']) *\
+                                            FEE_FACTOR
+                    has_stoploss[symbol] = df.loc[date, 'Adj Close'] * stoploss_factor
+
+                    trades += [{'symbol': symbol,
+                                'side': 'buy',
+                                'price': df.loc[date, 'Adj Close'],
+                                'size': df.loc[date, 'position_size'],
+                                'date': date}]
+
+                    # keep track of all the symbols that have had a trade
+                    if symbol not in all_traded_stocks:
+                        all_traded_stocks += [symbol]
+
+                # handle sells
+                if has_stoploss[symbol]:
+                    trigger_stoploss_sell = has_stoploss[symbol] >= df.loc[date, 'Adj Close']
+                else:
+                    trigger_stoploss_sell = False
+                force_sell = it_is_the_last_day and has_position[symbol]
+                if trigger_stoploss_sell or force_sell or \
+                        (has_position[symbol] and row['sell_condition']):
+                    df.loc[date, 'position_size'] = -1
+                    # adjust usd holdings and position size keeping fees in mind
+                    portfolio.loc[date, 'usd_holdings'] += (has_position[symbol] *
+                                                            df.loc[date, 'Adj Close']) * \
+                                                            FEE_FACTOR
+                    has_position[symbol] = False
+                    has_stoploss[symbol] = False
+
+                    trades += [{'symbol': symbol,
+                                'side': 'sell',
+                                'price': df.loc[date, 'Adj Close'],
+                                'size': df.loc[date, 'position_size'],
+                                'date': date}]
+
+                # handle the usd value of owned stock
+                if has_position[symbol]:
+                    portfolio.loc[date, 'stock_holdings_value'] += \
+                                  has_position[symbol] * df.loc[date, 'Adj Close']
 
     # check to make sure there are no long positions open
     not_long_list = [not has_position[symbol] for symbol in has_position.keys()]
@@ -196,7 +296,9 @@ def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_perc
     portfolio['total_portfolio_value'] = portfolio['usd_holdings'] + \
                                          portfolio['stock_holdings_value']
     # sharpe ratio
-    sharpe_ratio = get_sharpe_ratio(portfolio['total_portfolio_value'])
+    with instrumentation.stage('backtest.sharpe_ratio'):
+        sharpe_ratio = get_sharpe_ratio(portfolio['total_portfolio_value'],
+                                        metrics.periods_per_year(index))
     backtest_duration = dt.datetime.now() - start_time_of_backtest
     print(f"backtest evaluation duration: {backtest_duration}, "
           f"sharpe ratio: {sharpe_ratio}, "
@@ -205,15 +307,38 @@ def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_perc
     return sharpe_ratio, portfolio, all_traded_stocks, trades
 
 
-if __name__ == "__main__":
+# backtest STRATEGY, save the results and print the report, plotting is only imported
+# when there are plots to make
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="backtest the strategy in constants.py",
+                                     parents=list(parents))
+    parser.add_argument('--run-id', default=None,
+                        help="name of the run's results bundle, strategy and time by default")
+    parser.add_argument('--plot-top', type=int, default=None,
+                        help="only chart the N traded symbols with the highest profit")
+    parser.add_argument('--plot-bottom', type=int, default=None,
+                        help="only chart the N traded symbols with the lowest profit")
+    parser.add_argument('--plot-workers', type=int, default=None,
+                        help="processes that render the charts, one per cpu by default")
+    parser.add_argument('--no-plots', action='store_true',
+                        help="skip the portfolio plot and the charts")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    make_pngs = MAKE_PNGS and not args.no_plots
+    plot_portfolio = PLOT_PORTFOLIO and not args.no_plots
+    if make_pngs or plot_portfolio:
+        import plotting
+    instrumentation.configure(args.instrument, args.profile)
+
     print_params()
     make_dirs()
     dfs, index, all_symbols, mdf, spdf = get_data()
     filter_universe(dfs, index, all_symbols, mdf)
 
+    frames = {}
     backtest_result = backtest(dfs, all_symbols, mdf, spdf, index,
                                string_to_strategy[STRATEGY], params,
-                               STOPLOSS_PERCENTAGE)
+                               STOPLOSS_PERCENTAGE, frames=frames)
     sharpe_ratio, portfolio, all_traded_stocks, trades = backtest_result
 
     # calculate other portfolio metrics
@@ -227,78 +352,80 @@ if __name__ == "__main__":
               portfolio['total_portfolio_value'][0])
     profit_percentage = profit/portfolio['total_portfolio_value'][0] * 100
 
-    if PLOT_PORTFOLIO:
-        portfolio.to_csv("portfolio.csv")
+    if plot_portfolio:
         plotting.plot_portfolio(portfolio)
 
-    # plotting the results
-    for symbol in all_traded_stocks:
-        df = dfs[symbol]
-        if MAKE_CSVS:
+    # after backtest results, the trades are paired into round trips per symbol
+    trade_table = ledger.trade_ledger(trades)
+    trips = ledger.round_trips(trade_table, index)
+    symbol_profits = ledger.symbol_profits(trips)
+    trade_summary = ledger.summary(trips)
+
+    # saving the results
+    if SAVE_RESULTS:
+        run_id = args.run_id or results_store.new_run_id(STRATEGY)
+        meta = {'strategy': STRATEGY, 'params': params,
+                'stoploss_percentage': STOPLOSS_PERCENTAGE,
+                'trade_start_date': TRADE_START_DATE, 'trade_end_date': TRADE_END_DATE}
+        with instrumentation.stage('save_results'):
+            path = results_store.write_run(RESULTS_DIR_NAME, run_id, meta, frames,
+                                           all_traded_stocks, portfolio, trade_table, trips)
+        print(f"saved the results of {len(all_traded_stocks)} symbols to {path}")
+    if MAKE_CSVS:
+        portfolio.to_csv("portfolio.csv")
+        for symbol in all_traded_stocks:
             print(f"saving file {CSV_OUT_DIR_NAME}/{symbol}.csv")
-            df.to_csv(f"{CSV_OUT_DIR_NAME}/{symbol}.csv")
-
-        if MAKE_PNGS:
-            print(f"saving picture {PNG_OUT_DIR_NAME}/{symbol}.png")
-            plotting.plot_df(df, symbol, mdf.loc[symbol, "name_yf"],
-                             STRATEGY, params, save_png=True)
-
-    # after backtest results
-    full_trades = []
-    won_trades = 0
-    # a list of tuples (symbol, total profit)
-    symbol_profits = []
-    for symbol in all_traded_stocks:
-        s_trades = [trade for trade in trades if trade['symbol'] == symbol]
-        pairs_of_trades = list(zip(s_trades[::2], s_trades[1::2]))
-        total_profit_for_symbol = 1
-        for buy, sell in pairs_of_trades:
-            if not buy['side'] == 'buy' or not sell['side'] == 'sell':
-                # check whether the trades have been paired properly
-                raise ValueError("Trades not paired properly")
-            profit = 100 * (sell['price'] - buy['price'])/buy['price']
-            profit_ratio = 1+(sell['price'] - buy['price'])/buy['price']
-            total_profit_for_symbol *= profit_ratio
-            full_trades += [{'symbol': symbol,
-                             'profit': profit,
-                             'buy': buy,
-                             'sell': sell}]
-            if profit > 0:
-                won_trades += 1
-        symbol_profits.append((symbol, total_profit_for_symbol))
-
-    profits = [ft['profit'] for ft in full_trades]
-    full_trades.sort(reverse=True, key=lambda x: x['profit'])
-    symbol_profits.sort(reverse=True, key=lambda x: x[1])
-
-    for i, t in enumerate(full_trades[:20]):
-        print(f"{i}. {t['symbol']}, profit: {t['profit']}%, "
-              f"buy date: {t['buy']['date']}, "
-              f"sell date: {t['sell']['date']}")
-
-    for i, symbol_profit in enumerate(symbol_profits[:20]):
-        print(f"{i}. {symbol_profit[0]}, profit: {(symbol_profit[1] - 1) * 100}%")
-
-    print(f'there were {len(full_trades)} trades taken')
-    print(f'the average profit % was: {sum(profits) / len(profits)}')
+            frames[symbol].to_csv(f"{CSV_OUT_DIR_NAME}/{symbol}.csv")
+        ledger.export(trade_table, f"{CSV_OUT_DIR_NAME}/trades.csv")
+        ledger.export(trips, f"{CSV_OUT_DIR_NAME}/round_trips.csv")
+
+    # plotting the results
+    if make_pngs:
+        chart_symbols = ledger.ranked_symbols(symbol_profits, args.plot_top, args.plot_bottom)
+        with instrumentation.stage('render_charts'):
+            plotting.render_charts(frames, chart_symbols, mdf['name_yf'], STRATEGY, params,
+                                   workers=args.plot_workers)
+
+    for i, t in enumerate(ledger.top_trips(trips, 20).itertuples()):
+        print(f"{i}. {t.symbol}, profit: {t.profit}%, "
+              f"buy date: {t.buy_date}, "
+              f"sell date: {t.sell_date}")
+
+    for i, (symbol, profit_ratio) in enumerate(ledger.top_symbols(symbol_profits, 20).items()):
+        print(f"{i}. {symbol}, profit: {(profit_ratio - 1) * 100}%")
+
+    print(f"there were {trade_summary['trades']} trades taken")
+    print(f"the average profit % was: {trade_summary['average_profit']}")
+    print(f"the average holding period was: {trade_summary['average_holding_days']} days")
+
+    # metrics of the S&P 500 (row 0) and the trading strategy (row 1) in one pass
+    report = metrics.evaluate([portfolio['index_price'], portfolio['total_portfolio_value']],
+                              benchmark=portfolio['index_price'],
+                              periods_per_year=metrics.periods_per_year(index))
 
     print("")
     print("S&P 500")
-    print(f"sharpe ratio: {get_sharpe_ratio(portfolio['index_price'])}")
-    print(f"sortino ratio: {get_sortino_ratio(portfolio['index_price'])}")
-    print(f"max drawdown: {portfolio['index_drawdown'].max() * 100}%")
+    print(f"sharpe ratio: {report['sharpe_ratio'][0]}")
+    print(f"sortino ratio: {report['sortino_ratio'][0]}")
+    print(f"max drawdown: {report['max_drawdown'][0] * 100}%")
+    print(f"longest drawdown: {report['max_drawdown_duration'][0]} trading days")
+    print(f"cagr: {report['cagr'][0] * 100}%")
     i_p = portfolio['index_price']
     print(f"profit: {round((i_p[-1] - i_p[0]) / i_p[0] * 100, 2)}%")
 
     print("")
     print("Trading Strategy")
-    winrate_percentage = won_trades / len(full_trades) * 100
-    print(f"trade win rate: {round(winrate_percentage, 2)}%")
-    print(f"sharpe ratio: {get_sharpe_ratio(portfolio['total_portfolio_value'])}")
-    print(f"sortino ratio: {get_sortino_ratio(portfolio['total_portfolio_value'])}")
-    alpha, beta = get_alpha_beta(portfolio['index_price'],
-                                 portfolio['total_portfolio_value'])
-    print(f"beta: {beta}\nalpha: {alpha}")
-    print(f"max drawdown: {portfolio['portfolio_value_drawdown'].max() * 100}%")
+    print(f"trade win rate: {round(trade_summary['win_rate'], 2)}%")
+    print(f"sharpe ratio: {report['sharpe_ratio'][1]}")
+    print(f"sortino ratio: {report['sortino_ratio'][1]}")
+    print(f"beta: {report['beta'][1]}\nalpha: {report['alpha'][1]}")
+    print(f"max drawdown: {report['max_drawdown'][1] * 100}%")
+    print(f"longest drawdown: {report['max_drawdown_duration'][1]} trading days")
+    print(f"cagr: {report['cagr'][1] * 100}%")
     tpv = portfolio['total_portfolio_value']
     print(f"profit: {round(((tpv[-1] - tpv[0]) / tpv[0] * 100), 2)}%")
+    instrumentation.print_summary()
+
+
+if __name__ == "__main__":
+    main()
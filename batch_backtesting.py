@@ -0,0 +1,205 @@
+# backtests a whole population of parameter sets in one pass, the signals of all parameter
+# sets are stacked into param x date x symbol arrays and all portfolios are simulated together
+import numpy as np
+import compact
+import indicators
+import instrumentation
+import metrics
+from constants import *
+from helpers import *
+
+# strategies whose parameters only pick rolling windows and thresholds
+BATCH_STRATEGIES = ['sma', 'bb']
+
+
+# buy and sell conditions of every parameter set over the rows of one symbol, together with
+# the rows that survive the strategy's dropna, all as param x row arrays
+def strategy_conditions(strategy_name, close, param_matrix, symbol):
+    if strategy_name == 'sma':
+        fast_periods, slow_periods = param_matrix[:, 0], param_matrix[:, 1]
+        ma = {period: indicators.sma(close, period, symbol)
+              for period in np.unique(param_matrix)}
+        ma_fast = np.stack([ma[period] for period in fast_periods])
+        ma_slow = np.stack([ma[period] for period in slow_periods])
+        return ~np.isnan(ma_slow), ma_fast > ma_slow, ma_fast <= ma_slow
+    if strategy_name == 'bb':
+        periods = param_matrix[:, 0]
+        buy_thresholds, sell_thresholds = param_matrix[:, [1]], param_matrix[:, [2]]
+        percent_b, ma = {}, {}
+        for period in np.unique(periods):
+            ma[period] = indicators.sma(close, period, symbol)
+            std = indicators.rolling_std(close, period, symbol)
+            lower_bb = ma[period] - (std * 2)
+            upper_bb = ma[period] + (std * 2)
+            percent_b[period] = (close.to_numpy() - lower_bb) / (upper_bb - lower_bb) * 100
+        percent_b = np.stack([percent_b[period] for period in periods])
+        previous_percent_b = np.full(percent_b.shape, np.nan)
+        previous_percent_b[:, 1:] = percent_b[:, :-1]
+        buy_condition = (previous_percent_b < buy_thresholds) & (percent_b > buy_thresholds)
+        sell_condition = percent_b > sell_thresholds
+        keep = np.stack([~np.isnan(ma[period]) for period in periods])
+        return keep, buy_condition, sell_condition
+    raise ValueError(f"Strategy {strategy_name} can not be backtested in batches")
+
+
+# boolean masks of the batch matrices, the ones bit packed along the symbol axis with compact
+MASKS = ['in_universe', 'buy_signal', 'sell_condition', 'has_row', 'is_last_day']
+
+
+# empty param x date x symbol matrices, price and in_universe are the same for every
+# parameter set so they are date x symbol
+def empty_batch_matrices(shape):
+    return {'price': np.full(shape[1:], np.nan),
+            'in_universe': np.zeros(shape[1:], dtype=bool),
+            'buy_signal': np.zeros(shape, dtype=bool),
+            'sell_condition': np.zeros(shape, dtype=bool),
+            'has_row': np.zeros(shape, dtype=bool),
+            'is_last_day': np.zeros(shape, dtype=bool)}
+
+
+# fill column j of the matrices with the signals of one symbol for every parameter set,
+# following the same steps as backtesting.add_signals
+def add_symbol(matrices, j, df, symbol, mdf, index, strategy_name, param_matrix):
+    keep, buy_condition, sell_condition = strategy_conditions(
+        strategy_name, df['Adj Close'], param_matrix, symbol)
+    # only true when buy condition explicitly changes from false to true,
+    # never on the first row that is left after dropping the indicator warm up
+    previous_kept = np.zeros(keep.shape, dtype=bool)
+    previous_kept[:, 1:] = keep[:, :-1]
+    previous_buy_condition = np.zeros(keep.shape, dtype=bool)
+    previous_buy_condition[:, 1:] = buy_condition[:, :-1]
+    buy_signal = buy_condition & ~previous_buy_condition & previous_kept
+
+    # rows on the trading days of index after the symbol first became an index constituent
+    rows = index.get_indexer(df.index)
+    tradable = rows >= 0
+    added_date = mdf.loc[symbol, "date_added_sp"]
+    if added_date > index[0]:
+        tradable &= df.index >= added_date
+    rows = rows[tradable]
+    has_row = keep[:, tradable]
+    if not rows.size:
+        return
+
+    matrices['price'][rows, j] = df['Adj Close'].to_numpy()[tradable]
+    matrices['in_universe'][rows, j] = df['in_universe'].to_numpy(dtype=bool)[tradable]
+    matrices['has_row'][:, rows, j] = has_row
+    matrices['buy_signal'][:, rows, j] = buy_signal[:, tradable] & has_row
+    matrices['sell_condition'][:, rows, j] = sell_condition[:, tradable] & has_row
+    # a symbol can only be force sold on the last day it has data for
+    has_any_row = has_row.any(axis=1)
+    last_rows = rows[len(rows) - 1 - np.argmax(has_row[:, ::-1], axis=1)]
+    matrices['is_last_day'][np.flatnonzero(has_any_row), last_rows[has_any_row], j] = True
+
+
+# stack the signals of every parameter set into param x date x symbol arrays, with
+# compact_masks the masks are built PACK_BLOCK_SYMBOLS symbols at a time and packed into bits,
+# so the unpacked masks of all symbols never exist at once, and the prices are float32
+def build_batch_matrices(dfs, all_symbols, mdf, index, strategy_name, param_matrix,
+                         compact_masks=COMPACT):
+    shape = (len(param_matrix), len(index), len(all_symbols))
+    if not compact_masks:
+        matrices = empty_batch_matrices(shape)
+        for j, symbol in enumerate(all_symbols):
+            add_symbol(matrices, j, dfs[symbol], symbol, mdf, index, strategy_name,
+                       param_matrix)
+        return matrices
+
+    matrices = {'price': np.full(shape[1:], np.nan, dtype=compact.PRICE_DTYPE)}
+    for name, mask_shape in zip(MASKS, [shape[1:]] + [shape] * (len(MASKS) - 1)):
+        matrices[name] = np.zeros(mask_shape[:-1] + ((shape[2] + 7) // 8,), dtype=np.uint8)
+    for start in range(0, len(all_symbols), compact.PACK_BLOCK_SYMBOLS):
+        block_symbols = all_symbols[start:start + compact.PACK_BLOCK_SYMBOLS]
+        block = empty_batch_matrices(shape[:2] + (len(block_symbols),))
+        for j, symbol in enumerate(block_symbols):
+            add_symbol(block, j, dfs[symbol], symbol, mdf, index, strategy_name, param_matrix)
+        matrices['price'][:, start:start + len(block_symbols)] = block['price']
+        # the block starts on a byte boundary, only the last one can end inside a byte
+        columns = slice(start // 8, (start + len(block_symbols) + 7) // 8)
+        for name in MASKS:
+            matrices[name][..., columns] = compact.pack_mask(block[name])
+    return matrices
+
+
+# run the rules of fast_backtesting.simulate for all parameter sets at once, bit packed
+# masks are unpacked one date at a time, returns the total portfolio value of every
+# parameter set and how many buys it made
+def simulate_batch(price, in_universe, buy_signal, sell_condition, has_row, is_last_day,
+                   stoploss_percentage):
+    stoploss_factor = (100 - stoploss_percentage) / 100
+    n_params, n_dates = buy_signal.shape[:2]
+    n_symbols = price.shape[1]
+    is_packed = buy_signal.dtype == np.uint8
+    position = np.zeros((n_params, n_symbols))
+    stoploss = np.zeros((n_params, n_symbols))
+    usd = np.full(n_params, STARTING_CAPITAL, dtype=np.float64)
+    total_portfolio_value = np.empty((n_params, n_dates))
+    buy_count = np.zeros(n_params, dtype=np.int64)
+
+    for i in range(n_dates):
+        # float32 prices are traded in float64 like the single backtest
+        today_price = price[i].astype(np.float64)
+        today = {'in_universe': in_universe[i], 'buy_signal': buy_signal[:, i],
+                 'sell_condition': sell_condition[:, i], 'has_row': has_row[:, i],
+                 'is_last_day': is_last_day[:, i]}
+        if is_packed:
+            today = {name: compact.unpack_mask(bits, n_symbols) for name, bits in today.items()}
+        has_position = position > 0
+        # symbols that are long or in the universe today, per parameter set
+        current = today['has_row'] & (has_position | today['in_universe'])
+        allow_buys = current & ~has_position & ~today['is_last_day'] & today['buy_signal']
+        trigger_stoploss_sell = (stoploss > 0) & (stoploss >= today_price)
+        allow_sells = current & has_position & (trigger_stoploss_sell | today['is_last_day'] |
+                                                today['sell_condition'])
+
+        # symbols are walked in order as in the single backtest, but each step
+        # handles all parameter sets that trade the symbol today
+        for j in np.flatnonzero((allow_buys | allow_sells).any(axis=0)):
+            symbol_price = today_price[j]
+            buys = allow_buys[:, j] & (usd >= POSITION_SIZE_QUOTE)
+            usd[buys] -= POSITION_SIZE_QUOTE
+            position[buys, j] = (POSITION_SIZE_QUOTE / symbol_price) * FEE_FACTOR
+            stoploss[buys, j] = symbol_price * stoploss_factor
+            buy_count += buys
+
+            trigger_stoploss_sell = (stoploss[:, j] > 0) & (stoploss[:, j] >= symbol_price)
+            sells = current[:, j] & (position[:, j] > 0) & \
+                (trigger_stoploss_sell | today['is_last_day'][:, j] |
+                 today['sell_condition'][:, j])
+            usd[sells] += (position[sells, j] * symbol_price) * FEE_FACTOR
+            position[sells, j] = 0
+            stoploss[sells, j] = 0
+
+        # handle the usd value of owned stock
+        held = today['has_row'] & (position > 0)
+        stock_holdings_value = np.where(held, position * today_price, 0).sum(axis=1)
+        total_portfolio_value[:, i] = usd + stock_holdings_value
+
+    # check to make sure there are no long positions open
+    if np.any(position > 0):
+        raise ValueError("There are open longs at the end of the backtest")
+    return total_portfolio_value, buy_count
+
+
+# backtest every row of a param x k matrix of parameters (ordered as in the strategy's
+# param_bounds), returns the sharpe ratio and the number of buys of every parameter set
+@instrumentation.timed('batch_backtest')
+def batch_backtest(dfs, all_symbols, mdf, index, strategy_name, param_matrix,
+                   stoploss_percentage, compact_masks=COMPACT):
+    start_time_of_backtest = dt.datetime.now()
+    param_matrix = np.asarray(param_matrix, dtype=np.int64)
+    with instrumentation.stage('batch_backtest.matrices'):
+        matrices = build_batch_matrices(dfs, all_symbols, mdf, index, strategy_name,
+                                        param_matrix, compact_masks)
+    with instrumentation.stage('batch_backtest.simulate'):
+        total_portfolio_value, buy_count = simulate_batch(
+            stoploss_percentage=stoploss_percentage, **matrices)
+    with instrumentation.stage('batch_backtest.sharpe_ratios'):
+        sharpe_ratios = metrics.sharpe_ratios(total_portfolio_value,
+                                              metrics.periods_per_year(index))
+    backtest_duration = dt.datetime.now() - start_time_of_backtest
+    print(f"batch backtest evaluation duration: {backtest_duration}, "
+          f"{len(param_matrix)} parameter sets, "
+          f"best sharpe ratio: {sharpe_ratios.max(initial=0)}, "
+          f"stoploss = {stoploss_percentage}")
+    return sharpe_ratios, buy_count
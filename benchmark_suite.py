@@ -0,0 +1,175 @@
+# benchmark harness on seeded synthetic data, times loading the data, universe selection,
+# the indicators of every strategy, both backtest engines and one differential evolution
+# generation, and writes the timings as json so two versions can be compared, run with
+# --baseline to compare against the json of an earlier run
+import argparse
+import contextlib
+import json
+import platform
+import subprocess
+import tempfile
+import backtesting
+import batch_backtesting
+import differential_evolution as optimizer
+import fast_backtesting
+import numpy as np
+import pandas as pd
+import scipy
+from scipy.optimize import differential_evolution
+import synthetic_data
+from helpers import *
+
+
+# run a scenario `repeat` times with its output silenced, returns the durations in seconds
+def time_scenario(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start_time = dt.datetime.now()
+            function()
+            durations += [(dt.datetime.now() - start_time).total_seconds()]
+    return durations
+
+
+# indicators and signals of one strategy for every symbol
+def add_all_signals(dfs, all_symbols, mdf, index, strategy_name):
+    for symbol in all_symbols:
+        backtesting.add_signals(dfs[symbol], symbol, mdf, string_to_strategy[strategy_name],
+                                backtesting.optimized_params[strategy_name], index[0], index[-1])
+
+
+# the initial population and one generation of the optimizer, without a worker pool or the
+# result cache so only the evaluations themselves are timed
+def run_de_generation(dfs, all_symbols, mdf, spdf, index):
+    param_bounds = optimizer.param_bounds
+    if optimizer.BATCH_EVALUATION and STRATEGY in batch_backtesting.BATCH_STRATEGIES:
+        differential_evolution(optimizer.batch_objective_function, param_bounds[STRATEGY][1],
+                               args=(dfs, all_symbols, mdf, index, param_bounds),
+                               seed=69420, maxiter=1, polish=False, vectorized=True,
+                               updating='deferred')
+    else:
+        differential_evolution(optimizer.objective_function, param_bounds[STRATEGY][1],
+                               args=(dfs, all_symbols, mdf, spdf, index, string_to_strategy,
+                                     param_bounds),
+                               seed=69420, maxiter=1, polish=False)
+
+
+# time every scenario on the synthetic data in the current directory
+def run_scenarios(args):
+    scenarios = {}
+
+    def run(name, function):
+        durations = time_scenario(function, args.repeat)
+        scenarios[name] = {'durations': durations, 'min': min(durations),
+                           'median': float(np.median(durations))}
+        print(f"{name}: median {scenarios[name]['median']:.4f}s, "
+              f"min {scenarios[name]['min']:.4f}s")
+
+    run('get_data_csv', lambda: backtesting.get_data(use_store=False,
+                                                     trade_start_date=args.trade_start))
+    run('get_data_store', lambda: backtesting.get_data(use_store=True,
+                                                       trade_start_date=args.trade_start))
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data(trade_start_date=args.trade_start)
+    run('filter_universe', lambda: backtesting.filter_universe(
+        dfs, index, all_symbols, mdf, universe_size=args.universe_size))
+    for strategy_name in string_to_strategy:
+        run(f"strategy_{strategy_name}",
+            lambda: add_all_signals(dfs, all_symbols, mdf, index, strategy_name))
+    params = backtesting.optimized_params[STRATEGY]
+    run('backtest', lambda: backtesting.backtest(dfs, all_symbols, mdf, spdf, index,
+                                                 string_to_strategy[STRATEGY], params,
+                                                 STOPLOSS_PERCENTAGE))
+    run('fast_backtest', lambda: fast_backtesting.backtest(dfs, all_symbols, mdf, spdf, index,
+                                                           string_to_strategy[STRATEGY],
+                                                           params, STOPLOSS_PERCENTAGE))
+    run('de_generation', lambda: run_de_generation(dfs, all_symbols, mdf, spdf, index))
+    return scenarios, len(all_symbols), len(index)
+
+
+# the commit the benchmarks ran on, if the code is in a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# print the ratio of every median to the baseline's, returns the scenarios that got slower
+# by more than the tolerance
+def compare_to_baseline(scenarios, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, result in scenarios.items():
+        if name not in baseline['scenarios']:
+            continue
+        ratio = result['median'] / baseline['scenarios'][name]['median']
+        is_regression = ratio > 1 + tolerance
+        if is_regression:
+            regressions += [name]
+        print(f"{name}: {ratio:.2f}x the baseline median"
+              f"{', REGRESSION' if is_regression else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark on synthetic market data")
+    parser.add_argument('--symbols', type=int, default=100,
+                        help="number of synthetic symbols")
+    parser.add_argument('--universe-size', type=int, default=UNIVERSE_SIZE,
+                        help="number of symbols in the universe on every date")
+    parser.add_argument('--start', type=pd.Timestamp, default=pd.Timestamp(DATA_START_DATE),
+                        help="first date of the synthetic data (YYYY-MM-DD)")
+    parser.add_argument('--end', type=pd.Timestamp, default=pd.Timestamp(TRADE_END_DATE),
+                        help="last date of the synthetic data, get_data stops at "
+                             "TRADE_END_DATE (YYYY-MM-DD)")
+    parser.add_argument('--trade-start', type=pd.Timestamp,
+                        default=pd.Timestamp(TRADE_START_DATE),
+                        help="first trading date of the backtests (YYYY-MM-DD)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of times every scenario is run")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None,
+                        help="json of an earlier run to compare the medians against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown relative to the baseline that counts as a regression")
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    print_params()
+    # get_data reads from DATA_DIR_NAME in the working directory
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='benchmark_data_') as data_root:
+        os.chdir(data_root)
+        try:
+            print(f"generating {args.symbols} symbols from {args.start.date()} "
+                  f"to {args.end.date()} with seed {args.seed}")
+            synthetic_data.write_synthetic_data(args.symbols, args.start, args.end, args.seed)
+            scenarios, n_symbols, n_dates = run_scenarios(args)
+        finally:
+            os.chdir(working_dir)
+
+    results = {'created': dt.datetime.now().isoformat(timespec='seconds'),
+               'commit': git_commit(),
+               'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'pandas': pd.__version__, 'scipy': scipy.__version__},
+               'cpu_count': os.cpu_count(),
+               'config': {'symbols': args.symbols, 'symbols_after_filters': n_symbols,
+                          'trading_dates': n_dates, 'universe_size': args.universe_size,
+                          'start': str(args.start.date()), 'end': str(args.end.date()),
+                          'trade_start': str(args.trade_start.date()), 'seed': args.seed,
+                          'repeat': args.repeat, 'strategy': STRATEGY,
+                          'stoploss_percentage': STOPLOSS_PERCENTAGE},
+               'scenarios': scenarios}
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"wrote {output_path}")
+
+    if baseline_path is not None:
+        regressions = compare_to_baseline(scenarios, baseline_path, args.tolerance)
+        if regressions:
+            raise SystemExit(f"regressions in {', '.join(regressions)}")
@@ -0,0 +1,718 @@
+# times the faster implementations against the original ones on the downloaded data
+# and checks that both give the same results
+import backtesting
+import batch_backtesting
+import chunked_backtesting
+import fast_backtesting
+import compact
+import ledger
+import membership
+import metrics
+import plotting
+import results_store
+import differential_evolution
+import job_broker
+import shared_data
+import price_store
+import streaming
+import synthetic_data
+import trade_kernels
+from helpers import *
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+import functools
+import importlib.util
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# deep copy the per symbol dataframes, since backtests modify them in place
+def copy_dfs(dfs):
+    return {key: value.copy(deep=True) for key, value in dfs.items()}
+
+
+# run a function and return its result together with the duration in seconds
+def timed(function, *args, **kwargs):
+    start_time = dt.datetime.now()
+    result = function(*args, **kwargs)
+    return result, (dt.datetime.now() - start_time).total_seconds()
+
+
+# check that the price store loads the same data as the csv
+def compare_data_loading():
+    store_dir = f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}"
+    if not price_store.store_exists(store_dir):
+        price_store.csv_to_store(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}", store_dir)
+    csv_data, csv_duration = timed(backtesting.get_data, use_store=False)
+    store_data, store_duration = timed(backtesting.get_data, use_store=True)
+    csv_dfs, csv_index, csv_symbols = csv_data[:3]
+    store_dfs, store_index, store_symbols = store_data[:3]
+    if not csv_index.equals(store_index) or csv_symbols != store_symbols:
+        raise ValueError("csv and price store have different dates or symbols")
+    for symbol in csv_symbols:
+        if not csv_dfs[symbol].equals(store_dfs[symbol]):
+            raise ValueError(f"{symbol}: csv and price store data differ")
+    print(f"get_data: {len(csv_symbols)} symbols, "
+          f"csv {csv_duration:.3f}s, "
+          f"price store {store_duration:.3f}s, "
+          f"speedup {csv_duration / store_duration:.1f}x")
+
+
+# the original loop based universe selection, kept as the reference for universe_membership
+def legacy_filter_universe(dfs, index, all_symbols, mdf):
+    for symbol in all_symbols:
+        df = dfs[symbol]
+        df['in_universe'] = False
+        dfs[symbol] = df
+
+    for date in index:
+        today_symbols = []
+        # drop all the symbols that do not have data
+        for symbol in all_symbols:
+            # make sure that you don't consider stocks not yet in S&P
+            added_date = mdf.loc[symbol, "date_added_sp"]
+            # checking if there is data for the given date
+            if date in dfs[symbol].index and not date < added_date:
+                today_symbols += [symbol]
+
+        # get the volume of a particular symbol based on the current date
+        def get_vol(stock_symbol):
+            return dfs[stock_symbol]['Volume'].loc[date]
+        today_symbols.sort(reverse=True, key=get_vol)
+
+        today_symbols = today_symbols[:UNIVERSE_SIZE]
+        # sets the in_universe column for all the symbols that are in the universe today
+        for symbol in today_symbols:
+            dfs[symbol].loc[date, 'in_universe'] = True
+
+
+# check that the membership matrix selects the same universe as the original loop, which
+# only knows the dates the symbols were added
+def compare_universe(dfs, index, all_symbols, mdf):
+    legacy_dfs, fast_dfs = copy_dfs(dfs), copy_dfs(dfs)
+    _, legacy_duration = timed(legacy_filter_universe, legacy_dfs, index, all_symbols, mdf)
+    _, fast_duration = timed(backtesting.filter_universe, fast_dfs, index, all_symbols, mdf,
+                             intervals=membership.intervals_from_metadata(mdf))
+    for symbol in all_symbols:
+        if not legacy_dfs[symbol]['in_universe'].equals(fast_dfs[symbol]['in_universe']):
+            raise ValueError(f"{symbol}: universe selections differ")
+    print(f"filter_universe: {len(index)} dates x {len(all_symbols)} symbols, "
+          f"loop {legacy_duration:.3f}s, "
+          f"membership matrix {fast_duration:.3f}s, "
+          f"speedup {legacy_duration / fast_duration:.1f}x")
+
+
+# check the membership mask of the saved intervals against the constituents of every date and
+# against the scalar date_added_sp lookups per symbol and date it replaces
+def compare_membership(index, all_symbols, mdf):
+    table = membership.interval_table(membership.load_intervals(mdf))
+    mask, mask_duration = timed(membership.membership_mask, table, index, all_symbols)
+    start_time = dt.datetime.now()
+    for i, date in enumerate(index):
+        members = set(membership.constituents(table, date))
+        if [symbol in members for symbol in all_symbols] != list(mask[i]):
+            raise ValueError(f"{date}: constituents and membership mask differ")
+    constituents_duration = (dt.datetime.now() - start_time).total_seconds()
+    is_added, lookup_duration = timed(
+        lambda: [[not date < mdf.loc[symbol, "date_added_sp"] for symbol in all_symbols]
+                 for date in index])
+    metadata_mask = membership.membership_mask(
+        membership.interval_table(membership.intervals_from_metadata(mdf)), index, all_symbols)
+    if not np.array_equal(np.array(is_added, dtype=bool).reshape(mask.shape), metadata_mask):
+        raise ValueError("membership mask and date added lookups differ")
+    print(f"membership: {len(index)} dates x {len(all_symbols)} symbols, "
+          f"{(metadata_mask & ~mask).sum()} cells only members by date added, "
+          f"scalar lookups {lookup_duration:.3f}s, "
+          f"constituents per date {constituents_duration:.3f}s, "
+          f"mask {mask_duration:.3f}s, "
+          f"speedup {lookup_duration / mask_duration:.1f}x")
+
+
+# the original report loop that rescans the trades of every traded symbol, kept as the
+# reference for the ledger, returns the round trip profits and compounded symbol profits
+def legacy_round_trips(trades, all_traded_stocks):
+    profits, symbol_profits = [], []
+    for symbol in all_traded_stocks:
+        s_trades = [trade for trade in trades if trade['symbol'] == symbol]
+        total_profit_for_symbol = 1
+        for buy, sell in zip(s_trades[::2], s_trades[1::2]):
+            if not buy['side'] == 'buy' or not sell['side'] == 'sell':
+                raise ValueError("Trades not paired properly")
+            profits += [100 * (sell['price'] - buy['price']) / buy['price']]
+            total_profit_for_symbol *= 1 + (sell['price'] - buy['price']) / buy['price']
+        symbol_profits += [(symbol, total_profit_for_symbol)]
+    return profits, symbol_profits
+
+
+# check that the ledger pairs the trades of a backtest like the report loop did, the trades
+# are repeated under copies renamed symbols to time both on a larger universe
+def compare_ledger(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                   stoploss_percentage, copies=10):
+    _, _, all_traded_stocks, trades = fast_backtesting.backtest(
+        dfs, all_symbols, mdf, spdf, index, string_to_strategy[strategy_name], params,
+        stoploss_percentage)
+    trades = [dict(trade, symbol=f"{trade['symbol']}_{k}")
+              for k in range(copies) for trade in trades]
+    all_traded_stocks = [f"{symbol}_{k}" for k in range(copies) for symbol in all_traded_stocks]
+    (profits, symbol_profits), legacy_duration = timed(legacy_round_trips, trades,
+                                                       all_traded_stocks)
+    start_time = dt.datetime.now()
+    trips = ledger.round_trips(ledger.trade_ledger(trades), index)
+    ledger_symbol_profits = ledger.symbol_profits(trips)
+    ledger_duration = (dt.datetime.now() - start_time).total_seconds()
+    if not np.array_equal(profits, trips['profit']) or \
+            symbol_profits != list(ledger_symbol_profits.items()):
+        raise ValueError(f"{strategy_name}: ledger and report loop pair trades differently")
+    print(f"{strategy_name}: {len(trades)} trades of {len(all_traded_stocks)} symbols, "
+          f"report loop {legacy_duration:.3f}s, "
+          f"ledger {ledger_duration:.3f}s, "
+          f"speedup {legacy_duration / ledger_duration:.1f}x")
+
+
+# render the charts of the traded symbols one figure at a time as the report used to, then
+# on the process pool with reused figures, and again to check that unchanged charts are skipped
+def compare_rendering(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                      stoploss_percentage, n_symbols=20):
+    frames = {}
+    backtest_result = backtesting.backtest(copy_dfs(dfs), all_symbols, mdf, spdf, index,
+                                           string_to_strategy[strategy_name], params,
+                                           stoploss_percentage, frames=frames)
+    symbols = backtest_result[2][:n_symbols]
+    start_time = dt.datetime.now()
+    for symbol in symbols:
+        plotting.plot_df(frames[symbol], symbol, mdf.loc[symbol, 'name_yf'], strategy_name,
+                         params, save_png=True)
+    serial_duration = (dt.datetime.now() - start_time).total_seconds()
+    out_dir = tempfile.mkdtemp()
+    rendered, pool_duration = timed(plotting.render_charts, frames, symbols, mdf['name_yf'],
+                                    strategy_name, params, out_dir=out_dir)
+    skipped, skip_duration = timed(plotting.render_charts, frames, symbols, mdf['name_yf'],
+                                   strategy_name, params, out_dir=out_dir)
+    shutil.rmtree(out_dir)
+    if len(rendered) != len(symbols) or skipped:
+        raise ValueError(f"{strategy_name}: unchanged charts were rendered again")
+    print(f"{strategy_name}: {len(symbols)} charts, plot_df {serial_duration:.3f}s, "
+          f"render_charts {pool_duration:.3f}s, "
+          f"unchanged {skip_duration:.3f}s, "
+          f"speedup {serial_duration / pool_duration:.1f}x")
+
+
+# write a run's symbol frames, portfolio and trades as one csv each as the report used to and as
+# a results bundle, then read one symbol back from both and check the bundle kept the data
+def compare_results_output(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                           stoploss_percentage):
+    frames = {}
+    _, portfolio, all_traded_stocks, trades = backtesting.backtest(
+        copy_dfs(dfs), all_symbols, mdf, spdf, index, string_to_strategy[strategy_name], params,
+        stoploss_percentage, frames=frames)
+    trade_table = ledger.trade_ledger(trades)
+    trips = ledger.round_trips(trade_table, index)
+    out_dir = tempfile.mkdtemp()
+    start_time = dt.datetime.now()
+    portfolio.to_csv(f"{out_dir}/portfolio.csv")
+    for symbol in all_traded_stocks:
+        frames[symbol].to_csv(f"{out_dir}/{symbol}.csv")
+    ledger.export(trade_table, f"{out_dir}/trades.csv")
+    ledger.export(trips, f"{out_dir}/round_trips.csv")
+    csv_duration = (dt.datetime.now() - start_time).total_seconds()
+    path, bundle_duration = timed(results_store.write_run, out_dir, strategy_name, {}, frames,
+                                  all_traded_stocks, portfolio, trade_table, trips)
+    symbol = all_traded_stocks[-1]
+    _, csv_read_duration = timed(pd.read_csv, f"{out_dir}/{symbol}.csv", index_col=0,
+                                 parse_dates=True)
+    with results_store.ResultsReader(out_dir, strategy_name) as reader:
+        frame, bundle_read_duration = timed(reader.load_symbol, symbol)
+        if reader.symbols() != all_traded_stocks or \
+                not frame.equals(frames[symbol]) or \
+                not reader.load_trades().equals(trade_table) or \
+                not reader.load_round_trips().equals(trips):
+            raise ValueError(f"{strategy_name}: the results bundle does not match the results")
+    csv_size = sum(os.path.getsize(f"{out_dir}/{name}") for name in os.listdir(out_dir)
+                   if name.endswith('.csv'))
+    bundle_size = os.path.getsize(path)
+    shutil.rmtree(out_dir)
+    print(f"{strategy_name}: {len(all_traded_stocks)} symbols, "
+          f"csv {csv_duration:.3f}s {csv_size / 1e6:.1f}MB, "
+          f"bundle {bundle_duration:.3f}s {bundle_size / 1e6:.1f}MB, "
+          f"reading a symbol {csv_read_duration * 1000:.1f}ms vs "
+          f"{bundle_read_duration * 1000:.1f}ms")
+
+
+# modules that used to be imported by every script and its workers
+EAGER_IMPORTS = ['plotting', 'matplotlib.pyplot', 'talib', 'scipy.stats']
+# the ones no script may import on startup, scipy.optimize can bring scipy.stats along
+LAZY_IMPORTS = ['plotting', 'matplotlib.pyplot', 'talib']
+
+
+# cold start import time in seconds of statements in a new interpreter from -X importtime,
+# the sum of the top level imports, and the names of all the modules that were imported
+def import_time(statement):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True,
+                            env=dict(os.environ, MPLBACKEND='Agg')).stderr
+    total, modules = 0, set()
+    for line in output.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or \
+                not fields[1].strip().isdigit():
+            continue
+        modules.add(fields[2].strip())
+        # nested imports are indented further and are part of their parent's time
+        if not fields[2][1:].startswith(' '):
+            total += int(fields[1]) / 1e6
+    return total, modules
+
+
+# import the scripts in a new interpreter as they are and together with the modules they
+# used to import eagerly, the lazily imported modules must not be loaded by the scripts
+def compare_import_time(scripts=('backtesting', 'differential_evolution')):
+    eager = [module for module in EAGER_IMPORTS if importlib.util.find_spec(
+        module.split('.')[0]) is not None]
+    for script in scripts:
+        lazy_duration, modules = import_time(f"import {script}")
+        loaded = [module for module in LAZY_IMPORTS if module in modules]
+        if loaded:
+            raise ValueError(f"{script}: imports {', '.join(loaded)} on startup")
+        eager_duration, _ = import_time(f"import {', '.join([script] + eager)}")
+        print(f"import {script}: {len(modules)} modules, "
+              f"with {', '.join(eager)} {eager_duration:.3f}s, "
+              f"lazy {lazy_duration:.3f}s, "
+              f"speedup {eager_duration / lazy_duration:.1f}x")
+
+
+# unique (USS) and proportional (PSS) set size of a process in megabytes, zero for a
+# process that has exited
+def process_memory_mb(pid):
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) / 1024
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return np.array([fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+                     fields.get('Pss', 0)])
+
+
+# run evaluations in a forked worker, once the parent has measured the workers at rest
+def run_evaluations(evaluate, evaluations, ready, start):
+    ready.put(os.getpid())
+    start.wait()
+    for _ in range(evaluations):
+        evaluate()
+
+
+# compare the memory of forked optimizer workers whose evaluations deep copy the universe
+# with workers that share the read-only input dataframes they inherited, the USS and PSS of
+# all workers are summed while they run, a deep copy is private to every worker while the
+# shared frames stay in the pages of the parent
+def compare_memory(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                   stoploss_percentage, workers=4, evaluations=3):
+    def evaluate(copy):
+        frames = copy_dfs(dfs) if copy else dfs
+        fast_backtesting.backtest(frames, all_symbols, mdf, spdf, index,
+                                  string_to_strategy[strategy_name], params,
+                                  stoploss_percentage)
+
+    growth = {}
+    context = mp.get_context('fork')
+    for copy in [True, False]:
+        ready, start = context.Queue(), context.Event()
+        processes = [context.Process(target=run_evaluations,
+                                     args=(functools.partial(evaluate, copy), evaluations,
+                                           ready, start))
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get()
+        at_rest = sum(process_memory_mb(process.pid) for process in processes)
+        peak = at_rest
+        start.set()
+        while any(process.is_alive() for process in processes):
+            peak = np.maximum(peak, sum(process_memory_mb(process.pid)
+                                        for process in processes))
+            time.sleep(0.005)
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                raise ValueError(f"a memory benchmark worker exited with {process.exitcode}")
+        growth[copy] = peak - at_rest
+    saving = growth[True] - growth[False]
+    print(f"peak memory growth of {workers} workers over {evaluations} evaluations each, "
+          f"uss / pss: deep copy {growth[True][0]:.1f}MB / {growth[True][1]:.1f}MB, "
+          f"shared input {growth[False][0]:.1f}MB / {growth[False][1]:.1f}MB, "
+          f"saving {saving[0]:.1f}MB / {saving[1]:.1f}MB")
+
+
+# backtest on float64 and on compact data, check that the compact results stay within the
+# tolerances documented in compact.py and compare the memory of the frames and batch matrices
+def compare_compact(strategy_name, params, stoploss_percentage, population):
+    results = {}
+    for compact_dtypes in [False, True]:
+        dfs, index, all_symbols, mdf, spdf = backtesting.get_data(compact_dtypes=compact_dtypes)
+        backtesting.filter_universe(dfs, index, all_symbols, mdf)
+        frames = {}
+        (sharpe_ratio, portfolio, _, trades), duration = timed(
+            fast_backtesting.backtest, dfs, all_symbols, mdf, spdf, index,
+            string_to_strategy[strategy_name], params, stoploss_percentage, frames=frames,
+            compact_dtypes=compact_dtypes)
+        matrices = batch_backtesting.build_batch_matrices(
+            dfs, all_symbols, mdf, index, strategy_name, np.array(population), compact_dtypes)
+        batch_sharpe_ratios, _ = batch_backtesting.batch_backtest(
+            dfs, all_symbols, mdf, index, strategy_name, population, stoploss_percentage,
+            compact_masks=compact_dtypes)
+        results[compact_dtypes] = {
+            'sharpe_ratio': sharpe_ratio, 'portfolio': portfolio,
+            'trades': {(trade['symbol'], trade['side'], trade['date']) for trade in trades},
+            'batch_sharpe_ratios': batch_sharpe_ratios, 'duration': duration,
+            'data_mb': compact.frame_bytes(dfs) / 1e6,
+            'frames_mb': compact.frame_bytes(frames) / 1e6,
+            'matrices_mb': sum(values.nbytes for values in matrices.values()) / 1e6}
+    full, small = results[False], results[True]
+
+    mismatched = len(full['trades'] ^ small['trades']) / max(len(full['trades']), 1)
+    if mismatched > compact.MAX_TRADE_MISMATCH:
+        raise ValueError(f"{strategy_name}: {mismatched:.1%} of the compact trades differ")
+    if not np.allclose(small['portfolio']['total_portfolio_value'],
+                       full['portfolio']['total_portfolio_value'], rtol=compact.PORTFOLIO_RTOL):
+        raise ValueError(f"{strategy_name}: compact portfolio values are out of tolerance")
+    if abs(small['sharpe_ratio'] - full['sharpe_ratio']) > compact.SHARPE_ATOL or \
+            not np.allclose(small['batch_sharpe_ratios'], full['batch_sharpe_ratios'], rtol=0,
+                            atol=compact.SHARPE_ATOL):
+        raise ValueError(f"{strategy_name}: compact sharpe ratios are out of tolerance")
+    print(f"{strategy_name}: compact within tolerance, {mismatched:.2%} of trades differ, "
+          f"sharpe {full['sharpe_ratio']:.6f} vs {small['sharpe_ratio']:.6f}, "
+          f"price data {full['data_mb']:.1f}MB vs {small['data_mb']:.1f}MB, "
+          f"signal frames {full['frames_mb']:.1f}MB vs {small['frames_mb']:.1f}MB, "
+          f"batch matrices {full['matrices_mb']:.1f}MB vs {small['matrices_mb']:.1f}MB, "
+          f"backtest {full['duration']:.3f}s vs {small['duration']:.3f}s")
+
+
+# time a batch of optimizer evaluations on worker pools of growing size, for both the
+# fork and spawn start methods, workers attach to the data published in shared memory
+def compare_worker_scaling(dfs, all_symbols, mdf, index, evaluations=None):
+    max_workers = os.cpu_count()
+    worker_counts = sorted({2 ** i for i in range(max_workers.bit_length())} | {max_workers})
+    evaluations = evaluations or 4 * max_workers
+    bounds = np.array(differential_evolution.param_bounds[STRATEGY][1])
+    candidates = np.random.default_rng(0).uniform(bounds[:, 0], bounds[:, 1],
+                                                  size=(evaluations, len(bounds)))
+    manifest, blocks = shared_data.publish(dfs, all_symbols, mdf, index)
+    for start_method in ['fork', 'spawn']:
+        context = mp.get_context(start_method)
+        for num_workers in worker_counts:
+            with context.Pool(num_workers, initializer=differential_evolution.init_worker,
+                              initargs=(manifest, None)) as pool:
+                jobs = [(candidate, differential_evolution.param_bounds)
+                        for candidate in candidates]
+                # warm up so that starting and attaching the workers is not timed
+                pool.starmap(differential_evolution.shared_objective_function,
+                             jobs[:num_workers], chunksize=1)
+                _, duration = timed(pool.starmap,
+                                    differential_evolution.shared_objective_function, jobs)
+            print(f"{start_method}, {num_workers} workers: {evaluations} evaluations in "
+                  f"{duration:.2f}s, {evaluations / duration:.2f} evaluations/s")
+    shared_data.release(blocks)
+
+
+# time a batch of optimizer evaluations on growing numbers of broker workers on this host,
+# each loads the data itself like a worker on another host, then stall one worker so that
+# its task is handed out again after the heartbeat timeout, every result has to match the
+# evaluation in this process
+def compare_broker_scaling(dfs, all_symbols, mdf, index, evaluations=None):
+    max_workers = os.cpu_count()
+    worker_counts = sorted({2 ** i for i in range(max_workers.bit_length())} | {max_workers})
+    evaluations = evaluations or 4 * max_workers
+    bounds = np.array(differential_evolution.param_bounds[STRATEGY][1])
+    candidates = np.random.default_rng(1).uniform(bounds[:, 0], bounds[:, 1],
+                                                  size=(evaluations, len(bounds)))
+    function = functools.partial(differential_evolution.shared_objective_function,
+                                 param_bounds=differential_evolution.param_bounds)
+    shared_data.attached = dfs, all_symbols, mdf, index
+    expected = [function(candidate) for candidate in candidates]
+    key = job_broker.data_key(dfs, all_symbols, mdf, index)
+    # a one off secret, the broker only listens on the loopback interface
+    authkey = secrets.token_bytes(32)
+    context = mp.get_context('spawn')
+    throughput = {}
+    for num_workers in worker_counts:
+        broker = job_broker.Broker(('127.0.0.1', 0), key, authkey)
+        workers = job_broker.start_local_workers(broker, num_workers, context)
+        broker.wait_for_workers(num_workers)
+        # warm up so that loading the data in the workers is not timed
+        broker.map(function, candidates[:num_workers])
+        fitness, duration = timed(broker.map, function, candidates)
+        if not np.allclose(fitness, expected):
+            raise ValueError(f"{num_workers} broker workers score differently")
+        throughput[num_workers] = evaluations / duration
+        print(f"broker, {num_workers} workers: {evaluations} evaluations in {duration:.2f}s, "
+              f"{throughput[num_workers]:.2f} evaluations/s, "
+              f"{throughput[num_workers] / throughput[1] / num_workers:.0%} efficiency")
+
+        if num_workers == worker_counts[-1] and num_workers > 1:
+            # a stopped worker keeps its connection but sends no more heartbeats
+            stalled = workers[0]
+            os.kill(stalled.pid, signal.SIGSTOP)
+            fitness, duration = timed(broker.map, function, candidates)
+            os.kill(stalled.pid, signal.SIGCONT)
+            if not np.allclose(fitness, expected):
+                raise ValueError(f"{num_workers} broker workers with one stalled score "
+                                 f"differently")
+            print(f"broker, {num_workers} workers with one stalled: {evaluations} evaluations "
+                  f"in {duration:.2f}s, {broker.redispatched} tasks handed out again")
+        broker.close()
+        for worker in workers:
+            worker.join()
+
+
+# check that the batch backtest scores a population like one array backtest per candidate
+def compare_batch(dfs, all_symbols, mdf, spdf, index, strategy_name, param_matrix,
+                  stoploss_percentage):
+    param_names = differential_evolution.param_bounds[strategy_name][0]
+    start_time = dt.datetime.now()
+    sharpe_ratios, buy_counts = [], []
+    for params in param_matrix:
+        result = fast_backtesting.backtest(dfs, all_symbols, mdf, spdf, index,
+                                           string_to_strategy[strategy_name],
+                                           dict(zip(param_names, params)),
+                                           stoploss_percentage)
+        sharpe_ratios += [result[0]]
+        buy_counts += [len(result[3]) // 2]
+    single_duration = (dt.datetime.now() - start_time).total_seconds()
+    (batch_sharpe_ratios, batch_buy_counts), batch_duration = timed(
+        batch_backtesting.batch_backtest, dfs, all_symbols, mdf, index, strategy_name,
+        param_matrix, stoploss_percentage)
+    if not np.allclose(sharpe_ratios, batch_sharpe_ratios) or \
+            not np.array_equal(buy_counts, batch_buy_counts):
+        raise ValueError(f"{strategy_name}: batch and single backtests differ")
+    print(f"{strategy_name} population of {len(param_matrix)}: "
+          f"one by one {single_duration:.3f}s, batch {batch_duration:.3f}s, "
+          f"speedup {single_duration / batch_duration:.1f}x")
+
+
+# check that the vectorized metrics match the single series helpers on the equity curves of
+# every strategy, each repeated copies times to time them on a population sized input
+def compare_metrics(dfs, all_symbols, mdf, spdf, index, strategy_params, stoploss_percentage,
+                    copies=50):
+    benchmark = spdf.loc[index, 'Adj Close']
+    curves = [fast_backtesting.backtest(dfs, all_symbols, mdf, spdf, index,
+                                        string_to_strategy[strategy_name], params,
+                                        stoploss_percentage)[1]['total_portfolio_value']
+              for strategy_name, params in strategy_params.items()] * copies
+    start_time = dt.datetime.now()
+    helper_results = [[get_sharpe_ratio(curve), get_sortino_ratio(curve),
+                       *get_alpha_beta(benchmark, curve), drawdown(curve).max()]
+                      for curve in curves]
+    helper_duration = (dt.datetime.now() - start_time).total_seconds()
+    results, vectorized_duration = timed(metrics.evaluate, np.vstack(curves), benchmark)
+    vectorized_results = np.column_stack([results['sharpe_ratio'], results['sortino_ratio'],
+                                          results['alpha'], results['beta'],
+                                          results['max_drawdown']])
+    if not np.allclose(helper_results, vectorized_results, rtol=1e-9, atol=1e-12):
+        raise ValueError("vectorized metrics differ from the helpers")
+    print(f"metrics of {len(curves)} equity curves: helpers {helper_duration:.3f}s, "
+          f"vectorized {vectorized_duration:.3f}s, "
+          f"speedup {helper_duration / vectorized_duration:.1f}x")
+
+
+# check that the entry and exit kernel with the cash allocation pass makes the same trades as
+# the date by date simulation, and time trade detection and cash allocation separately
+def compare_simulation(dfs, all_symbols, mdf, index, strategy_name, params,
+                       stoploss_percentage):
+    frames = {symbol: backtesting.add_signals(dfs[symbol], symbol, mdf,
+                                              string_to_strategy[strategy_name], params,
+                                              index[0], index[-1])
+              for symbol in all_symbols}
+    matrices = fast_backtesting.build_matrices(frames, all_symbols, index)
+    loop_result, loop_duration = timed(fast_backtesting.simulate, index, all_symbols,
+                                       stoploss_percentage=stoploss_percentage, **matrices)
+    kernel_result, kernel_duration = timed(trade_kernels.simulate, index, all_symbols,
+                                           stoploss_percentage=stoploss_percentage,
+                                           **matrices)
+    if not np.array_equal(loop_result[0], kernel_result[0]) or \
+            not np.allclose(loop_result[1], kernel_result[1]) or \
+            not np.array_equal(loop_result[2], kernel_result[2], equal_nan=True) or \
+            loop_result[3:] != kernel_result[3:]:
+        raise ValueError(f"{strategy_name}: kernel and loop simulations differ for a "
+                         f"stoploss of {stoploss_percentage}")
+
+    detection, detection_duration = timed(trade_kernels.detect_trades,
+                                          stoploss_percentage=stoploss_percentage,
+                                          **matrices)
+    _, allocation_duration = timed(trade_kernels.allocate_cash, *detection,
+                                   matrices['price'], len(index))
+    print(f"{strategy_name} simulation, stoploss {stoploss_percentage}: "
+          f"{len(loop_result[4])} trades, "
+          f"date loop {loop_duration:.4f}s, kernel {kernel_duration:.4f}s "
+          f"(trade detection {detection_duration:.4f}s for {len(detection[0])} candidate "
+          f"entries, cash allocation {allocation_duration:.4f}s), "
+          f"speedup {loop_duration / kernel_duration:.1f}x")
+
+
+# check that the streaming engine gives the same signals as the strategy functions and,
+# stepped through the history one day at a time, the same trades and portfolio as a backtest
+def compare_streaming(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                      stoploss_percentage):
+    for symbol in all_symbols:
+        df = dfs[symbol]
+        frame = backtesting.add_signals(df, symbol, mdf, string_to_strategy[strategy_name],
+                                        params, index[0], index[-1])
+        state = streaming.SymbolState(strategy_name, params)
+        signals = pd.DataFrame([state.update(price) for price in df['Adj Close']],
+                               index=df.index,
+                               columns=['has_row', 'buy_signal', 'sell_condition'])
+        signals = signals[signals['has_row'] & (signals.index >= index[0]) &
+                          (signals.index <= index[-1])]
+        # the rows before the symbol became an index constituent are cut from the frame
+        signals = signals.iloc[len(signals) - len(frame):]
+        if not signals.index.equals(frame.index) or \
+                not np.array_equal(signals['buy_signal'], frame['buy_signal'].astype(bool)) or \
+                not np.array_equal(signals['sell_condition'], frame['sell_condition']):
+            raise ValueError(f"{strategy_name} {symbol}: streaming and batch signals differ")
+
+    (sharpe_ratio, portfolio, _, trades), backtest_duration = timed(
+        fast_backtesting.backtest, dfs, all_symbols, mdf, spdf, index,
+        string_to_strategy[strategy_name], params, stoploss_percentage)
+    engine = streaming.SignalEngine(strategy_name, params, stoploss_percentage, mdf, index[0])
+    results, streaming_duration = timed(streaming.replay, engine, dfs, all_symbols, index[-1])
+    steps = len(results)
+    results = [result for result in results if result['date'] >= index[0]]
+    streaming_trades = [trade for result in results for trade in result['trades']]
+    if [(trade['symbol'], trade['side'], trade['date']) for trade in trades] != \
+            [(trade['symbol'], trade['side'], trade['date']) for trade in streaming_trades]:
+        raise ValueError(f"{strategy_name}: streaming and backtest trades differ")
+    total_portfolio_value = pd.Series([result['total_portfolio_value'] for result in results],
+                                      index=[result['date'] for result in results])
+    if not total_portfolio_value.index.equals(index) or \
+            not np.allclose(total_portfolio_value, portfolio['total_portfolio_value']):
+        raise ValueError(f"{strategy_name}: streaming and backtest portfolios differ")
+    print(f"{strategy_name}: streaming engine matches, {len(trades)} trades, "
+          f"{steps} steps in {streaming_duration:.3f}s "
+          f"({streaming_duration / steps * 1000:.2f}ms a day), "
+          f"backtest {backtest_duration:.3f}s")
+
+
+# backtest synthetic 5 minute bars in memory and chunk by chunk from the price store, the
+# results have to be the same for every chunk size, including chunks smaller than the
+# indicator warm-up
+def compare_chunked(strategy_name, params, stoploss_percentage, n_symbols=30,
+                    chunk_sizes=(50, 1000, 100000)):
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='chunked_data_') as data_root:
+        # get_data reads from DATA_DIR_NAME in the working directory
+        os.chdir(data_root)
+        try:
+            start = pd.Timestamp(TRADE_START_DATE) - pd.Timedelta(days=40)
+            end = pd.Timestamp(TRADE_START_DATE) + pd.Timedelta(days=40)
+            synthetic_data.write_synthetic_data(n_symbols, start, end, bar_minutes=5)
+            dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+            backtesting.filter_universe(dfs, index, all_symbols, mdf)
+            (sharpe_ratio, portfolio, _, trades), backtest_duration = timed(
+                fast_backtesting.backtest, dfs, all_symbols, mdf, spdf, index,
+                string_to_strategy[strategy_name], params, stoploss_percentage)
+            store = price_store.open_store(f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}")
+            durations = {}
+            for chunk_bars in chunk_sizes:
+                (chunked_sharpe_ratio, chunked_portfolio, _, chunked_trades), \
+                    durations[chunk_bars] = timed(chunked_backtesting.backtest, store, mdf,
+                                                  strategy_name, params, stoploss_percentage,
+                                                  all_symbols, chunk_bars)
+                if [(trade['symbol'], trade['side'], trade['date']) for trade in trades] != \
+                        [(trade['symbol'], trade['side'], trade['date'])
+                         for trade in chunked_trades]:
+                    raise ValueError(f"{strategy_name}: trades differ in chunks of "
+                                     f"{chunk_bars} bars")
+                if not chunked_portfolio.index.equals(portfolio.index) or \
+                        not np.allclose(chunked_portfolio['total_portfolio_value'],
+                                        portfolio['total_portfolio_value']) or \
+                        not np.isclose(chunked_sharpe_ratio, sharpe_ratio):
+                    raise ValueError(f"{strategy_name}: portfolios differ in chunks of "
+                                     f"{chunk_bars} bars")
+        finally:
+            os.chdir(working_dir)
+    print(f"{strategy_name}: chunked backtest matches on {len(index)} 5 minute bars x "
+          f"{len(all_symbols)} symbols, {len(trades)} trades, sharpe ratio {sharpe_ratio:.3f} "
+          f"at {metrics.periods_per_year(index)} bars a year, in memory "
+          f"{backtest_duration:.3f}s, " +
+          ", ".join(f"chunks of {chunk_bars}: {duration:.3f}s"
+                    for chunk_bars, duration in durations.items()))
+
+
+# check that the array engine gives the same backtest as the pandas engine
+def compare_engines(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                    stoploss_percentage):
+    results, durations = {}, {}
+    for engine in [backtesting, fast_backtesting]:
+        results[engine], durations[engine] = timed(engine.backtest, dfs,
+                                                   all_symbols, mdf, spdf, index,
+                                                   string_to_strategy[strategy_name],
+                                                   params, stoploss_percentage)
+    sharpe_ratio, portfolio, all_traded_stocks, trades = results[backtesting]
+    fast_sharpe_ratio, fast_portfolio, fast_all_traded_stocks, fast_trades = \
+        results[fast_backtesting]
+
+    if all_traded_stocks != fast_all_traded_stocks or trades != fast_trades:
+        raise ValueError(f"{strategy_name}: engines took different trades")
+    if not np.allclose(portfolio['total_portfolio_value'].astype(float),
+                       fast_portfolio['total_portfolio_value']):
+        raise ValueError(f"{strategy_name}: engines have different portfolio values")
+    if not np.isclose(sharpe_ratio, fast_sharpe_ratio):
+        raise ValueError(f"{strategy_name}: engines have different sharpe ratios")
+    print(f"{strategy_name}: {len(trades)} trades, "
+          f"pandas engine {durations[backtesting]:.3f}s, "
+          f"array engine {durations[fast_backtesting]:.3f}s, "
+          f"speedup {durations[backtesting] / durations[fast_backtesting]:.1f}x")
+
+
+if __name__ == "__main__":
+    print_params()
+    make_dirs()
+    compare_import_time()
+    compare_data_loading()
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+    compare_universe(dfs, index, all_symbols, mdf)
+    compare_membership(index, all_symbols, mdf)
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+
+    strategy_params = backtesting.optimized_params
+    for strategy_name, params in strategy_params.items():
+        compare_engines(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                        STOPLOSS_PERCENTAGE)
+    # a stoploss of 0 sells every position on the day it is bought
+    for strategy_name, params in strategy_params.items():
+        for stoploss_percentage in [STOPLOSS_PERCENTAGE, 0]:
+            compare_simulation(dfs, all_symbols, mdf, index, strategy_name, params,
+                               stoploss_percentage)
+    for strategy_name, params in strategy_params.items():
+        compare_streaming(dfs, all_symbols, mdf, spdf, index, strategy_name, params,
+                          STOPLOSS_PERCENTAGE)
+    for strategy_name, params in strategy_params.items():
+        compare_chunked(strategy_name, params, STOPLOSS_PERCENTAGE)
+    compare_metrics(dfs, all_symbols, mdf, spdf, index, strategy_params, STOPLOSS_PERCENTAGE)
+    for strategy_name, params in strategy_params.items():
+        compare_ledger(dfs, all_symbols, mdf, spdf, index, strategy_name, params, 5)
+    compare_rendering(dfs, all_symbols, mdf, spdf, index, STRATEGY, strategy_params[STRATEGY],
+                      STOPLOSS_PERCENTAGE)
+    compare_results_output(dfs, all_symbols, mdf, spdf, index, STRATEGY,
+                           strategy_params[STRATEGY], STOPLOSS_PERCENTAGE)
+    population = {'sma': [[23, 77], [5, 10], [10, 50], [23, 77], [40, 100], [15, 30]],
+                  'bb': [[35, 41, 96], [10, 0, 51], [35, 20, 80], [100, 49, 100], [20, 10, 60]]}
+    for strategy_name in batch_backtesting.BATCH_STRATEGIES:
+        compare_batch(dfs, all_symbols, mdf, spdf, index, strategy_name,
+                      population[strategy_name], STOPLOSS_PERCENTAGE)
+    compare_memory(dfs, all_symbols, mdf, spdf, index, STRATEGY, strategy_params[STRATEGY],
+                   STOPLOSS_PERCENTAGE)
+    for strategy_name in batch_backtesting.BATCH_STRATEGIES:
+        compare_compact(strategy_name, strategy_params[strategy_name], STOPLOSS_PERCENTAGE,
+                        population[strategy_name])
+    compare_worker_scaling(dfs, all_symbols, mdf, index)
+    compare_broker_scaling(dfs, all_symbols, mdf, index)
@@ -0,0 +1,174 @@
+# out-of-core backtest for bar data that does not fit into memory, like 1 or 5 minute bars of
+# the whole universe: the bars are read from the memory-mapped price store in time ordered
+# chunks of CHUNK_BARS dates and stepped through streaming.SignalEngine, whose indicator and
+# portfolio state carries over from one chunk to the next, so only one chunk of the date x
+# symbol arrays is in memory at a time, the results are the ones fast_backtesting.backtest
+# gives on the same bars
+import argparse
+import numpy as np
+import pandas as pd
+import backtesting
+import instrumentation
+import ledger
+import membership
+import metrics
+import price_store
+import results_store
+import streaming
+from constants import *
+from helpers import *
+
+
+# store row of the last bar of every column up to the end of the store, -1 for columns
+# without any, read one chunk at a time
+def last_bar_rows(adj_close, cols, chunk_bars):
+    last_rows = np.full(len(cols), -1)
+    for start in range(0, len(adj_close), chunk_bars):
+        has_bar = ~np.isnan(adj_close[start:start + chunk_bars][:, cols])
+        rows = start + len(has_bar) - 1 - np.argmax(has_bar[::-1], axis=0)
+        last_rows = np.where(has_bar.any(axis=0), rows, last_rows)
+    return last_rows
+
+
+# backtest a strategy over the bars of a price store (as returned by price_store.open_store)
+# from DATA_START_DATE to end_date, trading from start_date on, with the outputs of
+# fast_backtesting.backtest, the bars before start_date only warm up the indicators,
+# symbols are all symbols of the store unless a list is given, the metrics are annualized
+# with the number of bars a year has
+@instrumentation.timed('chunked_backtest')
+def backtest(store, mdf, strategy_name, params, stoploss_percentage, symbols=None,
+             chunk_bars=CHUNK_BARS, start_date=TRADE_START_DATE, end_date=TRADE_END_DATE,
+             universe_size=UNIVERSE_SIZE, intervals=None):
+    start_time_of_backtest = dt.datetime.now()
+    store = price_store.slice_store(store, DATA_START_DATE, end_date)
+    dates = store['dates']
+    symbols = list(store['symbols'] if symbols is None else symbols)
+    cols = pd.Index(store['symbols']).get_indexer(symbols)
+    if np.any(cols < 0):
+        raise ValueError(f"Symbols missing from the price store: "
+                         f"{[symbol for symbol, col in zip(symbols, cols) if col < 0]}")
+    symbol_array = np.array(symbols, dtype=object)
+    adj_close, volume = store['fields']['Adj Close'], store['fields']['Volume']
+    if intervals is None:
+        intervals = membership.load_intervals(mdf)
+    table = membership.interval_table(intervals)
+
+    with instrumentation.stage('chunked_backtest.last_bars'):
+        last_rows = last_bar_rows(adj_close, cols, chunk_bars)
+    engine = streaming.SignalEngine(strategy_name, params, stoploss_percentage, mdf,
+                                    start_date)
+    trade_start = dates.searchsorted(start_date, side='left')
+    index = dates[trade_start:]
+    usd_holdings = np.empty(len(index))
+    stock_holdings_value = np.empty(len(index))
+    trades = []
+
+    for start in range(0, len(dates), chunk_bars):
+        stop = min(start + chunk_bars, len(dates))
+        chunk_dates = dates[start:stop]
+        with instrumentation.stage('chunked_backtest.read'):
+            prices = adj_close[start:stop][:, cols]
+            volumes = volume[start:stop][:, cols]
+        has_bar = ~np.isnan(prices)
+        # the universe of the bars that can be traded and the symbols that are forced out
+        with instrumentation.stage('chunked_backtest.universe'):
+            in_universe = np.zeros(prices.shape, dtype=bool)
+            if stop > trade_start:
+                is_member = membership.membership_mask(table, chunk_dates, symbols)
+                in_universe = backtesting.top_volume(volumes, has_bar & is_member,
+                                                     universe_size)
+            is_last_day = np.zeros(prices.shape, dtype=bool)
+            ends_here = np.flatnonzero((last_rows >= start) & (last_rows < stop))
+            is_last_day[last_rows[ends_here] - start, ends_here] = True
+
+        with instrumentation.stage('chunked_backtest.step'):
+            for i, date in enumerate(chunk_dates):
+                bars = dict(zip(symbol_array[has_bar[i]], prices[i, has_bar[i]].tolist()))
+                result = engine.step(date, bars, set(symbol_array[in_universe[i]]),
+                                     set(symbol_array[is_last_day[i]]))
+                row = start + i - trade_start
+                if row >= 0:
+                    usd_holdings[row] = result['usd_holdings']
+                    stock_holdings_value[row] = result['stock_holdings_value']
+                    trades += result['trades']
+
+    # check to make sure there are no long positions open
+    if engine.position:
+        raise ValueError("There are open longs at the end of the backtest")
+    all_traded_stocks = list(dict.fromkeys(trade['symbol'] for trade in trades
+                                           if trade['side'] == 'buy'))
+
+    # a dataframe to keep track of the portfolio
+    portfolio = pd.DataFrame({'usd_holdings': usd_holdings,
+                              'stock_holdings_value': stock_holdings_value},
+                             index=index, columns=COLUMNS)
+    # calculate the total portfolio value
+    portfolio['total_portfolio_value'] = portfolio['usd_holdings'] + \
+                                         portfolio['stock_holdings_value']
+    sharpe_ratio = get_sharpe_ratio(portfolio['total_portfolio_value'],
+                                    metrics.periods_per_year(index))
+    backtest_duration = dt.datetime.now() - start_time_of_backtest
+    print(f"backtest evaluation duration: {backtest_duration}, "
+          f"sharpe ratio: {sharpe_ratio}, "
+          f"params = {params}, "
+          f"stoploss = {stoploss_percentage}, "
+          f"chunks of {chunk_bars} bars")
+    return sharpe_ratio, portfolio, all_traded_stocks, trades
+
+
+# backtest STRATEGY chunk by chunk over the price store of BAR_INTERVAL, save the portfolio
+# and the trades and print the report
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="backtest the strategy in constants.py over "
+                                                 "a price store that does not fit into memory",
+                                     parents=list(parents))
+    parser.add_argument('--store-dir', default=f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}",
+                        help="price store to read the bars from")
+    parser.add_argument('--run-id', default=None,
+                        help="name of the run's results bundle, strategy and time by default")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.configure(args.instrument, args.profile)
+
+    print_params()
+    print(f"bars: {BAR_INTERVAL}, chunk size: {CHUNK_BARS} bars")
+    mdf = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}",
+                      parse_dates=["date_added_sp"], index_col=0)
+    mdf['date_added_sp'] = membership.first_added_dates(mdf, membership.load_intervals(mdf))
+    store = price_store.open_store(args.store_dir)
+    sharpe_ratio, portfolio, all_traded_stocks, trades = backtest(
+        store, mdf, STRATEGY, backtesting.params, STOPLOSS_PERCENTAGE)
+
+    trade_table = ledger.trade_ledger(trades)
+    trips = ledger.round_trips(trade_table, portfolio.index)
+    trade_summary = ledger.summary(trips)
+    if backtesting.SAVE_RESULTS:
+        run_id = args.run_id or results_store.new_run_id(STRATEGY)
+        meta = {'strategy': STRATEGY, 'params': backtesting.params,
+                'stoploss_percentage': STOPLOSS_PERCENTAGE, 'bar_interval': BAR_INTERVAL,
+                'trade_start_date': TRADE_START_DATE, 'trade_end_date': TRADE_END_DATE}
+        with instrumentation.stage('save_results'):
+            with results_store.ResultsWriter(RESULTS_DIR_NAME, run_id, meta) as writer:
+                writer.write_frame('portfolio', portfolio)
+                writer.write_frame('trades', trade_table, index=False)
+                writer.write_frame('round_trips', trips, index=False)
+        print(f"saved the results to {results_store.bundle_path(RESULTS_DIR_NAME, run_id)}")
+
+    report = metrics.evaluate(portfolio['total_portfolio_value'],
+                              periods_per_year=metrics.periods_per_year(portfolio.index))
+    print("")
+    print("Trading Strategy")
+    print(f"traded symbols: {len(all_traded_stocks)}, trades: {trade_summary['trades']}")
+    print(f"trade win rate: {round(trade_summary['win_rate'], 2)}%")
+    print(f"sharpe ratio: {report['sharpe_ratio'][0]}")
+    print(f"sortino ratio: {report['sortino_ratio'][0]}")
+    print(f"max drawdown: {report['max_drawdown'][0] * 100}%")
+    print(f"longest drawdown: {report['max_drawdown_duration'][0]} bars")
+    print(f"cagr: {report['cagr'][0] * 100}%")
+    tpv = portfolio['total_portfolio_value']
+    print(f"profit: {round(((tpv.iloc[-1] - tpv.iloc[0]) / tpv.iloc[0] * 100), 2)}%")
+    instrumentation.print_summary()
+
+
+if __name__ == "__main__":
+    main()
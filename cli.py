@@ -0,0 +1,78 @@
+# one entry point for the scripts, e.g. `python cli.py backtest --strategy bb --stoploss 10`,
+# the settings of constants.py are flags here and reach the scripts and the worker processes
+# they start through BACKTEST_<name> environment variables, nothing is imported before they
+# are set and a subcommand only imports the script it runs, so matplotlib, talib and yfinance
+# are only loaded by the subcommands that use them
+import argparse
+import importlib
+import os
+
+# the script that runs each subcommand
+SUBCOMMANDS = {'backtest': 'backtesting',
+               'chunked': 'chunked_backtesting',
+               'optimize': 'differential_evolution',
+               'grid': 'grid_search',
+               'walk-forward': 'walk_forward',
+               'sweep': 'sweep',
+               'signals': 'streaming',
+               'collect': 'data_collection',
+               'worker': 'job_broker',
+               'plot': 'plotting'}
+# flags of the settings, by the name of their environment variable
+SETTING_FLAGS = {'STRATEGY': '--strategy',
+                 'STOPLOSS_PERCENTAGE': '--stoploss',
+                 'DATA_START_DATE': '--data-start',
+                 'TRADE_START_DATE': '--trade-start',
+                 'TRADE_END_DATE': '--trade-end',
+                 'UNIVERSE_SIZE': '--universe-size',
+                 'COMPACT': '--compact',
+                 'BAR_INTERVAL': '--bar-interval',
+                 'CHUNK_BARS': '--chunk-bars'}
+
+
+# the settings flags, shared by all subcommands, values are checked when constants is imported
+def settings_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    group = parser.add_argument_group("settings of constants.py")
+    group.add_argument('--strategy', choices=['sma', 'macd', 'bb', 'rsi_sma'])
+    group.add_argument('--stoploss', help="stoploss percentage")
+    group.add_argument('--data-start', help="first date of data the indicators use (YYYY-MM-DD)")
+    group.add_argument('--trade-start', help="first trading date (YYYY-MM-DD)")
+    group.add_argument('--trade-end', help="last trading date (YYYY-MM-DD)")
+    group.add_argument('--universe-size', help="number of symbols in the universe every day")
+    group.add_argument('--compact', action='store_const', const='1',
+                       help="float32 prices and compact signals for large universes")
+    group.add_argument('--bar-interval', help="interval of the price bars, e.g. 1d or 5m")
+    group.add_argument('--chunk-bars', help="dates of bars the chunked backtest reads at a time")
+    group.add_argument('--headless', action='store_true',
+                       help="render plots to files only, with the Agg backend of matplotlib")
+    return parser
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="backtest, backtest in chunks, optimize, "
+                                                 "search the grid, walk forward, sweep, "
+                                                 "step the signal engine, run optimizer "
+                                                 "workers, collect data or plot",
+                                     epilog="run a subcommand with --help for its flags")
+    parser.add_argument('command', choices=list(SUBCOMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help="flags of the subcommand and the settings")
+    args = parser.parse_args(argv)
+
+    settings = settings_parser()
+    values, _ = settings.parse_known_args(args.args)
+    for name, flag in SETTING_FLAGS.items():
+        value = getattr(values, flag[2:].replace('-', '_'))
+        if value is not None:
+            os.environ[f"BACKTEST_{name}"] = value
+    if values.headless:
+        os.environ['MPLBACKEND'] = 'Agg'
+
+    # the script's parser also takes the settings flags, so its --help lists them
+    script = importlib.import_module(SUBCOMMANDS[args.command])
+    script.main(args.args, parents=[settings])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# compact in-memory representation for large universes, switched on with COMPACT
+# (BACKTEST_COMPACT=1 or cli.py --compact): float32 prices, uint32 volumes (int64 when they
+# do not fit), bool signal columns instead of object ones, int8 position markers and the
+# boolean masks of the batch backtest packed into bits along the symbol axis
+import numpy as np
+import pandas as pd
+
+PRICE_DTYPE = np.float32
+# position markers of the signal frames, instead of nan, 1 and -1 as float64
+NO_POSITION = 0
+# symbols that are packed together when the batch masks are built, a multiple of 8
+PACK_BLOCK_SYMBOLS = 512
+
+# how far compact results may be from float64 ones, checked by benchmarks.compare_compact:
+# float32 keeps about 7 significant digits of a price, so portfolio values agree to about
+# 1e-6 relative, and a crossover only flips when two averages are that close to each other,
+# which moves a handful of trades by a day at most
+PORTFOLIO_RTOL = 1e-4
+SHARPE_ATOL = 1e-3
+MAX_TRADE_MISMATCH = 0.01
+
+
+# smallest of uint32 and int64 that holds every volume, missing volumes become 0
+def volume_dtype(volume):
+    return np.uint32 if volume.max(initial=0) < 2 ** 32 and volume.min(initial=0) >= 0 \
+        else np.int64
+
+
+# Adj Close and Volume of a ticker in compact dtypes
+def compact_prices(df):
+    volume = np.round(df['Volume'].fillna(0).to_numpy())
+    return pd.DataFrame({'Adj Close': df['Adj Close'].to_numpy(dtype=PRICE_DTYPE),
+                         'Volume': volume.astype(volume_dtype(volume))}, index=df.index)
+
+
+# the columns add_signals made in compact dtypes: float32 indicators, bool signals
+# (the shifted buy signal is an object column with missing values otherwise)
+# and int8 position markers
+def compact_signals(df):
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column == 'position_size':
+            columns[column] = position_markers(values.to_numpy(dtype=np.float64))
+        elif values.dtype == object or values.dtype == bool:
+            columns[column] = values.fillna(False).to_numpy(dtype=bool)
+        elif values.dtype == np.float64:
+            columns[column] = values.to_numpy(dtype=PRICE_DTYPE)
+        else:
+            columns[column] = values.to_numpy()
+    return pd.DataFrame(columns, index=df.index)
+
+
+# position sizes with nan for no trade as int8 markers
+def position_markers(position_size):
+    return np.nan_to_num(position_size, nan=NO_POSITION).astype(np.int8)
+
+
+# pack a boolean array into bits along its last axis
+def pack_mask(mask):
+    return np.packbits(mask, axis=-1)
+
+
+# the first n booleans of every bit packed row
+def unpack_mask(bits, n):
+    return np.unpackbits(bits, axis=-1, count=n).view(bool)
+
+
+# bytes held by the per symbol frames, with their indexes
+def frame_bytes(dfs):
+    return sum(int(df.memory_usage(index=True, deep=True).sum()) for df in dfs.values())
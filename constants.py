@@ -1,26 +1,66 @@
 # constants used across multiple different scripts
 import strategies
 import datetime as dt
+import os
 
-STRATEGY = 'sma'
-DATA_START_DATE = dt.datetime(year=2009, month=1, day=1)
-TRADE_START_DATE = dt.datetime(year=2020, month=1, day=1)
-TRADE_END_DATE = dt.datetime(year=2023, month=1, day=1)
+# the settings below can be overridden with BACKTEST_<name> environment variables, which is
+# how the flags of cli.py reach the scripts and the worker processes they start
+SETTINGS_ENV_PREFIX = 'BACKTEST_'
 
-UNIVERSE_SIZE = 50
+
+# a setting from its environment variable, parsed, or the default when it is not set
+def env_setting(name, default, parse=str):
+    value = os.environ.get(SETTINGS_ENV_PREFIX + name)
+    return default if value is None else parse(value)
+
+
+# an int when the text is a whole number, a float otherwise
+def parse_number(text):
+    number = float(text)
+    return int(number) if number.is_integer() else number
+
+
+# true for 1, true and yes
+def parse_flag(text):
+    return text.lower() in ('1', 'true', 'yes')
+
+
+STRATEGY = env_setting('STRATEGY', 'sma')
+DATA_START_DATE = env_setting('DATA_START_DATE', dt.datetime(year=2009, month=1, day=1),
+                              dt.datetime.fromisoformat)
+TRADE_START_DATE = env_setting('TRADE_START_DATE', dt.datetime(year=2020, month=1, day=1),
+                               dt.datetime.fromisoformat)
+TRADE_END_DATE = env_setting('TRADE_END_DATE', dt.datetime(year=2023, month=1, day=1),
+                             dt.datetime.fromisoformat)
+
+UNIVERSE_SIZE = env_setting('UNIVERSE_SIZE', 50, int)
 STARTING_CAPITAL = 100
 POSITION_SIZE_QUOTE = 5
 TRANSACTION_FEE_AND_SLIPPAGE_PERCENT = 0.1
 FEE_FACTOR = (100 - TRANSACTION_FEE_AND_SLIPPAGE_PERCENT) / 100
-STOPLOSS_PERCENTAGE = 15
+STOPLOSS_PERCENTAGE = env_setting('STOPLOSS_PERCENTAGE', 15, parse_number)
+# float32 prices, compact signal columns and bit packed batch masks, see compact.py
+COMPACT = env_setting('COMPACT', False, parse_flag)
+# yfinance interval of the price bars, intraday bars like '5m' get a price store of their own
+DAILY_BAR_INTERVAL = '1d'
+BAR_INTERVAL = env_setting('BAR_INTERVAL', DAILY_BAR_INTERVAL)
+# dates of bars the chunked backtest reads from the price store at a time
+CHUNK_BARS = env_setting('CHUNK_BARS', 10000, int)
 
 DATA_DIR_NAME = 'stock_price_data'
 DATA_FILE_NAME = 'stock_price_data.csv'
 METADATA_FILE_NAME = 'stock_price_metadata.csv'
+MEMBERSHIP_FILE_NAME = 'sp500_membership.csv'
+METADATA_CHECKPOINT_FILE_NAME = 'metadata_checkpoint.jsonl'
 SP500_DATA_FILE_NAME = 'sp500_price_data.csv'
+PRICE_STORE_DIR_NAME = 'price_store' if BAR_INTERVAL == DAILY_BAR_INTERVAL \
+    else f'price_store_{BAR_INTERVAL}'
+RESULT_CACHE_FILE_NAME = 'optimization_results.sqlite'
+SIGNAL_SNAPSHOT_FILE_NAME = 'signal_engine_snapshot.pkl'
+PROFILE_DIR_NAME = 'profiles'
 PNG_OUT_DIR_NAME = 'png_plots'
 CSV_OUT_DIR_NAME = 'csv_plots'
-IND_DATA_DIR_NAME = 'individual_stock_price_data'
+RESULTS_DIR_NAME = 'results'
 COLUMNS = ['usd_holdings', 'stock_holdings_value', 'index_price']
 
 string_to_strategy = {'sma': strategies.sma_cross,
@@ -1,28 +1,35 @@
 # a script that has to be run first, gets S&P constituents from wikipedia, downloads data from yfinance
+# run with --update to add the constituents that joined since the last run and to only download
+# the bars and tickers that are missing from the price store
+import argparse
 import pandas as pd
 import numpy as np
-import time
-import requests
-import yfinance as yf
+import membership
+import price_store
+from data_providers import YahooProvider
+from metadata_fetcher import fetch_metadata
 from constants import *
 import os
 
 DOWNLOAD_DATA_START = dt.datetime(year=2000, month=1, day=1)
 DOWNLOAD_DATA_END = dt.datetime(year=2023, month=1, day=1)
+INDEX_SYMBOL = '^GSPC'
 
 
 # create directories if missing
-for dir_name in [DATA_DIR_NAME, DATA_DIR_NAME + "/" + IND_DATA_DIR_NAME]:
-    if not os.path.isdir(dir_name):
-        os.mkdir(dir_name)
+def make_data_dirs():
+    if not os.path.isdir(DATA_DIR_NAME):
+        os.mkdir(DATA_DIR_NAME)
 
-# create metadata if not present
-if not os.path.isfile(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}"):
-    # get all tickers of sp 500
+
+# the current constituents and the changes tables of the S&P 500 on wikipedia
+def read_wikipedia_tables():
     wiki_html = pd.read_html('https://en.wikipedia.org/wiki/List_of_S%26P_500_companies')
-    sp500_components = wiki_html[0]
-    sp500_changes = wiki_html[1]
+    return wiki_html[0], wiki_html[1]
+
 
+# get all tickers of sp 500 together with the date they were added
+def get_wikipedia_metadata(sp500_components, sp500_changes):
     # extract metadata from wikipedia
     columns = ["symbol", "date_added_sp", "name_wiki"]
     data = {}
@@ -59,63 +66,192 @@ if not os.path.isfile(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}"):
     # dropping duplicate symbols but keeping the one that has the earlier date
     mdf = mdf.sort_values('date_added_sp')
     mdf = mdf.drop_duplicates(subset=['symbol'], keep='first')
-    mdf = mdf.reset_index(drop=True).set_index('symbol')
-else:
-    print("found metadata in csv, reading...")
-    mdf = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}", parse_dates=["date_added_sp"], index_col=0)
-
-# if there is no data, download it
-if not os.path.isfile(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}"):
-    end_date = DOWNLOAD_DATA_END
-    start_date = DOWNLOAD_DATA_START
-    df = yf.download(list(mdf.index), start=start_date, end=end_date, interval="1d", group_by='ticker')
-    df.to_csv(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}")
-else:
-    print("found stock price data in csv, reading...")
-df = pd.read_csv(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}", parse_dates=True, index_col=[0], header=[0, 1])
-
-
-# if there is no s&p 500 data, download it
-if not os.path.isfile(f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}"):
-    end_date = DOWNLOAD_DATA_END
-    start_date = DOWNLOAD_DATA_START
-    spdf = yf.download("^GSPC", start=start_date, end=end_date, interval="1d", group_by='ticker')
-    spdf.to_csv(f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}")
-else:
-    print("found S&P 500 price data in csv, reading...")
-spdf = pd.read_csv(f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}", parse_dates=True, index_col=[0])
-
-# drop empty dfs, empty rows, useless columns
-all_symbols = list(set([t[0] for t in df.columns]))
-dfs = {}
-for ticker in all_symbols:
-    ticker_df = df[ticker].dropna(subset=['Adj Close'])
-    if not ticker_df.empty:
-        ticker_df.to_csv(f"{DATA_DIR_NAME}/{IND_DATA_DIR_NAME}/{ticker}.csv")
-        dfs[ticker] = ticker_df
-all_symbols = list(dfs.keys())
-
-if not os.path.isfile(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}"):
-    # add more metadata
-    mdf['name_yf'] = np.nan
-    mdf['currency'] = np.nan
-    mdf['exchange'] = np.nan
-    mdf['quote_type'] = np.nan
-    mdf['timezone'] = np.nan
-
-    for i, symbol in enumerate(all_symbols):
-        print(f"Downloading metadata for {symbol} {i+1}/{len(all_symbols)}")
-        ticker = yf.Ticker(symbol)
-        company_info = ticker.fast_info
-        try:
-            company_name = ticker.info['longName'] + f" ({symbol})"
-            print(f"full company name (symbol): {company_name}")
-        except Exception as _:
-            company_name = symbol
-        mdf.loc[symbol, 'name_yf'] = company_name
-        mdf.loc[symbol, 'currency'] = company_info['currency']
-        mdf.loc[symbol, 'exchange'] = company_info['exchange']
-        mdf.loc[symbol, 'quote_type'] = company_info['quoteType']
-        mdf.loc[symbol, 'timezone'] = company_info['timezone']
-    mdf = mdf.dropna(subset=['timezone'])
-    mdf.to_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}")
+    return mdf.reset_index(drop=True).set_index('symbol')
+
+
+# save the membership intervals of every current and removed constituent, and give the
+# removed constituents the date of their first addition instead of none
+def save_membership(mdf, sp500_components, sp500_changes):
+    intervals = membership.intervals_from_wikipedia(sp500_components, sp500_changes)
+    intervals.to_csv(f"{DATA_DIR_NAME}/{MEMBERSHIP_FILE_NAME}", index=False)
+    first_added = intervals.groupby('symbol')['start'].min()
+    mdf['date_added_sp'] = mdf['date_added_sp'].fillna(first_added.reindex(mdf.index))
+    return mdf
+
+
+# download the full history of all symbols into the price store, and the csv for daily bars
+def download_price_data(provider, symbols, store_dir, start_date, end_date):
+    df = provider.download(symbols, start_date, end_date)
+    if BAR_INTERVAL == DAILY_BAR_INTERVAL:
+        df.to_csv(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}")
+    price_store.write_store(df, store_dir)
+
+
+# download only what the price store is missing: the bars after the last stored bar of
+# every ticker, and the full history of tickers that are not stored yet, tickers that were
+# removed from the index are only updated until their bars reach the removal or an update
+# brings them no new bars
+def update_price_data(provider, symbols, store_dir, start_date, end_date, intervals):
+    store = price_store.open_store(store_dir)
+    last_rows = price_store.last_stored_rows(store)
+    stored_symbols = dict(zip(store['symbols'], last_rows))
+    removed_dates = membership.last_removed_dates(intervals)
+    bar_duration = pd.Timedelta(BAR_INTERVAL)
+
+    # tickers that need data from the same date are downloaded together
+    start_dates = {}
+    skipped = 0
+    for symbol in symbols:
+        last_row = stored_symbols.get(symbol, -1)
+        if last_row < 0:
+            symbol_start = start_date
+        else:
+            last_date = store['dates'][last_row]
+            removed_date = removed_dates.get(symbol, pd.NaT)
+            if not pd.isna(removed_date) and (removed_date <= last_date or
+                                              last_date < store['dates'][-1]):
+                skipped += 1
+                continue
+            symbol_start = last_date + bar_duration
+        if symbol_start < end_date:
+            start_dates.setdefault(symbol_start, []).append(symbol)
+    print(f"skipping {skipped} removed tickers that will not get new bars")
+
+    frames = []
+    for symbol_start, group in start_dates.items():
+        print(f"downloading {len(group)} tickers from {symbol_start.date()} to {end_date.date()}")
+        df = provider.download(group, symbol_start, end_date)
+        if not df.empty:
+            frames += [df]
+    if not frames:
+        print("price store is up to date")
+        return
+    new_df = pd.concat(frames, axis=1)
+    price_store.update_store(store_dir, new_df)
+    print(f"added {len(new_df.index)} dates for {len(symbols_with_data(new_df))} tickers "
+          f"to the price store")
+
+
+# download the s&p 500 data, or only the bars after the last stored date when updating
+def download_index_data(provider, start_date, end_date, update=False):
+    spdf_path = f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}"
+    spdf = None
+    if update and os.path.isfile(spdf_path):
+        spdf = pd.read_csv(spdf_path, parse_dates=True, index_col=[0])
+        start_date = spdf.index[-1] + dt.timedelta(days=1)
+    if start_date >= end_date:
+        return
+    new_spdf = provider.download([INDEX_SYMBOL], start_date, end_date)
+    if new_spdf.empty:
+        return
+    new_spdf = new_spdf[INDEX_SYMBOL]
+    if spdf is not None:
+        new_spdf = pd.concat([spdf, new_spdf])
+    new_spdf.to_csv(spdf_path)
+
+
+# the tickers that have any price data, their bars are already in the price store,
+# so they are no longer written into a csv each
+def symbols_with_data(df):
+    all_symbols = list(dict.fromkeys(t[0] for t in df.columns))
+    adj_close = df.xs('Adj Close', axis=1, level=1)
+    return [ticker for ticker in all_symbols if adj_close[ticker].notna().any()]
+
+
+# add company name, currency, exchange, quote type and timezone, fetched concurrently,
+# a crashed run picks up from the checkpoint instead of starting over
+def add_yf_metadata(mdf, all_symbols, provider):
+    checkpoint_path = f"{DATA_DIR_NAME}/{METADATA_CHECKPOINT_FILE_NAME}"
+    metadata = fetch_metadata(provider, all_symbols, checkpoint_path)
+    mdf = mdf.join(metadata, how='left')
+    return mdf.dropna(subset=['timezone'])
+
+
+# the current constituents that are not in the metadata yet, with their wikipedia metadata
+def new_constituents(mdf, sp500_components, sp500_changes):
+    wiki_mdf = get_wikipedia_metadata(sp500_components, sp500_changes)
+    current = [symbol for symbol in sp500_components['Symbol'] if symbol in wiki_mdf.index]
+    return wiki_mdf.loc[[symbol for symbol in current if symbol not in mdf.index]]
+
+
+# download or update the metadata, the membership intervals and the price data, the bars
+# and metadata come from provider, yahoo finance bars of BAR_INTERVAL by default, and the
+# daily s&p 500 bars from index_provider
+def main(argv=None, parents=(), provider=None, index_provider=None):
+    parser = argparse.ArgumentParser(description="download S&P 500 constituent price data",
+                                     parents=list(parents))
+    parser.add_argument('--update', action='store_true',
+                        help="add new constituents and only download bars and tickers "
+                             "missing from the price store")
+    parser.add_argument('--end', type=dt.datetime.fromisoformat, default=None,
+                        help="download bars before this date (YYYY-MM-DD), "
+                             "defaults to today when updating")
+    args = parser.parse_args(argv)
+    end_date = args.end or (dt.datetime.combine(dt.date.today(), dt.time())
+                            if args.update else DOWNLOAD_DATA_END)
+    provider = provider or YahooProvider(BAR_INTERVAL)
+    index_provider = index_provider or YahooProvider()
+    make_data_dirs()
+
+    # create metadata if not present
+    has_metadata = os.path.isfile(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}")
+    has_membership = os.path.isfile(f"{DATA_DIR_NAME}/{MEMBERSHIP_FILE_NAME}")
+    if not has_metadata or not has_membership or args.update:
+        sp500_components, sp500_changes = read_wikipedia_tables()
+    if not has_metadata:
+        mdf = get_wikipedia_metadata(sp500_components, sp500_changes)
+    else:
+        print("found metadata in csv, reading...")
+        mdf = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}", parse_dates=["date_added_sp"], index_col=0)
+    # an update adds the constituents that joined since the last run, their full history is
+    # downloaded together with the new bars of the stored tickers
+    new_mdf = mdf.iloc[:0]
+    if has_metadata and args.update:
+        new_mdf = new_constituents(mdf, sp500_components, sp500_changes)
+        print(f"found {len(new_mdf.index)} new constituents")
+        mdf = pd.concat([mdf, new_mdf])
+    if not has_membership or args.update:
+        mdf = save_membership(mdf, sp500_components, sp500_changes)
+
+    # if there is no data, download it
+    store_dir = f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}"
+    if not price_store.store_exists(store_dir) and BAR_INTERVAL == DAILY_BAR_INTERVAL and \
+            os.path.isfile(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}"):
+        print("found stock price data in csv, converting it into the price store...")
+        price_store.csv_to_store(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}", store_dir)
+    if not price_store.store_exists(store_dir):
+        download_price_data(provider, list(mdf.index), store_dir, DOWNLOAD_DATA_START, end_date)
+    elif args.update:
+        update_price_data(provider, list(mdf.index), store_dir, DOWNLOAD_DATA_START, end_date,
+                          membership.load_intervals(mdf))
+    else:
+        print("found stock price data in the price store, reading...")
+    df = price_store.store_to_frame(price_store.open_store(store_dir))
+
+    # if there is no s&p 500 data, download it, its bars stay daily for every BAR_INTERVAL
+    if not os.path.isfile(f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}") or args.update:
+        download_index_data(index_provider, DOWNLOAD_DATA_START, end_date, update=args.update)
+    else:
+        print("found S&P 500 price data in csv, reading...")
+
+    # tickers without any data get no metadata
+    all_symbols = symbols_with_data(df)
+
+    fetches_metadata = not has_metadata or len(new_mdf.index) > 0
+    if not has_metadata:
+        mdf = add_yf_metadata(mdf, all_symbols, provider)
+    elif fetches_metadata:
+        new_symbols = list(new_mdf.index)
+        new_mdf = add_yf_metadata(mdf.loc[new_symbols, new_mdf.columns],
+                                  [symbol for symbol in all_symbols if symbol in new_symbols],
+                                  provider)
+        mdf = pd.concat([mdf.drop(index=new_symbols), new_mdf])
+    if not has_metadata or not has_membership or args.update:
+        mdf.to_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}")
+    # the checkpoint is only removed once the metadata it holds is written
+    if fetches_metadata:
+        os.remove(f"{DATA_DIR_NAME}/{METADATA_CHECKPOINT_FILE_NAME}")
+
+
+if __name__ == "__main__":
+    main()
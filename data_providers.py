@@ -0,0 +1,83 @@
+# sources of price data and ticker metadata, yahoo finance for real downloads and
+# local csvs for offline runs, every provider returns price frames with (symbol, field) columns
+import pandas as pd
+
+
+# raised when a request for part of the metadata failed, metadata holds what a retry
+# should fall back to once it runs out of attempts
+class IncompleteMetadata(Exception):
+    def __init__(self, message, metadata):
+        super().__init__(message)
+        self.metadata = metadata
+
+
+# make sure a downloaded frame has (symbol, field) columns, even for a single symbol
+def with_symbol_columns(df, symbols):
+    if not isinstance(df.columns, pd.MultiIndex):
+        df = pd.concat({symbols[0]: df}, axis=1)
+    return df
+
+
+# downloads bars from yahoo finance, daily ones unless an intraday interval like '5m' is
+# given, yahoo only serves the last weeks of intraday bars
+class YahooProvider:
+    # requests to yahoo per get_metadata call, one for fast_info and one for info
+    metadata_requests = 2
+
+    def __init__(self, interval="1d"):
+        self.interval = interval
+
+    # download the bars of symbols from start (inclusive) to end (exclusive)
+    def download(self, symbols, start, end):
+        import yfinance as yf
+        df = yf.download(list(symbols), start=start, end=end, interval=self.interval,
+                         group_by='ticker')
+        return with_symbol_columns(df, list(symbols))
+
+    # company name, currency, exchange, quote type and timezone of a symbol, a failed
+    # fast_info request raises, a failed info request raises IncompleteMetadata with the
+    # symbol as the name, tickers without a name in their info are named by their symbol
+    def get_metadata(self, symbol):
+        import yfinance as yf
+        ticker = yf.Ticker(symbol)
+        company_info = ticker.fast_info
+        metadata = {'name_yf': symbol,
+                    'currency': company_info['currency'],
+                    'exchange': company_info['exchange'],
+                    'quote_type': company_info['quoteType'],
+                    'timezone': company_info['timezone']}
+        try:
+            info = ticker.info
+        except Exception as e:
+            raise IncompleteMetadata(f"info request failed: {e}", metadata)
+        name = info.get('longName') or info.get('shortName')
+        if name:
+            metadata['name_yf'] = f"{name} ({symbol})"
+        return metadata
+
+
+# serves daily bars from a multi-index csv in the layout of stock_price_data.csv,
+# and metadata from a csv in the layout of stock_price_metadata.csv
+class CsvProvider:
+    # the metadata is read from disk, no requests are made
+    metadata_requests = 0
+
+    def __init__(self, csv_path, metadata_path=None):
+        self.df = pd.read_csv(csv_path, parse_dates=True, index_col=[0], header=[0, 1])
+        self.metadata = None
+        if metadata_path is not None:
+            self.metadata = pd.read_csv(metadata_path, index_col=0)
+
+    # return the bars of symbols from start (inclusive) to end (exclusive)
+    def download(self, symbols, start, end):
+        symbols = [symbol for symbol in symbols if symbol in self.df.columns.levels[0]]
+        df = self.df.loc[(self.df.index >= start) & (self.df.index < end), symbols]
+        return df.dropna(how='all')
+
+    # company name, currency, exchange, quote type and timezone of a symbol
+    def get_metadata(self, symbol):
+        if self.metadata is None or symbol not in self.metadata.index:
+            raise KeyError(f"no metadata for {symbol}")
+        row = self.metadata.loc[symbol]
+        return {column: row.get(column) for column in
+                ['name_yf', 'currency', 'exchange', 'quote_type', 'timezone']}
@@ -1,37 +1,72 @@
 # optimize parameters of trading strategies using differential evolution
+import argparse
+import contextlib
 import backtesting
+import batch_backtesting
+import fast_backtesting
+import indicators
+import instrumentation
+import job_broker
+import metrics
 from helpers import *
 from scipy.optimize import differential_evolution
 import multiprocessing as mp
+import numpy as np
+import result_cache
+import shared_data
+import shutil
+import tempfile
+
+# 'fork' or 'spawn', workers attach to the data in shared memory either way
+START_METHOD = 'fork'
+# evaluate whole generations in one batch backtest for the strategies that support it
+BATCH_EVALUATION = True
+
+param_bounds = {'sma': (['fast_period', 'slow_period'], [(5, 50), (10, 100)]),
+                'macd': (['fast_period', 'slow_period', 'signal_period'],
+                         [(5, 50), (10, 100), (5, 50)]),
+                'bb': (['period', 'buy_threshold', 'sell_threshold'],
+                       [(10, 100), (0, 49), (51, 100)]),
+                'rsi_sma': (['ma_period', 'rsi_period', 'oversold'],
+                            [(10, 100), (5, 50), (0, 49)])}
 
 
 # tell the progress of the optimization at the end of each generation
 def progress_callback(xk, convergence):
     print("Current best solution:", xk)
     print("Current convergence value:", convergence)
+    print_cache_stats()
+
+
+# print how often the workers found their indicators in the cache
+def print_cache_stats():
+    stats = indicators.cache.stats()
+    print(f"indicator cache: {stats['hits']} hits, {stats['shared_hits']} shared hits, "
+          f"{stats['misses']} misses, hit rate {stats['hit_rate']:.1f}%")
 
 
 # evaluates the fitness of the input parameters
+@instrumentation.timed('objective_function')
 def objective_function(params, *args):
     dfs, all_symbols, mdf, spdf, index, strat_dict, param_bounds = args
     param_names = param_bounds[STRATEGY][0]
     formatted_params = {param_names[i]: round(params[i]) for i in range(len(param_names))}
-    dfs_copy = {key: value.copy(deep=True) for key, value in dfs.items()}
     if STRATEGY in ['sma', 'macd']:
         # penalize if fast period is larger than slow period
         if formatted_params['fast_period'] >= formatted_params['slow_period']:
             return 1_000_000
     # perform the backtest
-    backtest_result = backtesting.backtest(dfs_copy, all_symbols, mdf, spdf,
-                                           index, strat_dict[STRATEGY], formatted_params,
-                                           STOPLOSS_PERCENTAGE)
+    backtest_result = fast_backtesting.backtest(dfs, all_symbols, mdf, spdf,
+                                                index, strat_dict[STRATEGY], formatted_params,
+                                                STOPLOSS_PERCENTAGE)
     sharpe_ratio, portfolio, all_traded_stocks, trades = backtest_result
     # penalize strategy if there is less than one trade a year on average
-    day_count = len(portfolio.index)
+    bar_count = len(portfolio.index)
     buy_count = int(len(trades) / 2)
-    if buy_count/day_count*252 <= 1:
-        print(f"Entered {buy_count} positions over a period of {day_count} days. "
-              f"On average that's {buy_count / day_count * 252} entries a year.")
+    buys_per_year = buy_count / bar_count * metrics.periods_per_year(portfolio.index)
+    if buys_per_year <= 1:
+        print(f"Entered {buy_count} positions over a period of {bar_count} bars. "
+              f"On average that's {buys_per_year} entries a year.")
         return 1_000_000
     # penalize low or no sharpe ratio
     if not sharpe_ratio > 0:
@@ -39,34 +74,164 @@ def objective_function(params, *args):
     return -sharpe_ratio
 
 
-if __name__ == "__main__":
-    # for MacOS or Linux, set the start method for multiprocessing
-    mp.set_start_method('fork')
+# evaluates the fitness of the input parameters on the data this worker attached to,
+# so only the parameter vector has to be sent to the worker
+def shared_objective_function(params, param_bounds):
+    dfs, all_symbols, mdf, index = shared_data.attached
+    return objective_function(params, dfs, all_symbols, mdf, None, index,
+                              string_to_strategy, param_bounds)
+
+
+# evaluates the fitness of a whole generation at once, x holds one parameter set per column,
+# or is a single parameter set when called by the polishing step at the end
+def batch_objective_function(x, *args):
+    dfs, all_symbols, mdf, index, param_bounds = args
+    if x.ndim == 1:
+        return batch_objective_function(x[:, None], *args)[0]
+    param_matrix = np.round(x.T).astype(np.int64)
+    fitness = np.full(len(param_matrix), 1_000_000.0)
+    valid = np.ones(len(param_matrix), dtype=bool)
+    if STRATEGY in ['sma', 'macd']:
+        # penalize if fast period is larger than slow period
+        valid = param_matrix[:, 0] < param_matrix[:, 1]
+    if not valid.any():
+        return fitness
+    # perform the backtest
+    sharpe_ratios, buy_count = batch_backtesting.batch_backtest(
+        dfs, all_symbols, mdf, index, STRATEGY, param_matrix[valid], STOPLOSS_PERCENTAGE)
+    # penalize strategy if there is less than one trade a year on average,
+    # and penalize low or no sharpe ratio
+    enough_trades = buy_count / len(index) * metrics.periods_per_year(index) > 1
+    fitness[valid] = np.where(enough_trades & (sharpe_ratios > 0), -sharpe_ratios, 1_000_000)
+    return fitness
+
+
+# batch objective on the data this worker attached to, for chunks of parameter sets
+def shared_batch_objective_function(x, param_bounds):
+    dfs, all_symbols, mdf, index = shared_data.attached
+    return batch_objective_function(x, dfs, all_symbols, mdf, index, param_bounds)
+
+
+# batch objective that only backtests the parameter sets missing from the result cache
+def cached_batch_objective_function(x, evaluator, *args):
+    if x.ndim == 1:
+        return cached_batch_objective_function(x[:, None], evaluator, *args)[0]
+    return np.array(evaluator.evaluate(
+        x.T, lambda missing: batch_objective_function(np.array(missing, dtype=np.float64).T,
+                                                      *args)))
+
+
+# look up earlier results of the strategy on the same data
+def open_result_cache(dfs, all_symbols, mdf, index):
+    fingerprint = result_cache.data_fingerprint(dfs, all_symbols, mdf, index)
+    cache = result_cache.ResultCache(f"{DATA_DIR_NAME}/{RESULT_CACHE_FILE_NAME}", fingerprint)
+    return cache, result_cache.CachedEvaluator(cache, STRATEGY, STOPLOSS_PERCENTAGE)
+
+
+# set up a worker process: attach to the published data and use the shared indicator cache,
+# and report to the run's instrumentation when it is on
+def init_worker(manifest, cache, recorder=None):
+    shared_data.attach(manifest)
+    indicators.cache = cache
+    instrumentation.install(recorder)
+
+
+# optimize the parameters of STRATEGY and print them
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="optimize the parameters of the strategy",
+                                     parents=list(parents))
+    parser.add_argument('--serve', default=None, metavar='HOST:PORT',
+                        help="hand the evaluations out to the workers that connect to this "
+                             "address, started with `cli.py worker --broker HOST:PORT`")
+    parser.add_argument('--local-workers', type=int, default=0,
+                        help="worker processes to start on this host for --serve")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.configure(args.instrument, args.profile)
+
     print_params()
     dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
     backtesting.filter_universe(dfs, index, all_symbols, mdf)
-    param_bounds = {'sma': (['fast_period', 'slow_period'], [(5, 50), (10, 100)]),
-                    'macd': (['fast_period', 'slow_period', 'signal_period'],
-                             [(5, 50), (10, 100), (5, 50)]),
-                    'bb': (['period', 'buy_threshold', 'sell_threshold'],
-                           [(10, 100), (0, 49), (51, 100)]),
-                    'rsi_sma': (['ma_period', 'rsi_period', 'oversold'],
-                                [(10, 100), (5, 50), (0, 49)])}
-
-    # run the optimization
-    num_workers = os.cpu_count()
-    print(f"initiating optimization with {num_workers} workers")
-    result = differential_evolution(objective_function,
-                                    param_bounds[STRATEGY][1],
-                                    args=(dfs, all_symbols, mdf, spdf, index,
-                                          string_to_strategy, param_bounds),
-                                    seed=69420,
-                                    callback=progress_callback,
-                                    workers=num_workers,
-                                    updating='deferred')
+
+    # the shared memory, the result cache and the indicator directory are released
+    # even when the optimization fails
+    with contextlib.ExitStack() as stack:
+        # indicators computed by one worker are published for all the others,
+        # in memory backed storage when the system has it
+        shared_dir = tempfile.mkdtemp(prefix='indicator_cache_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        stack.callback(shutil.rmtree, shared_dir, ignore_errors=True)
+        context = mp.get_context(START_METHOD)
+        indicators.cache = indicators.IndicatorCache(shared_dir=shared_dir, context=context)
+
+        # parameter sets scored before on the same data are not backtested again
+        results, evaluator = open_result_cache(dfs, all_symbols, mdf, index)
+        stack.callback(results.close)
+
+        # run the optimization
+        if args.serve:
+            # the polishing step at the end evaluates in this process
+            shared_data.attached = dfs, all_symbols, mdf, index
+            broker = job_broker.Broker(job_broker.parse_address(args.serve),
+                                       job_broker.data_key(dfs, all_symbols, mdf, index))
+            stack.callback(broker.close)
+            local_workers = job_broker.start_local_workers(broker, args.local_workers,
+                                                           mp.get_context('spawn'))
+            print(f"initiating optimization with the workers of the broker at {broker.address}, "
+                  f"{args.local_workers} of them on this host")
+            result = differential_evolution(shared_objective_function,
+                                            param_bounds[STRATEGY][1],
+                                            args=(param_bounds,),
+                                            seed=69420,
+                                            callback=progress_callback,
+                                            workers=evaluator.map(broker.map),
+                                            updating='deferred')
+            # idle workers stop when they ask for their next task
+            broker.close()
+            for worker in local_workers:
+                worker.join()
+            print(f"{broker.redispatched} tasks of lost workers were handed out again")
+        elif BATCH_EVALUATION and STRATEGY in batch_backtesting.BATCH_STRATEGIES:
+            print("initiating optimization with batch evaluation of each generation")
+            result = differential_evolution(cached_batch_objective_function,
+                                            param_bounds[STRATEGY][1],
+                                            args=(evaluator, dfs, all_symbols, mdf, index,
+                                                  param_bounds),
+                                            seed=69420,
+                                            callback=progress_callback,
+                                            vectorized=True,
+                                            updating='deferred')
+        else:
+            # publish the data once, the workers attach to it by name
+            manifest, blocks = shared_data.publish(dfs, all_symbols, mdf, index)
+            stack.callback(shared_data.release, blocks)
+            # the polishing step at the end evaluates in this process
+            shared_data.attached = dfs, all_symbols, mdf, index
+            num_workers = os.cpu_count()
+            print(f"initiating optimization with {num_workers} workers")
+            with context.Pool(num_workers, initializer=init_worker,
+                              initargs=(manifest, indicators.cache,
+                                        instrumentation.recorder)) as pool:
+                result = differential_evolution(shared_objective_function,
+                                                param_bounds[STRATEGY][1],
+                                                args=(param_bounds,),
+                                                seed=69420,
+                                                callback=progress_callback,
+                                                workers=evaluator.map(pool.map),
+                                                updating='deferred')
+                # let the workers exit on their own, so they write their stage timings
+                pool.close()
+                pool.join()
+        print_cache_stats()
+        evaluator.print_throughput()
+        instrumentation.print_summary()
 
     # print optimized parameters
     for i, param_name in enumerate(param_bounds[STRATEGY][0]):
         param_name = param_name.replace('_', ' ')
         print(f'optimized {param_name}: {result.x[i]}')
     print(f'-----\n{result}')
+
+
+if __name__ == "__main__":
+    main()
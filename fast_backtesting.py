@@ -0,0 +1,163 @@
+# array-backed backtesting engine, runs the same trading rules as backtesting.backtest
+# over date x symbol numpy matrices instead of per-date pandas lookups
+import pandas as pd
+import numpy as np
+import compact
+import instrumentation
+import metrics
+import trade_kernels
+from backtesting import add_signals
+from constants import *
+from helpers import *
+
+
+# line all symbols up on one date x symbol matrix for every column the event loop reads
+def build_matrices(dfs, all_symbols, index):
+    shape = (len(index), len(all_symbols))
+    matrices = {'price': np.full(shape, np.nan),
+                'buy_signal': np.zeros(shape, dtype=bool),
+                'sell_condition': np.zeros(shape, dtype=bool),
+                'in_universe': np.zeros(shape, dtype=bool),
+                'has_row': np.zeros(shape, dtype=bool),
+                'is_last_day': np.zeros(shape, dtype=bool)}
+    for j, symbol in enumerate(all_symbols):
+        df = dfs[symbol]
+        if df.empty:
+            continue
+        rows = index.get_indexer(df.index)
+        known = rows >= 0
+        rows = rows[known]
+        matrices['price'][rows, j] = df['Adj Close'].to_numpy()[known]
+        matrices['buy_signal'][rows, j] = df['buy_signal'].to_numpy(dtype=bool)[known]
+        matrices['sell_condition'][rows, j] = df['sell_condition'].to_numpy(dtype=bool)[known]
+        matrices['in_universe'][rows, j] = df['in_universe'].to_numpy(dtype=bool)[known]
+        matrices['has_row'][rows, j] = True
+        # a symbol can only be force sold on the last day it has data for
+        if known[-1]:
+            matrices['is_last_day'][rows[-1], j] = True
+    return matrices
+
+
+# run the cash, position, stoploss and last day rules over preallocated arrays, one date
+# at a time, trade_kernels.simulate gives the same results and is what backtest uses
+def simulate(index, all_symbols, price, buy_signal, sell_condition, in_universe,
+             has_row, is_last_day, stoploss_percentage):
+    stoploss_factor = (100 - stoploss_percentage) / 100
+    n_dates, n_symbols = price.shape
+    # size of the held position and stoploss price of every symbol, 0 when there is none
+    position = np.zeros(n_symbols)
+    stoploss = np.zeros(n_symbols)
+    position_size = np.full(price.shape, np.nan)
+    usd_holdings = np.empty(n_dates)
+    stock_holdings_value = np.zeros(n_dates)
+    is_traded = np.zeros(n_symbols, dtype=bool)
+    all_traded_stocks = []
+    trades = []
+
+    usd = STARTING_CAPITAL
+    for i in range(n_dates):
+        date = index[i]
+        today_price = price[i]
+        has_position = position > 0
+        # symbols that are long or in the universe today
+        current = has_row[i] & (has_position | in_universe[i])
+        allow_buys = current & ~has_position & ~is_last_day[i] & buy_signal[i]
+        trigger_stoploss_sell = (stoploss > 0) & (stoploss >= today_price)
+        allow_sells = current & has_position & (trigger_stoploss_sell | is_last_day[i] |
+                                                sell_condition[i])
+
+        # cash is spent and received in symbol order, so only the symbols
+        # that could trade today are walked one by one
+        for j in np.flatnonzero(allow_buys | allow_sells):
+            symbol = all_symbols[j]
+            symbol_price = today_price[j]
+
+            # check for buys
+            if allow_buys[j] and usd >= POSITION_SIZE_QUOTE:
+                position_size[i, j] = 1
+                # adjust usd holdings and position size keeping fees in mind
+                usd -= POSITION_SIZE_QUOTE
+                position[j] = (POSITION_SIZE_QUOTE / symbol_price) * FEE_FACTOR
+                stoploss[j] = symbol_price * stoploss_factor
+                trades += [{'symbol': symbol,
+                            'side': 'buy',
+                            'price': symbol_price,
+                            'size': position_size[i, j],
+                            'date': date}]
+                # keep track of all the symbols that have had a trade
+                if not is_traded[j]:
+                    is_traded[j] = True
+                    all_traded_stocks += [symbol]
+
+            # handle sells
+            trigger_stoploss_sell = stoploss[j] > 0 and stoploss[j] >= symbol_price
+            if position[j] > 0 and (trigger_stoploss_sell or is_last_day[i, j] or
+                                    sell_condition[i, j]):
+                position_size[i, j] = -1
+                # adjust usd holdings and position size keeping fees in mind
+                usd += (position[j] * symbol_price) * FEE_FACTOR
+                position[j] = 0
+                stoploss[j] = 0
+                trades += [{'symbol': symbol,
+                            'side': 'sell',
+                            'price': symbol_price,
+                            'size': position_size[i, j],
+                            'date': date}]
+
+        # handle the usd value of owned stock
+        held = has_row[i] & (position > 0)
+        stock_holdings_value[i] = np.sum(position[held] * today_price[held])
+        usd_holdings[i] = usd
+
+    # check to make sure there are no long positions open
+    if np.any(position > 0):
+        raise ValueError("There are open longs at the end of the backtest")
+    return usd_holdings, stock_holdings_value, position_size, all_traded_stocks, trades
+
+
+# backtest trading strategy and strategy parameters, same inputs and outputs as
+# backtesting.backtest, dfs is not modified and all per run state lives in the matrices,
+# trades are made over the dates of index only, so a sub-range of it backtests a window
+@instrumentation.timed('fast_backtest')
+def backtest(dfs, all_symbols, mdf, spdf, index, strategy, params, stoploss_percentage,
+             frames=None, compact_dtypes=COMPACT):
+    start_time_of_backtest = dt.datetime.now()
+    # adds necessary indicators to every symbol
+    with instrumentation.stage('fast_backtest.signals'):
+        signal_frames = {symbol: add_signals(dfs[symbol], symbol, mdf, strategy, params,
+                                             index[0], index[-1], compact_dtypes)
+                         for symbol in all_symbols}
+    with instrumentation.stage('fast_backtest.matrices'):
+        matrices = build_matrices(signal_frames, all_symbols, index)
+    with instrumentation.stage('fast_backtest.simulate'):
+        simulation = trade_kernels.simulate(index, all_symbols,
+                                            stoploss_percentage=stoploss_percentage,
+                                            **matrices)
+    usd_holdings, stock_holdings_value, position_size, all_traded_stocks, trades = simulation
+
+    # write the buys and sells into the frames so they can be plotted
+    if frames is not None:
+        for j, symbol in enumerate(all_symbols):
+            df = signal_frames[symbol]
+            if not df.empty:
+                sizes = position_size[index.get_indexer(df.index), j]
+                df['position_size'] = compact.position_markers(sizes) if compact_dtypes else sizes
+            frames[symbol] = df
+
+    # a dataframe to keep track of the portfolio
+    portfolio = pd.DataFrame({'usd_holdings': usd_holdings,
+                              'stock_holdings_value': stock_holdings_value},
+                             index=index, columns=COLUMNS)
+    # calculate the total portfolio value
+    portfolio['total_portfolio_value'] = portfolio['usd_holdings'] + \
+                                         portfolio['stock_holdings_value']
+    # sharpe ratio
+    with instrumentation.stage('fast_backtest.sharpe_ratio'):
+        sharpe_ratio = get_sharpe_ratio(portfolio['total_portfolio_value'],
+                                        metrics.periods_per_year(index))
+    backtest_duration = dt.datetime.now() - start_time_of_backtest
+    print(f"backtest evaluation duration: {backtest_duration}, "
+          f"sharpe ratio: {sharpe_ratio}, "
+          f"params = {params}, "
+          f"stoploss = {stoploss_percentage}")
+    return sharpe_ratio, portfolio, all_traded_stocks, trades
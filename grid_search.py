@@ -0,0 +1,101 @@
+# optimize parameters of trading strategies by scoring every point of their integer grid,
+# with the same objective as differential_evolution.py, on a process pool, points that were
+# already scored on the same data are taken from the result cache
+import argparse
+import contextlib
+import functools
+import itertools
+import backtesting
+import batch_backtesting
+import differential_evolution
+import indicators
+from helpers import *
+import multiprocessing as mp
+import numpy as np
+import shared_data
+import shutil
+import tempfile
+
+# parameter sets per task when the strategy is scored with batch backtests
+GRID_BATCH_SIZE = 32
+
+
+# all integer parameter sets within the bounds, every step-th value of each parameter
+def parameter_grid(bounds, step=1):
+    return list(itertools.product(*[range(low, high + 1, step) for low, high in bounds]))
+
+
+# a random subset of the grid, in grid order
+def sample_grid(grid, max_points, seed=69420):
+    if max_points is None or max_points >= len(grid):
+        return grid
+    chosen = np.random.default_rng(seed).choice(len(grid), size=max_points, replace=False)
+    return [grid[i] for i in np.sort(chosen)]
+
+
+# score parameter sets on the pool, in chunks of batch backtests when the strategy supports it
+def evaluate_on_pool(pool, param_sets, param_bounds):
+    if differential_evolution.BATCH_EVALUATION and \
+            STRATEGY in batch_backtesting.BATCH_STRATEGIES:
+        chunks = [np.array(param_sets[start:start + GRID_BATCH_SIZE], dtype=np.float64).T
+                  for start in range(0, len(param_sets), GRID_BATCH_SIZE)]
+        objective = functools.partial(differential_evolution.shared_batch_objective_function,
+                                      param_bounds=param_bounds)
+        return np.concatenate(pool.map(objective, chunks))
+    return pool.map(functools.partial(differential_evolution.shared_objective_function,
+                                      param_bounds=param_bounds), param_sets)
+
+
+# score the grid of STRATEGY on a process pool and print the best parameter sets
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="Score every point of the parameter grid",
+                                     parents=list(parents))
+    parser.add_argument('--step', type=int, default=1,
+                        help="only use every step-th value of each parameter")
+    parser.add_argument('--max-points', type=int, default=None,
+                        help="score a random subset of this many grid points")
+    args = parser.parse_args(argv)
+
+    print_params()
+    param_bounds = differential_evolution.param_bounds
+    param_names, bounds = param_bounds[STRATEGY]
+    grid = sample_grid(parameter_grid(bounds, args.step), args.max_points)
+    print(f"grid of {len(grid)} parameter sets")
+
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+    # the shared memory, the result cache and the indicator directory are released
+    # even when the search fails
+    with contextlib.ExitStack() as stack:
+        results, evaluator = differential_evolution.open_result_cache(dfs, all_symbols, mdf, index)
+        stack.callback(results.close)
+
+        shared_dir = tempfile.mkdtemp(prefix='indicator_cache_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        stack.callback(shutil.rmtree, shared_dir, ignore_errors=True)
+        context = mp.get_context(differential_evolution.START_METHOD)
+        indicators.cache = indicators.IndicatorCache(shared_dir=shared_dir, context=context)
+        manifest, blocks = shared_data.publish(dfs, all_symbols, mdf, index)
+        stack.callback(shared_data.release, blocks)
+
+        num_workers = os.cpu_count()
+        print(f"initiating grid search with {num_workers} workers")
+        with context.Pool(num_workers, initializer=differential_evolution.init_worker,
+                          initargs=(manifest, indicators.cache)) as pool:
+            fitnesses = np.array(evaluator.evaluate(
+                grid, lambda missing: evaluate_on_pool(pool, missing, param_bounds)))
+        differential_evolution.print_cache_stats()
+        evaluator.print_throughput()
+
+    # print the best parameter sets, a fitness of 1_000_000 is a penalized parameter set
+    print('-----')
+    for i in np.argsort(fitnesses, kind='stable')[:10]:
+        if fitnesses[i] >= 1_000_000:
+            break
+        formatted_params = ', '.join(f"{param_name.replace('_', ' ')}: {param}"
+                                     for param_name, param in zip(param_names, grid[i]))
+        print(f"{formatted_params}, sharpe ratio: {-fitnesses[i]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 # helper functions used throughout several modules
 import os
 from constants import *
-from scipy.stats import linregress
 
 
 # print basic information about backtest
@@ -11,29 +10,30 @@ def print_params():
     print(f"trading end date: {TRADE_END_DATE}")
 
 
-# compute annualized sharpe ratio
-def get_sharpe_ratio(price_column):
+# compute annualized sharpe ratio, periods_per_year is the number of bars in a year
+def get_sharpe_ratio(price_column, periods_per_year=252):
     daily_return = price_column.pct_change().dropna()
     mean_return = daily_return.mean()
     std_return = daily_return.std()
     if not std_return > 0:
         return 0
-    return mean_return/std_return * (252**0.5)
+    return mean_return/std_return * (periods_per_year**0.5)
 
 
 # compute annualized sortino ratio
-def get_sortino_ratio(price_column):
+def get_sortino_ratio(price_column, periods_per_year=252):
     daily_return = price_column.pct_change().dropna()
     mean_return = daily_return.mean()
     downside = daily_return[daily_return < 0]
     std_downside = downside.std()
     if not std_downside > 0:
         return 0
-    return mean_return/std_downside * (252**0.5)
+    return mean_return/std_downside * (periods_per_year**0.5)
 
 
-# compute alpha and beta values
+# compute alpha and beta values, scipy.stats is slow to import and only needed here
 def get_alpha_beta(benchmark, asset):
+    from scipy.stats import linregress
     if not benchmark.index.equals(asset.index):
         raise ValueError("Datasets do not have the same index")
     # calculate returns for both benchmark and security/portfolio
@@ -0,0 +1,157 @@
+# technical indicators used by the strategies, memoized by (symbol, indicator, params)
+# when a cache is installed, e.g. by the optimizer that tries the same periods over and over
+import multiprocessing as mp
+import os
+from collections import OrderedDict
+import numpy as np
+
+MAX_CACHE_BYTES = 1_000_000_000
+
+# the cache used by the indicator functions, None disables caching
+cache = None
+
+
+# least recently used cache of indicator arrays with a memory cap, the hit and miss counters
+# live in shared memory so forked optimizer workers add up to one total, and with a
+# shared_dir the arrays are also published as memory-mapped files every process can read,
+# the files are held to the same cap and the least recently used ones are deleted first,
+# the counters have to come from the multiprocessing context the workers are started with
+class IndicatorCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, shared_dir=None, context=mp):
+        self.max_bytes = max_bytes
+        self.shared_dir = shared_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = context.Value('q', 0)
+        self.shared_hits = context.Value('q', 0)
+        self.misses = context.Value('q', 0)
+        # bytes of the files in shared_dir, its lock also serializes publishing and evicting
+        self.shared_size = context.Value('q', 0)
+
+    # file an entry is published under in the shared directory
+    def shared_path(self, key):
+        return f"{self.shared_dir}/{'-'.join(str(part) for part in key)}.npy"
+
+    # return the cached array for key, computing and storing it on a miss
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            count(self.hits)
+            return self.entries[key]
+        values = None
+        if self.shared_dir is not None:
+            values = self.load_shared(key)
+        if values is None:
+            values = compute()
+            values.flags.writeable = False
+            count(self.misses)
+            if self.shared_dir is not None:
+                self.publish(key, values)
+        self.put(key, values)
+        return values
+
+    # the published array of key, None when there is none or it was just evicted
+    def load_shared(self, key):
+        path = self.shared_path(key)
+        try:
+            values = np.load(path, mmap_mode='r')
+            # mark the file as recently used for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        count(self.shared_hits)
+        return values
+
+    # write an array into the shared directory, evicting the least recently used files to
+    # stay under the memory cap, arrays larger than the cap are not published
+    def publish(self, key, values):
+        path = self.shared_path(key)
+        with self.shared_size.get_lock():
+            if os.path.isfile(path):
+                return
+            self.evict_shared(self.max_bytes - values.nbytes)
+            if self.shared_size.value + values.nbytes > self.max_bytes:
+                return
+            # write under a temporary name first, other processes only see complete files
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, values)
+            os.replace(tmp_path, path)
+            self.shared_size.value += os.path.getsize(path)
+
+    # delete the least recently used files of the shared directory until at most max_size
+    # bytes are left, processes that mapped a deleted file keep their mapping
+    def evict_shared(self, max_size):
+        if self.shared_size.value <= max_size:
+            return
+        files = []
+        for entry in os.scandir(self.shared_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                files += [(stat.st_mtime, stat.st_size, entry.path)]
+        for _, size, path in sorted(files):
+            if self.shared_size.value <= max_size:
+                break
+            os.remove(path)
+            self.shared_size.value -= size
+
+    # add an entry, evicting the least recently used ones to stay under the memory cap
+    def put(self, key, values):
+        self.entries[key] = values
+        self.size += values.nbytes
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    # hit and miss counts summed over all processes
+    def stats(self):
+        hits, shared_hits, misses = self.hits.value, self.shared_hits.value, self.misses.value
+        lookups = hits + shared_hits + misses
+        hit_rate = (hits + shared_hits) / lookups * 100 if lookups else 0
+        return {'hits': hits, 'shared_hits': shared_hits, 'misses': misses,
+                'hit_rate': hit_rate}
+
+
+# increment a shared counter
+def count(counter):
+    with counter.get_lock():
+        counter.value += 1
+
+
+# look up an indicator in the cache, or compute it when caching is off
+def cached(symbol, name, params, close, compute):
+    if cache is None or symbol is None:
+        return compute()
+    # the data length is part of the key in case the same symbol is loaded over different
+    # dates, and the dtype so compact float32 prices never share entries with float64 ones
+    return cache.get((symbol, name, *params, len(close), close.dtype.name), compute)
+
+
+# simple moving average
+def sma(close, period, symbol=None):
+    return cached(symbol, 'sma', (period,), close,
+                  lambda: close.rolling(window=period).mean().to_numpy())
+
+
+# rolling standard deviation
+def rolling_std(close, period, symbol=None):
+    return cached(symbol, 'std', (period,), close,
+                  lambda: close.rolling(window=period).std().to_numpy())
+
+
+# macd line, signal line and histogram, stacked as the rows of one array,
+# talib is only imported by the strategies that need it
+def macd(close, fast_period, slow_period, signal_period, symbol=None):
+    import talib
+    return cached(symbol, 'macd', (fast_period, slow_period, signal_period), close,
+                  lambda: np.vstack(talib.MACD(close.to_numpy(dtype=np.float64),
+                                               fastperiod=fast_period,
+                                               slowperiod=slow_period,
+                                               signalperiod=signal_period)))
+
+
+# relative strength index
+def rsi(close, period, symbol=None):
+    import talib
+    return cached(symbol, 'rsi', (period,), close,
+                  lambda: talib.RSI(close.to_numpy(dtype=np.float64), timeperiod=period))
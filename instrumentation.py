@@ -0,0 +1,209 @@
+# optional wall clock, call count and peak memory instrumentation of the stages of a run,
+# switched on with the INSTRUMENTATION_ENV_VAR environment variable or the --instrument and
+# --profile flags of the scripts, every process writes its totals into the run's directory so
+# the totals of optimizer workers add up to one summary, with profiling every stage also gets
+# a cProfile of the code that runs in it, not counting the stages nested in it
+import contextlib
+import cProfile
+import functools
+import glob
+import json
+import multiprocessing.util
+import pstats
+import re
+import sys
+import time
+from constants import *
+from helpers import *
+
+# '1' times the stages, 'profile' also profiles them with cProfile
+INSTRUMENTATION_ENV_VAR = 'BACKTEST_INSTRUMENTATION'
+# seconds between two writes of a process's totals
+FLUSH_INTERVAL = 1.0
+
+try:
+    import resource
+except ImportError:
+    # windows has no getrusage, the memory columns stay 0 there
+    resource = None
+
+# the recorder the stages report to, None disables the instrumentation
+recorder = None
+# what stage returns when the instrumentation is off, does nothing on enter and exit
+no_stage = contextlib.nullcontext()
+
+
+# stage totals of one process, written to output_dir as timings.<pid>.json, and
+# <stage>.<pid>.prof files when profiling, only the settings are sent to worker processes
+class Recorder:
+    def __init__(self, output_dir, profile=False):
+        self.output_dir = output_dir
+        self.profile = profile
+        # stage name -> [calls, seconds, peak rss MB at the end, MB the peak rose by in it]
+        self.totals = {}
+        self.profilers = {}
+        self.stack = []
+        self.last_flush = time.perf_counter()
+
+    def __getstate__(self):
+        return {'output_dir': self.output_dir, 'profile': self.profile}
+
+    def __setstate__(self, state):
+        self.__init__(state['output_dir'], state['profile'])
+
+    # time the code in the with block under name, stages can be nested
+    @contextlib.contextmanager
+    def stage(self, name):
+        parent = self.stack[-1] if self.stack else None
+        self.stack.append(name)
+        if self.profile:
+            # only one profiler can run at a time, the parent's is paused
+            if parent is not None:
+                self.profilers[parent].disable()
+            self.profilers.setdefault(name, cProfile.Profile()).enable()
+        start_peak = peak_rss_mb()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            peak = peak_rss_mb()
+            if self.profile:
+                self.profilers[name].disable()
+                if parent is not None:
+                    self.profilers[parent].enable()
+            self.stack.pop()
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], peak)
+            totals[3] += peak - start_peak
+            # write the totals between stages, at most once every FLUSH_INTERVAL
+            if not self.stack and time.perf_counter() - self.last_flush > FLUSH_INTERVAL:
+                self.flush()
+
+    # write this process's totals and profiles, replacing what it wrote before
+    def flush(self):
+        pid = os.getpid()
+        tmp_path = f"{self.output_dir}/timings.{pid}.json.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.totals, f)
+        os.replace(tmp_path, f"{self.output_dir}/timings.{pid}.json")
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(f"{self.output_dir}/{name}.{pid}.prof")
+        self.last_flush = time.perf_counter()
+
+
+# highest resident set size of this process so far in megabytes, one getrusage call,
+# so it is cheap enough to read around every stage
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# time the code in the with block under name when the instrumentation is on
+def stage(name):
+    if recorder is None:
+        return no_stage
+    return recorder.stage(name)
+
+
+# decorator that runs every call of the function as a stage
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if recorder is None:
+                return function(*args, **kwargs)
+            with recorder.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# use a recorder in this process, in a worker process it starts from empty totals that are
+# written once more when the worker exits, None switches the instrumentation off
+def install(new_recorder):
+    global recorder
+    if new_recorder is not None:
+        new_recorder = Recorder(new_recorder.output_dir, new_recorder.profile)
+        multiprocessing.util.Finalize(new_recorder, new_recorder.flush, exitpriority=10)
+    recorder = new_recorder
+
+
+# switch the instrumentation on when the flags or the environment variable ask for it,
+# with a new directory for the run's totals and profiles, returns the recorder or None
+def configure(instrument=False, profile=False):
+    mode = os.environ.get(INSTRUMENTATION_ENV_VAR, '')
+    profile = profile or mode == 'profile'
+    if not (instrument or profile or mode == '1'):
+        install(None)
+        return None
+    run_name = f"{dt.datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    output_dir = f"{PROFILE_DIR_NAME}/{run_name}"
+    os.makedirs(output_dir)
+    install(Recorder(output_dir, profile))
+    return recorder
+
+
+# the --instrument and --profile flags of the scripts
+def add_arguments(parser):
+    parser.add_argument('--instrument', action='store_true',
+                        help="time every stage of the run and print a summary at the end")
+    parser.add_argument('--profile', action='store_true',
+                        help="like --instrument, and also cProfile every stage")
+
+
+# add up the totals that every process wrote into output_dir, the peak rss is the highest
+# of any process and the peak growth is summed up
+def collect_totals(output_dir):
+    totals, processes = {}, {}
+    for path in glob.glob(f"{output_dir}/timings.*.json"):
+        with open(path) as f:
+            for name, (calls, seconds, peak, growth) in json.load(f).items():
+                stage_totals = totals.setdefault(name, [0, 0.0, 0.0, 0.0])
+                stage_totals[0] += calls
+                stage_totals[1] += seconds
+                stage_totals[2] = max(stage_totals[2], peak)
+                stage_totals[3] += growth
+                processes[name] = processes.get(name, 0) + 1
+    return totals, processes
+
+
+# merge the per process profiles of every stage into one <stage>.prof file
+def merge_profiles(output_dir, names):
+    merged_paths = []
+    for name in names:
+        # the name of a nested stage starts with its parent's, so the pid has to follow
+        paths = sorted(path for path in glob.glob(f"{output_dir}/{name}.*.prof")
+                       if re.fullmatch(rf"{re.escape(name)}\.\d+\.prof", os.path.basename(path)))
+        if not paths:
+            continue
+        merged = pstats.Stats(*paths)
+        merged.dump_stats(f"{output_dir}/{name}.prof")
+        merged_paths += [f"{output_dir}/{name}.prof"]
+    return merged_paths
+
+
+# print a table of the calls, time and memory of every stage summed over all processes,
+# nested stages are listed under their parents and their time is also part of the parents'
+# time, peak MB is the highest rss of a process at the end of the stage and +peak MB how
+# much the stage raised that high-water mark, i.e. which stages make the run need memory
+def print_summary():
+    if recorder is None:
+        return
+    recorder.flush()
+    totals, processes = collect_totals(recorder.output_dir)
+    print(f"{'stage':<32}{'calls':>10}{'total s':>12}{'mean ms':>12}{'processes':>11}"
+          f"{'peak MB':>10}{'+peak MB':>10}")
+    for name in sorted(totals):
+        calls, seconds, peak, growth = totals[name]
+        print(f"{name:<32}{calls:>10}{seconds:>12.3f}{seconds / calls * 1000:>12.3f}"
+              f"{processes[name]:>11}{peak:>10.1f}{growth:>10.1f}")
+    if recorder.profile:
+        for path in merge_profiles(recorder.output_dir, totals):
+            print(f"profile written to {path}")
+    print(f"stage timings written to {recorder.output_dir}")
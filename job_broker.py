@@ -0,0 +1,329 @@
+# spreads the evaluations of the optimizer over worker processes on this and other hosts:
+# the optimizer runs a broker that hands out one task at a time to the workers that connect
+# to it over tcp, a worker loads the price data once, pulls tasks, evaluates them and pushes
+# back the results, it sends heartbeats while it works, and the tasks of a worker that stops
+# sending them or drops its connection are handed out again
+# start workers with `python cli.py worker --broker HOST:PORT`, messages are pickles, so the
+# broker and its workers refuse to run without a BACKTEST_BROKER_KEY secret, which they use
+# to authenticate each other before any message is unpickled
+import argparse
+import itertools
+import os
+import secrets
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import backtesting
+import result_cache
+import shared_data
+from helpers import *
+
+BROKER_KEY_ENV = f"{SETTINGS_ENV_PREFIX}BROKER_KEY"
+# seconds between the heartbeats of a worker, and without any message until its tasks are
+# handed out again
+HEARTBEAT_INTERVAL = 2
+HEARTBEAT_TIMEOUT = 10
+# seconds a worker waits for a task before it asks again
+IDLE_WAIT = 1
+# seconds a worker keeps trying to reach a broker that is not up yet
+CONNECT_TIMEOUT = 60
+
+
+# the shared secret of the broker and its workers, there is no default, anyone who knew the
+# key could run code on the other side
+def broker_key():
+    key = os.environ.get(BROKER_KEY_ENV)
+    if not key:
+        raise ValueError(f"Set {BROKER_KEY_ENV} to a secret shared by the broker and its "
+                         f"workers, e.g. {secrets.token_hex(16)}")
+    return key.encode()
+
+
+# (host, port) of a HOST:PORT address
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+# send every message right away, a worker sends its result and asks for the next task in
+# two small messages, which nagle's algorithm would hold back until the first is acknowledged
+def without_delay(connection):
+    with socket.fromfd(connection.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+
+# hands out tasks to the connected workers and collects their results, map is a drop in
+# replacement for the map function of a worker pool, one connection thread per worker
+class Broker:
+    def __init__(self, address, data_key, authkey=None):
+        self.authkey = authkey or broker_key()
+        self.listener = Listener(address, authkey=self.authkey)
+        self.address = self.listener.address
+        # the workers have to have loaded the same data for the same strategy and stoploss
+        self.data_key = data_key
+        self.condition = threading.Condition()
+        self.task_ids = itertools.count()
+        # function and argument of the tasks of the current map calls
+        self.tasks = {}
+        self.pending = deque()
+        self.results = {}
+        # worker of every task that is handed out
+        self.in_flight = {}
+        # time of the last message of every connected worker
+        self.last_seen = {}
+        self.redispatched = 0
+        # errors of the tasks that failed on a worker, they fail the map call of the task
+        self.errors = {}
+        self.closed = False
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                # a client without the key, or the listener was closed
+                continue
+            threading.Thread(target=self.serve, args=(without_delay(connection),),
+                             daemon=True).start()
+
+    # talk to one worker until it disconnects or the broker is closed
+    def serve(self, connection):
+        worker = None
+        try:
+            _, worker, key = connection.recv()
+            if key != self.data_key:
+                connection.send(('reject', "the worker's data, strategy or stoploss differ"))
+                return
+            connection.send(('welcome',))
+            self.seen(worker)
+            print(f"worker {worker} connected")
+            while True:
+                message = connection.recv()
+                self.seen(worker)
+                if message[0] == 'next':
+                    connection.send(self.next_task(worker))
+                elif message[0] == 'result':
+                    self.add_result(worker, message[1], message[2])
+                elif message[0] == 'error':
+                    self.add_error(worker, message[1], message[2])
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            if worker is not None:
+                self.lose(worker)
+
+    def seen(self, worker):
+        with self.condition:
+            self.last_seen[worker] = time.monotonic()
+            self.condition.notify_all()
+
+    # the next pending task for a worker, 'idle' when there is none for a while
+    def next_task(self, worker):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending or self.closed, timeout=IDLE_WAIT)
+            if self.closed:
+                return ('stop',)
+            if not self.pending:
+                return ('idle',)
+            task_id = self.pending.popleft()
+            self.in_flight[task_id] = worker
+            function, item = self.tasks[task_id]
+            return ('task', task_id, function, item)
+
+    # results of tasks that were handed out again only count once
+    def add_result(self, worker, task_id, value):
+        with self.condition:
+            if self.in_flight.get(task_id) == worker:
+                del self.in_flight[task_id]
+            if task_id in self.tasks and task_id not in self.results:
+                self.results[task_id] = value
+                self.condition.notify_all()
+
+    # a task that raised on a worker is not handed out again, its map call fails instead
+    def add_error(self, worker, task_id, text):
+        with self.condition:
+            if self.in_flight.get(task_id) == worker:
+                del self.in_flight[task_id]
+            if task_id in self.tasks and task_id not in self.results:
+                self.errors[task_id] = RuntimeError(f"worker {worker} failed:\n{text}")
+                self.condition.notify_all()
+
+    # hand the unfinished tasks of a worker out again
+    def lose(self, worker):
+        with self.condition:
+            self.last_seen.pop(worker, None)
+            lost = [task_id for task_id, owner in self.in_flight.items() if owner == worker]
+            for task_id in lost:
+                del self.in_flight[task_id]
+                if task_id not in self.results:
+                    self.pending.appendleft(task_id)
+                    self.redispatched += 1
+            if lost:
+                print(f"lost worker {worker}, handing out {len(lost)} of its tasks again")
+            self.condition.notify_all()
+
+    # workers without a message for HEARTBEAT_TIMEOUT seconds are taken as lost
+    def check_heartbeats(self):
+        with self.condition:
+            deadline = time.monotonic() - HEARTBEAT_TIMEOUT
+            silent = [worker for worker, seen in self.last_seen.items() if seen < deadline]
+        for worker in silent:
+            self.lose(worker)
+
+    # wait until n workers are connected
+    def wait_for_workers(self, n, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.last_seen) >= n, timeout=timeout):
+                raise TimeoutError(f"only {len(self.last_seen)} of {n} workers connected")
+
+    # evaluate function on every item on the workers, returns the results in item order,
+    # raises the error of the first task that failed on a worker
+    def map(self, function, iterable):
+        with self.condition:
+            task_ids = []
+            for item in iterable:
+                task_id = next(self.task_ids)
+                self.tasks[task_id] = function, item
+                self.pending.append(task_id)
+                task_ids += [task_id]
+            self.condition.notify_all()
+        try:
+            while True:
+                with self.condition:
+                    failed = [task_id for task_id in task_ids if task_id in self.errors]
+                    if failed:
+                        raise self.errors[failed[0]]
+                    if all(task_id in self.results for task_id in task_ids):
+                        return [self.results[task_id] for task_id in task_ids]
+                    self.condition.wait(timeout=HEARTBEAT_INTERVAL)
+                self.check_heartbeats()
+        finally:
+            with self.condition:
+                for task_id in task_ids:
+                    self.tasks.pop(task_id, None)
+                    self.results.pop(task_id, None)
+                    self.errors.pop(task_id, None)
+                    self.in_flight.pop(task_id, None)
+                self.pending = deque(task_id for task_id in self.pending
+                                     if task_id in self.tasks)
+
+    # tell the workers to stop and stop taking connections
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.listener.close()
+
+
+# what the broker and its workers have to agree on: the data and the optimized settings
+def data_key(dfs, all_symbols, mdf, index):
+    return (result_cache.data_fingerprint(dfs, all_symbols, mdf, index), STRATEGY,
+            STOPLOSS_PERCENTAGE)
+
+
+# connect to a broker, waiting for it to come up
+def connect(address, authkey=None):
+    authkey = authkey or broker_key()
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            return without_delay(Client(address, authkey=authkey))
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+# load the data once, then evaluate the broker's tasks until it tells the worker to stop or
+# goes away, returns the number of evaluated tasks
+def run_worker(address, name=None, authkey=None):
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    # fail before the data is loaded when there is no key
+    authkey = authkey or broker_key()
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+    # the objective functions read the data of the worker from shared_data
+    shared_data.attached = dfs, all_symbols, mdf, index
+
+    connection = connect(address, authkey)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    send(('hello', name, data_key(dfs, all_symbols, mdf, index)))
+    reply = connection.recv()
+    if reply[0] == 'reject':
+        connection.close()
+        raise ValueError(f"broker at {address} rejected the worker: {reply[1]}")
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send(('heartbeat',))
+            except OSError:
+                return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    evaluated = 0
+    try:
+        while True:
+            send(('next',))
+            message = connection.recv()
+            if message[0] == 'stop':
+                break
+            if message[0] == 'idle':
+                continue
+            _, task_id, function, item = message
+            try:
+                value = function(item)
+            except Exception:
+                send(('error', task_id, traceback.format_exc()))
+                continue
+            send(('result', task_id, value))
+            evaluated += 1
+    except (EOFError, OSError):
+        # the broker went away
+        pass
+    finally:
+        stopped.set()
+        connection.close()
+    return evaluated
+
+
+# start worker processes on this host, for a broker without remote workers or for testing
+def start_local_workers(broker, n, context):
+    workers = [context.Process(target=run_worker,
+                               args=(broker.address, f"local-{i}", broker.authkey), daemon=True)
+               for i in range(n)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+# run a worker for the broker of an optimizer on this or another host
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="evaluate the tasks of an optimizer's broker",
+                                     parents=list(parents))
+    parser.add_argument('--broker', required=True, help="HOST:PORT of the optimizer's broker")
+    parser.add_argument('--name', default=None,
+                        help="name of the worker in the broker's log, host and pid by default")
+    args = parser.parse_args(argv)
+
+    print_params()
+    evaluated = run_worker(parse_address(args.broker), args.name)
+    print(f"evaluated {evaluated} tasks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# columnar trade ledger: the trade dicts of a backtest go into one dataframe, every symbol's
+# buys and sells are paired into round trips in one grouped pass, and the report's win rate,
+# compounded profit per symbol, holding periods and top lists are computed from the round trips
+import numpy as np
+import pandas as pd
+
+LEDGER_COLUMNS = ['symbol', 'side', 'price', 'size', 'date']
+
+
+# one row per trade in the order the backtest made them, typed even when there are no trades
+def trade_ledger(trades):
+    return pd.DataFrame.from_records(trades, columns=LEDGER_COLUMNS).astype(
+        {'price': np.float64, 'size': np.float64, 'date': 'datetime64[ns]'})
+
+
+# pair each symbol's trades into (buy, sell) round trips, a symbol's trades alternate between
+# buys and sells, round trips are ordered by the first trade of their symbol and then by time,
+# with index the holding period is also counted in trading dates
+def round_trips(ledger, index=None):
+    # position of every trade among its symbol's trades, even for buys and odd for sells
+    trade_number = ledger.groupby('symbol', sort=False).cumcount().to_numpy()
+    symbol_order = ledger.groupby('symbol', sort=False).ngroup().to_numpy()
+    is_buy = trade_number % 2 == 0
+    buys, sells = ledger[is_buy], ledger[~is_buy]
+    if len(buys) != len(sells) or not (buys['side'] == 'buy').all() or \
+            not (sells['side'] == 'sell').all():
+        # check whether the trades have been paired properly
+        raise ValueError("Trades not paired properly")
+    # the k-th sell of a symbol closes its k-th buy
+    buy_order = np.lexsort((trade_number[is_buy], symbol_order[is_buy]))
+    sell_order = np.lexsort((trade_number[~is_buy], symbol_order[~is_buy]))
+    buys, sells = buys.iloc[buy_order], sells.iloc[sell_order]
+    buy_price, sell_price = buys['price'].to_numpy(), sells['price'].to_numpy()
+    trips = pd.DataFrame({'symbol': buys['symbol'].to_numpy(),
+                          'buy_date': buys['date'].to_numpy(),
+                          'buy_price': buy_price,
+                          'sell_date': sells['date'].to_numpy(),
+                          'sell_price': sell_price,
+                          'profit': 100 * (sell_price - buy_price) / buy_price})
+    trips['holding_days'] = (trips['sell_date'] - trips['buy_date']).dt.days
+    if index is not None:
+        trips['holding_bars'] = index.get_indexer(trips['sell_date']) - \
+            index.get_indexer(trips['buy_date'])
+    return trips
+
+
+# compounded profit ratio of every symbol's round trips, in the order of the round trips
+def symbol_profits(trips):
+    profit_ratio = 1 + (trips['sell_price'] - trips['buy_price']) / trips['buy_price']
+    return profit_ratio.groupby(trips['symbol'], sort=False).prod()
+
+
+# win rate, average profit and holding periods over all round trips
+def summary(trips):
+    return {'trades': len(trips),
+            'won_trades': int((trips['profit'] > 0).sum()),
+            'win_rate': (trips['profit'] > 0).mean() * 100 if len(trips) else 0,
+            'average_profit': trips['profit'].mean() if len(trips) else 0,
+            'average_holding_days': trips['holding_days'].mean() if len(trips) else 0,
+            'median_holding_days': trips['holding_days'].median() if len(trips) else 0}
+
+
+# the n most profitable round trips, ties keep their round trip order
+def top_trips(trips, n=20):
+    return trips.sort_values('profit', ascending=False, kind='stable').head(n)
+
+
+# the n symbols with the highest compounded profit ratio
+def top_symbols(profits, n=20):
+    return profits.sort_values(ascending=False, kind='stable').head(n)
+
+
+# the top n and bottom n symbols by compounded profit ratio, best first, all of them when
+# neither is given
+def ranked_symbols(profits, top=None, bottom=None):
+    ranked = list(profits.sort_values(ascending=False, kind='stable').index)
+    if top is None and bottom is None:
+        return ranked
+    chosen = ranked[:top or 0] + ranked[len(ranked) - (bottom or 0):]
+    # a symbol can be in both when there are fewer than top + bottom symbols
+    return list(dict.fromkeys(chosen))
+
+
+# write a ledger or round trip table as csv, or as parquet when the path ends in .parquet,
+# parquet needs pyarrow or fastparquet, which are not in the requirements
+def export(table, path):
+    if path.endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
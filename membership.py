@@ -0,0 +1,122 @@
+# point-in-time S&P 500 membership: every symbol's membership intervals from the current
+# constituents and the changes tables on wikipedia, including the removed constituents, kept as
+# arrays sorted by start date, so the constituents on a date or a whole date x symbol
+# membership mask come from interval searches instead of per symbol metadata lookups
+import os
+import numpy as np
+import pandas as pd
+from constants import *
+
+INTERVAL_COLUMNS = ['symbol', 'start', 'end']
+# open ends of the intervals, a missing start is before and a missing end after any date
+OPEN_START = np.iinfo(np.int64).min
+OPEN_END = np.iinfo(np.int64).max
+
+
+# membership intervals [start, end) of every symbol from the wikipedia tables, a symbol whose
+# first change is a removal was a member since before the changes table begins, a missing
+# start or end means the interval is open on that side
+def intervals_from_wikipedia(components, changes):
+    dates = pd.to_datetime(changes[('Date', 'Date')], errors='coerce')
+    events = pd.concat([
+        pd.DataFrame({'symbol': changes[('Added', 'Ticker')], 'date': dates, 'added': True}),
+        pd.DataFrame({'symbol': changes[('Removed', 'Ticker')], 'date': dates, 'added': False})])
+    events = events.dropna(subset=['symbol', 'date']).sort_values('date', kind='stable')
+    current_added = dict(zip(components['Symbol'],
+                             pd.to_datetime(components['Date added'], errors='coerce')))
+
+    intervals = []
+    for symbol, symbol_events in events.groupby('symbol', sort=False):
+        start, is_member = pd.NaT, None
+        for date, added in zip(symbol_events['date'], symbol_events['added']):
+            if added:
+                start, is_member = date, True
+            elif is_member is None:
+                intervals += [(symbol, pd.NaT, date)]
+                is_member = False
+            elif is_member:
+                intervals += [(symbol, start, date)]
+                is_member = False
+        if is_member:
+            intervals += [(symbol, start, pd.NaT)]
+        elif symbol in current_added:
+            # removed once and a constituent again, without an addition in the changes table
+            intervals += [(symbol, current_added[symbol], pd.NaT)]
+    # current constituents without any changes, since the table begins or since they were added
+    changed = set(events['symbol'])
+    intervals += [(symbol, added_date, pd.NaT) for symbol, added_date in current_added.items()
+                  if symbol not in changed]
+    return pd.DataFrame(intervals, columns=INTERVAL_COLUMNS).astype(
+        {'start': 'datetime64[ns]', 'end': 'datetime64[ns]'})
+
+
+# one open ended interval per symbol from the date it was added in the metadata, the
+# membership that was used before the removals were known
+def intervals_from_metadata(mdf):
+    return pd.DataFrame({'symbol': mdf.index,
+                         'start': mdf['date_added_sp'].to_numpy(dtype='datetime64[ns]'),
+                         'end': pd.NaT}, columns=INTERVAL_COLUMNS).astype(
+        {'start': 'datetime64[ns]', 'end': 'datetime64[ns]'})
+
+
+# the intervals written by data_collection.py, from the metadata when there are none yet
+def load_intervals(mdf, path=f"{DATA_DIR_NAME}/{MEMBERSHIP_FILE_NAME}"):
+    if not os.path.isfile(path):
+        return intervals_from_metadata(mdf)
+    return pd.read_csv(path).astype({'start': 'datetime64[ns]', 'end': 'datetime64[ns]'})
+
+
+# the date every symbol of mdf first became a constituent, the start of its first interval,
+# NaT when that interval is open because it was a member before the changes table begins,
+# symbols without intervals keep their date_added_sp
+def first_added_dates(mdf, intervals):
+    starts = intervals.groupby('symbol')['start']
+    first_added = starts.min()
+    first_added[starts.apply(lambda start: start.isna().any())] = pd.NaT
+    return mdf['date_added_sp'].where(~mdf.index.isin(first_added.index),
+                                      first_added.reindex(mdf.index))
+
+
+# the date every symbol of the intervals stopped being a constituent, NaT for the current
+# constituents
+def last_removed_dates(intervals):
+    ends = intervals.groupby('symbol')['end']
+    last_removed = ends.max()
+    last_removed[ends.apply(lambda end: end.isna().any())] = pd.NaT
+    return last_removed
+
+
+# intervals as nanosecond arrays sorted by start, open sides at the int64 limits so that the
+# searches need no special case for them
+def interval_table(intervals):
+    starts = intervals['start'].to_numpy(dtype='datetime64[ns]').view(np.int64).copy()
+    ends = intervals['end'].to_numpy(dtype='datetime64[ns]').view(np.int64).copy()
+    # NaT is the smallest int64, which already makes a missing start open
+    ends[ends == OPEN_START] = OPEN_END
+    order = np.argsort(starts, kind='stable')
+    return {'symbols': intervals['symbol'].to_numpy(dtype=object)[order],
+            'starts': starts[order], 'ends': ends[order]}
+
+
+# the symbols that are constituents on a date, sorted
+def constituents(table, date):
+    date = pd.Timestamp(date).value
+    # only intervals that started by the date can contain it
+    started = np.searchsorted(table['starts'], date, side='right')
+    is_member = table['ends'][:started] > date
+    return sorted(set(table['symbols'][:started][is_member]))
+
+
+# date x symbol boolean mask of index membership, the intervals of every symbol are turned
+# into +1 at their first date and -1 after their last date and summed up over the dates,
+# symbols without intervals are never members
+def membership_mask(table, index, all_symbols):
+    columns = pd.Index(all_symbols).get_indexer(table['symbols'])
+    known = columns >= 0
+    dates = index.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    first = np.searchsorted(dates, table['starts'][known], side='left')
+    last = np.searchsorted(dates, table['ends'][known], side='left')
+    changes = np.zeros((len(dates) + 1, len(all_symbols)), dtype=np.int32)
+    np.add.at(changes, (first, columns[known]), 1)
+    np.add.at(changes, (last, columns[known]), -1)
+    return np.cumsum(changes[:-1], axis=0) > 0
@@ -0,0 +1,108 @@
+# fetches ticker metadata concurrently, with a bound on the number of requests in flight,
+# a request rate limit, retries with backoff and an on-disk checkpoint to resume from
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from data_providers import IncompleteMetadata
+
+METADATA_COLUMNS = ['name_yf', 'currency', 'exchange', 'quote_type', 'timezone']
+
+
+# token bucket that lets through at most `rate` requests a second on average,
+# with bursts of up to `capacity` requests
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # block until `tokens` tokens are available and take them
+    def acquire(self, tokens=1):
+        if tokens > self.capacity:
+            raise ValueError(f"Cannot take {tokens} tokens from a bucket of {self.capacity}")
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# call the provider for one symbol, retrying with exponential backoff on errors, every
+# attempt takes a token for each request the provider makes, metadata that stays incomplete
+# after the last attempt falls back to what the provider could fetch
+def fetch_with_retry(provider, symbol, bucket, retries, backoff):
+    for attempt in range(retries + 1):
+        bucket.acquire(getattr(provider, 'metadata_requests', 1))
+        try:
+            return provider.get_metadata(symbol)
+        except IncompleteMetadata as e:
+            if attempt == retries:
+                print(f"incomplete metadata for {symbol}: {e}")
+                return e.metadata
+        except Exception as e:
+            if attempt == retries:
+                print(f"giving up on metadata for {symbol}: {e}")
+                return None
+        time.sleep(backoff * 2 ** attempt)
+
+
+# read the metadata that has already been fetched from the checkpoint
+def read_checkpoint(checkpoint_path):
+    done = {}
+    if os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                # a crash can leave the last line half written
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                done[record['symbol']] = record['metadata']
+    return done
+
+
+# fetch metadata for all symbols, symbols already in the checkpoint are not requested again,
+# symbols that keep failing are left out of the result
+def fetch_metadata(provider, symbols, checkpoint_path, max_workers=8, rate=5.0,
+                   retries=3, backoff=1.0):
+    done = read_checkpoint(checkpoint_path)
+    missing = [symbol for symbol in symbols if symbol not in done]
+    print(f"metadata checkpoint has {len(symbols) - len(missing)}/{len(symbols)} symbols, "
+          f"fetching {len(missing)}")
+
+    bucket = TokenBucket(rate, capacity=max(max_workers,
+                                            getattr(provider, 'metadata_requests', 1)))
+    start_time = time.monotonic()
+    fetched = 0
+    with open(checkpoint_path, 'a') as checkpoint, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_with_retry, provider, symbol, bucket, retries,
+                                   backoff): symbol
+                   for symbol in missing}
+        for future in as_completed(futures):
+            symbol, metadata = futures[future], future.result()
+            if metadata is None:
+                continue
+            done[symbol] = metadata
+            fetched += 1
+            checkpoint.write(json.dumps({'symbol': symbol, 'metadata': metadata}) + '\n')
+            checkpoint.flush()
+            print(f"Downloaded metadata for {symbol} {fetched}/{len(missing)}")
+
+    duration = time.monotonic() - start_time
+    throughput = fetched / duration if duration > 0 else 0
+    print(f"fetched metadata for {fetched} symbols in {duration:.1f}s "
+          f"({throughput:.2f} symbols/s)")
+    return pd.DataFrame.from_dict({symbol: done[symbol] for symbol in symbols if symbol in done},
+                                  orient='index', columns=METADATA_COLUMNS)
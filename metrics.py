@@ -0,0 +1,163 @@
+# portfolio metrics of many equity curves at once, every row of a curves array is one curve
+# (a portfolio, a parameter set of a population, a sweep job) over the same dates, the
+# metrics follow the single series versions in helpers, the rolling variants return one
+# value per date with nan until the first window is complete
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+PERIODS_PER_YEAR = 252
+
+
+# bars per year of the dates of a series of bars: PERIODS_PER_YEAR trading days times the
+# median number of bars a trading day has, daily bars give PERIODS_PER_YEAR
+def periods_per_year(dates):
+    days = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[D]')
+    if not len(days):
+        return PERIODS_PER_YEAR
+    _, bars_per_day = np.unique(days, return_counts=True)
+    return PERIODS_PER_YEAR * int(round(np.median(bars_per_day)))
+
+
+# curves as a 2-D float array, a single curve becomes one row
+def as_curves(curves):
+    curves = np.asarray(curves, dtype=np.float64)
+    return curves[None, :] if curves.ndim == 1 else curves
+
+
+# simple returns of every curve, one column less than the curves
+def returns(curves):
+    curves = as_curves(curves)
+    return curves[:, 1:] / curves[:, :-1] - 1
+
+
+# annualized sharpe ratios of the returns along the last axis, 0 without volatility
+def sharpe_from_returns(curve_returns, periods_per_year=PERIODS_PER_YEAR):
+    mean_return = curve_returns.mean(axis=-1)
+    std_return = curve_returns.std(axis=-1, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe_ratios = mean_return / std_return * (periods_per_year ** 0.5)
+    return np.where(std_return > 0, sharpe_ratios, 0)
+
+
+# annualized sortino ratios of the returns along the last axis, the downside deviation is
+# the sample std of the negative returns only, 0 with fewer than two of them
+def sortino_from_returns(curve_returns, periods_per_year=PERIODS_PER_YEAR):
+    is_down = curve_returns < 0
+    down_count = is_down.sum(axis=-1)
+    down_sum = np.where(is_down, curve_returns, 0).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        down_mean = down_sum / down_count
+        deviation = np.where(is_down, curve_returns - down_mean[..., None], 0)
+        std_downside = np.sqrt((deviation ** 2).sum(axis=-1) / (down_count - 1))
+        sortino_ratios = curve_returns.mean(axis=-1) / std_downside * (periods_per_year ** 0.5)
+    return np.where((down_count > 1) & (std_downside > 0), sortino_ratios, 0)
+
+
+# least squares alpha and beta of the returns along the last axis against the benchmark's,
+# as scipy.stats.linregress computes them
+def alpha_beta_from_returns(curve_returns, benchmark_returns):
+    benchmark_deviation = benchmark_returns - benchmark_returns.mean(axis=-1, keepdims=True)
+    curve_mean = curve_returns.mean(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = (benchmark_deviation * (curve_returns - curve_mean[..., None])).sum(axis=-1) / \
+            (benchmark_deviation ** 2).sum(axis=-1)
+    alpha = curve_mean - beta * benchmark_returns.mean(axis=-1)
+    return alpha, beta
+
+
+# drawdown of every curve from its running maximum, as helpers.drawdown
+def drawdowns(curves):
+    curves = as_curves(curves)
+    running_max = np.maximum.accumulate(curves, axis=-1)
+    return (running_max - curves) / running_max
+
+
+# longest stretch of every curve below its previous peak, in periods
+def max_drawdown_durations(curves):
+    curves = as_curves(curves)
+    running_max = np.maximum.accumulate(curves, axis=-1)
+    periods = np.arange(curves.shape[-1])
+    # the last period each curve was at its peak, the drawdown has lasted since then
+    last_peak = np.maximum.accumulate(np.where(curves >= running_max, periods, 0), axis=-1)
+    return (periods - last_peak).max(axis=-1)
+
+
+# compound annual growth rate of every curve from its first to its last value
+def cagrs(curves, periods_per_year=PERIODS_PER_YEAR):
+    curves = as_curves(curves)
+    years = (curves.shape[-1] - 1) / periods_per_year
+    return (curves[:, -1] / curves[:, 0]) ** (1 / years) - 1
+
+
+# annualized sharpe ratio of every curve
+def sharpe_ratios(curves, periods_per_year=PERIODS_PER_YEAR):
+    return sharpe_from_returns(returns(curves), periods_per_year)
+
+
+# annualized sortino ratio of every curve
+def sortino_ratios(curves, periods_per_year=PERIODS_PER_YEAR):
+    return sortino_from_returns(returns(curves), periods_per_year)
+
+
+# alpha and beta of every curve against one benchmark curve over the same dates
+def alpha_beta(curves, benchmark):
+    return alpha_beta_from_returns(returns(curves), returns(benchmark)[0])
+
+
+# all metrics of every curve in one pass over their returns, alpha and beta only when a
+# benchmark curve is given, max drawdown as a fraction and its duration in periods
+def evaluate(curves, benchmark=None, periods_per_year=PERIODS_PER_YEAR):
+    curves = as_curves(curves)
+    curve_returns = returns(curves)
+    results = {'sharpe_ratio': sharpe_from_returns(curve_returns, periods_per_year),
+               'sortino_ratio': sortino_from_returns(curve_returns, periods_per_year),
+               'max_drawdown': drawdowns(curves).max(axis=-1),
+               'max_drawdown_duration': max_drawdown_durations(curves),
+               'cagr': cagrs(curves, periods_per_year)}
+    if benchmark is not None:
+        results['alpha'], results['beta'] = alpha_beta_from_returns(curve_returns,
+                                                                    returns(benchmark)[0])
+    return results
+
+
+# windows of the last `window` returns of every curve ending at each date, the first
+# date has no return and the dates before the first full window get no window
+def return_windows(curves, window):
+    return sliding_window_view(returns(curves), window, axis=-1)
+
+
+# put rolling values back on the dates of the curves, nan where there was no full window
+def align(values, n_dates):
+    aligned = np.full(values.shape[:-1] + (n_dates,), np.nan)
+    aligned[..., n_dates - values.shape[-1]:] = values
+    return aligned
+
+
+# annualized sharpe ratio of every curve over the last `window` returns at each date
+def rolling_sharpe_ratios(curves, window, periods_per_year=PERIODS_PER_YEAR):
+    curves = as_curves(curves)
+    return align(sharpe_from_returns(return_windows(curves, window), periods_per_year),
+                 curves.shape[-1])
+
+
+# annualized sortino ratio of every curve over the last `window` returns at each date
+def rolling_sortino_ratios(curves, window, periods_per_year=PERIODS_PER_YEAR):
+    curves = as_curves(curves)
+    return align(sortino_from_returns(return_windows(curves, window), periods_per_year),
+                 curves.shape[-1])
+
+
+# alpha and beta of every curve against the benchmark over the last `window` returns
+def rolling_alpha_beta(curves, benchmark, window):
+    curves = as_curves(curves)
+    alpha, beta = alpha_beta_from_returns(return_windows(curves, window),
+                                          return_windows(benchmark, window)[0])
+    return align(alpha, curves.shape[-1]), align(beta, curves.shape[-1])
+
+
+# largest drawdown of every curve within the last `window` values at each date
+def rolling_max_drawdowns(curves, window):
+    curves = as_curves(curves)
+    windows = sliding_window_view(curves, window, axis=-1)
+    running_max = np.maximum.accumulate(windows, axis=-1)
+    return align(((running_max - windows) / running_max).max(axis=-1), curves.shape[-1])
@@ -1,13 +1,36 @@
-# plots graphs
+# plots graphs, run it to render the charts of a saved backtest run again
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
 import matplotlib as mpl
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import pandas as pd
+import ledger
+import results_store
+from constants import *
 
-mpl.use('TkAgg')
+# windows need a display, without one (e.g. on a server) charts are only rendered to files,
+# a backend set with MPLBACKEND (e.g. Agg by cli.py --headless) is kept
+if 'MPLBACKEND' not in os.environ:
+    mpl.use('TkAgg' if sys.platform in ('win32', 'darwin') or os.environ.get('DISPLAY')
+            else 'Agg')
+HAS_DISPLAY = mpl.get_backend().lower() != 'agg'
+import matplotlib.pyplot as plt
 mpl.rcParams['font.family'] = 'Times New Roman'
 mpl.rcParams['font.size'] = 14
 
-PNG_OUT_DIR_NAME = 'png_plots'
 CSV_IN_DIR_NAME = 'csv_plots'
+PNG_DPI = 300
+# content hashes of the rendered symbol charts, charts whose inputs did not change are skipped
+RENDER_MANIFEST_FILE_NAME = 'render_hashes.json'
+# part of every chart's hash, bump it when the charts are drawn differently
+CHART_VERSION = 1
+
+# reusable figures of the symbol charts of this process, by strategy
+templates = {}
 
 
 def plot_portfolio(portfolio):
@@ -31,20 +54,36 @@ def plot_portfolio(portfolio):
     axs[1].set_ylabel('Drawdown (%)')
     axs[1].set_xlabel('')
     axs[0].set_title('Total portfolio value compared to the S&P 500')
-    plt.savefig(f'portfolio.png', dpi=300)
-    plt.show()
+    plt.savefig(f'portfolio.png', dpi=PNG_DPI)
+    if HAS_DISPLAY:
+        plt.show()
     plt.close()
 
 
-def plot_df(df, symbol, name, strategy, params, save_png=False, show_plot=False):
+# figure size and subplot height ratios of a strategy's symbol chart
+def chart_layout(strategy):
     if strategy == 'sma':
-        fig, axs = plt.subplots(2, 1, figsize=(10, 8), sharex='all',
-                                gridspec_kw={'height_ratios': [3, 1]}, dpi=150)
-    else:
-        fig, axs = plt.subplots(3, 1, figsize=(10, 10), sharex='all',
-                                gridspec_kw={'height_ratios': [3, 1, 1]}, dpi=150)
+        return (10, 8), [3, 1]
+    return (10, 10), [3, 1, 1]
+
+
+def plot_df(df, symbol, name, strategy, params, save_png=False, show_plot=False):
+    figsize, height_ratios = chart_layout(strategy)
+    fig, axs = plt.subplots(len(height_ratios), 1, figsize=figsize, sharex='all',
+                            gridspec_kw={'height_ratios': height_ratios}, dpi=150)
     # make the plots a little tighter
     plt.subplots_adjust(hspace=0.1)
+    draw_df(axs, df, name, strategy, params)
+
+    if save_png:
+        plt.savefig(f'{PNG_OUT_DIR_NAME}/{symbol}.png', dpi=PNG_DPI)
+    if show_plot:
+        plt.show()
+    plt.close()
+
+
+# draw a symbol's chart onto the subplots of its strategy's layout
+def draw_df(axs, df, name, strategy, params):
     # remove minor ticks that appear due to sharex
     for ax in axs:
         ax.tick_params(axis='x', which='minor', bottom=False)
@@ -87,12 +126,13 @@ def plot_df(df, symbol, name, strategy, params, save_png=False, show_plot=False)
         axs[2].legend()
         axs[2].set_ylabel('MACD')
 
-    # plot buys and sells as scatter plot points
-    buy_dates = df.loc[df['position_size'] > 0].index
+    # plot buys and sells as scatter plot points, as datetimes since the time series converter
+    # of pandas fails on a single numpy datetime
+    buy_dates = df.loc[df['position_size'] > 0].index.to_pydatetime()
     buy_prices = df.loc[df['position_size'] > 0, 'Adj Close']
     axs[0].scatter(buy_dates, buy_prices, marker='^', s=100, c='#3CAEA3',
                    zorder=4, edgecolor='black', label='Buy', lw=0.6)
-    sell_dates = df.loc[df['position_size'] < 0].index
+    sell_dates = df.loc[df['position_size'] < 0].index.to_pydatetime()
     sell_prices = df.loc[df['position_size'] < 0, 'Adj Close']
     axs[0].scatter(sell_dates, sell_prices, marker='v', s=100, c='#F37021',
                    zorder=4, edgecolor='black', label='Sell', lw=0.6)
@@ -106,8 +146,106 @@ def plot_df(df, symbol, name, strategy, params, save_png=False, show_plot=False)
     axs[0].set_title(f'{name}')
     axs[0].legend()
 
-    if save_png:
-        plt.savefig(f'{PNG_OUT_DIR_NAME}/{symbol}.png', dpi=300)
-    if show_plot:
-        plt.show()
-    plt.close()
+
+# the figure of a strategy's symbol chart, built once per process and cleared for every
+# chart, its subplots are made again each time, so no state pandas attached to the axes
+# of the previous chart is kept, the figure is not managed by pyplot so it renders with Agg
+# on any backend
+def figure_template(strategy):
+    figsize, height_ratios = chart_layout(strategy)
+    if strategy not in templates:
+        templates[strategy] = Figure(figsize=figsize, dpi=150)
+    fig = templates[strategy]
+    fig.clear()
+    # pandas moves the bottom up for rotated dates of irregular series, start from the defaults
+    fig.subplots_adjust(**{name: mpl.rcParams[f'figure.subplot.{name}']
+                           for name in ('left', 'right', 'bottom', 'top', 'wspace')}, hspace=0.1)
+    axs = fig.subplots(len(height_ratios), 1, sharex='all',
+                       gridspec_kw={'height_ratios': height_ratios})
+    return fig, axs
+
+
+# render one symbol chart to a png on the template of its strategy
+def render_chart(df, symbol, name, strategy, params, out_dir=PNG_OUT_DIR_NAME):
+    fig, axs = figure_template(strategy)
+    draw_df(axs, df, name, strategy, params)
+    fig.savefig(f'{out_dir}/{symbol}.png', dpi=PNG_DPI)
+    return symbol
+
+
+# hash of everything a symbol chart is drawn from
+def chart_hash(df, name, strategy, params):
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    digest.update(json.dumps([list(df.columns), name, strategy, params, CHART_VERSION],
+                             sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+# render the charts of symbols with several processes, charts whose png exists and whose
+# inputs hash the same as when it was rendered are skipped, returns the rendered symbols
+def render_charts(frames, symbols, names, strategy, params, workers=None,
+                  out_dir=PNG_OUT_DIR_NAME):
+    manifest_path = f'{out_dir}/{RENDER_MANIFEST_FILE_NAME}'
+    hashes = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            hashes = json.load(f)
+    jobs = []
+    for symbol in symbols:
+        content_hash = chart_hash(frames[symbol], names[symbol], strategy, params)
+        if hashes.get(symbol) != content_hash or \
+                not os.path.isfile(f'{out_dir}/{symbol}.png'):
+            jobs += [(frames[symbol], symbol, names[symbol], strategy, params, out_dir)]
+            hashes[symbol] = content_hash
+    workers = min(workers or os.cpu_count(), len(jobs))
+    if workers > 1:
+        with mp.Pool(workers) as pool:
+            rendered = pool.starmap(render_chart, jobs, chunksize=1)
+    else:
+        rendered = [render_chart(*job) for job in jobs]
+    # write under a temporary name first, a crash never leaves a half written manifest
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(hashes, f)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    print(f"rendered {len(rendered)} charts, {len(symbols) - len(rendered)} unchanged")
+    return rendered
+
+
+# render the charts of a saved run, the latest one unless a run id is given
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="render the charts of a saved backtest run",
+                                     parents=list(parents))
+    parser.add_argument('--run-id', default=None,
+                        help="run in the results directory, the latest one by default")
+    parser.add_argument('--top', type=int, default=None,
+                        help="only chart the N traded symbols with the highest profit")
+    parser.add_argument('--bottom', type=int, default=None,
+                        help="only chart the N traded symbols with the lowest profit")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes that render the charts, one per cpu by default")
+    parser.add_argument('--portfolio', action='store_true',
+                        help="also plot the portfolio against the S&P 500")
+    args = parser.parse_args(argv)
+
+    runs = results_store.list_runs()
+    if not runs:
+        raise ValueError("Run a backtest first")
+    run_id = args.run_id or max(runs, key=lambda run: os.path.getmtime(
+        results_store.bundle_path(RESULTS_DIR_NAME, run)))
+    with results_store.ResultsReader(RESULTS_DIR_NAME, run_id) as reader:
+        symbol_profits = ledger.symbol_profits(reader.load_round_trips())
+        symbols = ledger.ranked_symbols(symbol_profits, args.top, args.bottom)
+        frames = {symbol: reader.load_symbol(symbol) for symbol in symbols}
+        strategy, params = reader.meta['strategy'], reader.meta['params']
+        portfolio = reader.load_portfolio() if args.portfolio else None
+    print(f"charting run {run_id}")
+    if portfolio is not None:
+        plot_portfolio(portfolio)
+    if not os.path.isdir(PNG_OUT_DIR_NAME):
+        os.mkdir(PNG_OUT_DIR_NAME)
+    names = pd.read_csv(f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}", index_col=0)['name_yf']
+    render_charts(frames, symbols, names, strategy, params, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# columnar on-disk price store, one memory-mapped .npy array per field over a shared
+# date axis and symbol axis, so the price data can be opened without parsing the csv
+import json
+import os
+import shutil
+import pandas as pd
+import numpy as np
+from constants import *
+
+MANIFEST_FILE_NAME = 'manifest.json'
+DATES_FILE_NAME = 'dates.npy'
+
+
+# file name of the array that holds a field, e.g. 'Adj Close' -> 'adj_close.npy'
+def field_file_name(field):
+    return field.lower().replace(' ', '_') + '.npy'
+
+
+# write a dataframe with (symbol, field) columns, as returned by yf.download with
+# group_by='ticker', into a store directory
+def write_store(df, store_dir):
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    symbols = list(dict.fromkeys(t[0] for t in df.columns))
+    fields = list(dict.fromkeys(t[1] for t in df.columns))
+    df = df.sort_index()
+    manifest = {'symbols': symbols, 'fields': {}, 'dates': DATES_FILE_NAME}
+    np.save(f"{store_dir}/{DATES_FILE_NAME}", df.index.to_numpy(dtype='datetime64[ns]'))
+    for field in fields:
+        # date x symbol array, symbols without the field stay missing
+        columns = pd.MultiIndex.from_product([symbols, [field]])
+        values = df.reindex(columns=columns).to_numpy(dtype=np.float64)
+        np.save(f"{store_dir}/{field_file_name(field)}", np.ascontiguousarray(values))
+        manifest['fields'][field] = field_file_name(field)
+    # the manifest is written last, so a store without one is never half written
+    with open(f"{store_dir}/{MANIFEST_FILE_NAME}", 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+# check whether a complete store exists in a directory
+def store_exists(store_dir):
+    return os.path.isfile(f"{store_dir}/{MANIFEST_FILE_NAME}")
+
+
+# open a store without reading the arrays into memory
+def open_store(store_dir):
+    with open(f"{store_dir}/{MANIFEST_FILE_NAME}") as f:
+        manifest = json.load(f)
+    dates = pd.DatetimeIndex(np.load(f"{store_dir}/{manifest['dates']}"), name='Date')
+    fields = {field: np.load(f"{store_dir}/{file_name}", mmap_mode='r')
+              for field, file_name in manifest['fields'].items()}
+    return {'dates': dates, 'symbols': manifest['symbols'], 'fields': fields}
+
+
+# restrict a store to the dates between start and end (both inclusive),
+# the arrays of the returned store are views into the memory map, nothing is copied
+def slice_store(store, start=None, end=None):
+    dates = store['dates']
+    first = 0 if start is None else dates.searchsorted(start, side='left')
+    last = len(dates) if end is None else dates.searchsorted(end, side='right')
+    return {'dates': dates[first:last],
+            'symbols': store['symbols'],
+            'fields': {field: values[first:last] for field, values in store['fields'].items()}}
+
+
+# build the (symbol, field) column dataframe that the csv would have been parsed into
+def store_to_frame(store):
+    fields = list(store['fields'])
+    values = np.stack([store['fields'][field] for field in fields], axis=2)
+    columns = pd.MultiIndex.from_product([store['symbols'], fields])
+    return pd.DataFrame(values.reshape(len(store['dates']), -1),
+                        index=store['dates'], columns=columns)
+
+
+# merge new bars and new symbols into a store, new values win over stored ones
+def update_store(store_dir, new_df):
+    # the stored arrays are read into memory so the files can be replaced
+    df = store_to_frame(open_store(store_dir))
+    df = new_df.combine_first(df)
+    # write next to the old store and swap, readers never see a half written store
+    tmp_dir, old_dir = f"{store_dir}.tmp", f"{store_dir}.old"
+    for dir_name in [tmp_dir, old_dir]:
+        if os.path.isdir(dir_name):
+            shutil.rmtree(dir_name)
+    write_store(df, tmp_dir)
+    os.rename(store_dir, old_dir)
+    os.rename(tmp_dir, store_dir)
+    shutil.rmtree(old_dir)
+
+
+# index of the last date that has an Adj Close for every symbol, -1 for symbols without any
+def last_stored_rows(store):
+    has_price = ~np.isnan(store['fields']['Adj Close'])
+    last_rows = len(store['dates']) - 1 - np.argmax(has_price[::-1], axis=0)
+    return np.where(has_price.any(axis=0), last_rows, -1)
+
+
+# convert the multi-index stock price csv into a store
+def csv_to_store(csv_path, store_dir):
+    df = pd.read_csv(csv_path, parse_dates=True, index_col=[0], header=[0, 1])
+    write_store(df, store_dir)
+
+
+if __name__ == "__main__":
+    store_dir = f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}"
+    print(f"converting {DATA_DIR_NAME}/{DATA_FILE_NAME} into {store_dir}")
+    csv_to_store(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}", store_dir)
+    store = open_store(store_dir)
+    print(f"stored {len(store['dates'])} dates x {len(store['symbols'])} symbols, "
+          f"fields: {', '.join(store['fields'])}")
@@ -0,0 +1,105 @@
+# persistent table of optimizer results keyed by strategy, rounded parameters, stoploss and a
+# fingerprint of the backtest data, so parameter sets that were already scored on the same
+# data are looked up instead of backtested again, also across runs of the optimizers
+import hashlib
+import json
+import sqlite3
+import time
+import numpy as np
+from constants import *
+
+# number of parameter sets per sqlite query, below the limit on query variables
+QUERY_CHUNK_SIZE = 500
+
+
+# hash of everything a backtest result depends on besides the strategy, parameters and stoploss
+def data_fingerprint(dfs, all_symbols, mdf, index):
+    digest = hashlib.sha1()
+    digest.update(repr((TRADE_START_DATE, TRADE_END_DATE, UNIVERSE_SIZE, STARTING_CAPITAL,
+                        POSITION_SIZE_QUOTE, FEE_FACTOR)).encode())
+    digest.update(index.to_numpy(dtype='datetime64[ns]').tobytes())
+    for symbol in all_symbols:
+        df = dfs[symbol]
+        digest.update(symbol.encode())
+        digest.update(df.index.to_numpy(dtype='datetime64[ns]').tobytes())
+        digest.update(df['Adj Close'].to_numpy(dtype=np.float64).tobytes())
+        digest.update(df['in_universe'].to_numpy(dtype=bool).tobytes())
+    digest.update(mdf.loc[all_symbols, 'date_added_sp'].to_numpy(dtype='datetime64[ns]').tobytes())
+    return digest.hexdigest()
+
+
+# optimizer results stored in a sqlite database, for one data fingerprint
+class ResultCache:
+    def __init__(self, path, fingerprint):
+        self.fingerprint = fingerprint
+        # several processes can write to the same database, wait for their locks
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                                "strategy TEXT, params TEXT, stoploss REAL, fingerprint TEXT, "
+                                "fitness REAL, "
+                                "PRIMARY KEY (strategy, params, stoploss, fingerprint))")
+        self.connection.commit()
+
+    # stored fitness of the given parameter sets, parameter sets without a result are left out
+    def get_many(self, strategy, stoploss, param_sets):
+        found = {}
+        keys = {json.dumps(list(params)): params for params in param_sets}
+        key_list = list(keys)
+        for start in range(0, len(key_list), QUERY_CHUNK_SIZE):
+            chunk = key_list[start:start + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                f"SELECT params, fitness FROM results WHERE strategy = ? AND stoploss = ? "
+                f"AND fingerprint = ? AND params IN ({', '.join('?' * len(chunk))})",
+                (strategy, stoploss, self.fingerprint, *chunk))
+            for params, fitness in rows:
+                found[keys[params]] = fitness
+        return found
+
+    # store the fitness of the given parameter sets
+    def put_many(self, strategy, stoploss, param_sets, fitnesses):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            [(strategy, json.dumps(list(params)), stoploss, self.fingerprint, float(fitness))
+             for params, fitness in zip(param_sets, fitnesses)])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+# scores parameter sets through the result cache, only the sets it has no result for are
+# passed on to be evaluated, and counts the evaluations to report their throughput
+class CachedEvaluator:
+    def __init__(self, cache, strategy, stoploss):
+        self.cache = cache
+        self.strategy = strategy
+        self.stoploss = stoploss
+        self.backtested = 0
+        self.cached = 0
+        self.start_time = time.monotonic()
+
+    # fitness of every parameter set, evaluate_missing gets the distinct rounded parameter
+    # sets that are not in the cache and returns their fitness in the same order
+    def evaluate(self, param_sets, evaluate_missing):
+        keys = [tuple(int(round(param)) for param in params) for params in param_sets]
+        found = self.cache.get_many(self.strategy, self.stoploss, set(keys))
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            fitnesses = list(evaluate_missing(missing))
+            self.cache.put_many(self.strategy, self.stoploss, missing, fitnesses)
+            found.update(zip(missing, fitnesses))
+        self.backtested += len(missing)
+        self.cached += len(keys) - len(missing)
+        return [found[key] for key in keys]
+
+    # a drop in replacement for the map function of a worker pool that goes through the cache
+    def map(self, map_function):
+        return lambda function, param_sets: self.evaluate(
+            list(param_sets), lambda missing: map_function(function, missing))
+
+    def print_throughput(self):
+        duration = time.monotonic() - self.start_time
+        evaluations = self.backtested + self.cached
+        throughput = evaluations / duration if duration > 0 else 0
+        print(f"{evaluations} evaluations in {duration:.1f}s ({throughput:.1f} evaluations/s), "
+              f"{self.cached} from the result cache, {self.backtested} backtested")
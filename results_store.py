@@ -0,0 +1,184 @@
+# consolidated results of backtest runs: one compressed bundle per run holds the indicator
+# frame of every traded symbol, the portfolio, the trades and the round trips as one .npy
+# array per column, so a single symbol or a few columns can be read back without the rest
+import datetime as dt
+import json
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from constants import *
+
+BUNDLE_EXTENSION = '.npz'
+META_MEMBER_NAME = 'meta.json'
+TABLE_MEMBER_NAME = 'columns.json'
+INDEX_MEMBER_NAME = 'index.npy'
+SYMBOLS_PREFIX = 'symbols/'
+
+
+# path of the bundle of a run
+def bundle_path(results_dir, run_id):
+    return f"{results_dir}/{run_id}{BUNDLE_EXTENSION}"
+
+
+# run id of a backtest, the strategy and the time it started
+def new_run_id(strategy):
+    return f"{strategy}_{dt.datetime.now():%Y%m%d_%H%M%S}"
+
+
+# ids of the runs that have a complete bundle in a directory, oldest first by name
+def list_runs(results_dir=RESULTS_DIR_NAME):
+    if not os.path.isdir(results_dir):
+        return []
+    return sorted(name[:-len(BUNDLE_EXTENSION)] for name in os.listdir(results_dir)
+                  if name.endswith(BUNDLE_EXTENSION))
+
+
+# a column as an array .npy can hold without pickling, object columns of numbers (like the
+# portfolio the pandas engine fills row by row) are stored as numbers, the rest as unicode
+def column_array(values):
+    array = np.asarray(values)
+    if array.dtype == object:
+        array = pd.Series(array).infer_objects().to_numpy()
+    if array.dtype == object:
+        array = array.astype(str)
+    return np.ascontiguousarray(array)
+
+
+# writes the tables of one run into its bundle as they become available, the bundle is
+# written under a temporary name and only appears under its own name once it is closed,
+# so a crashed run never leaves a half written bundle
+class ResultsWriter:
+    def __init__(self, results_dir, run_id, meta=None):
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+        self.path = bundle_path(results_dir, run_id)
+        if os.path.exists(self.path):
+            raise ValueError(f"Run {run_id} already exists in {results_dir}")
+        self.tmp_path = f"{self.path}.tmp"
+        self.archive = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED)
+        self.write_json(META_MEMBER_NAME, {'run_id': run_id, **(meta or {})})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.archive.close()
+            os.remove(self.tmp_path)
+
+    def write_json(self, name, value):
+        self.archive.writestr(name, json.dumps(value, default=str))
+
+    def write_array(self, name, array):
+        with self.archive.open(name, 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    # a dataframe as one array per column, with its index unless index is False
+    def write_frame(self, table, df, index=True):
+        self.write_json(f"{table}/{TABLE_MEMBER_NAME}",
+                        {'columns': list(df.columns), 'index': index,
+                         'index_name': df.index.name if index else None})
+        if index:
+            self.write_array(f"{table}/{INDEX_MEMBER_NAME}", column_array(df.index))
+        for i, column in enumerate(df.columns):
+            self.write_array(f"{table}/{i}.npy", column_array(df[column]))
+
+    # the indicator, signal and position frame of a symbol
+    def write_symbol(self, symbol, df):
+        self.write_frame(f"{SYMBOLS_PREFIX}{symbol}", df)
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.tmp_path, self.path)
+
+
+# reads tables of a run's bundle, only the arrays of the requested columns are decompressed
+class ResultsReader:
+    def __init__(self, results_dir, run_id):
+        self.archive = zipfile.ZipFile(bundle_path(results_dir, run_id))
+        self.meta = self.read_json(META_MEMBER_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_json(self, name):
+        with self.archive.open(name) as f:
+            return json.load(f)
+
+    def read_array(self, name):
+        with self.archive.open(name) as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+    # names of the tables in the bundle, e.g. 'portfolio', 'trades' or 'symbols/AAPL'
+    def tables(self):
+        suffix = f"/{TABLE_MEMBER_NAME}"
+        return [name[:-len(suffix)] for name in self.archive.namelist() if name.endswith(suffix)]
+
+    # the symbols that have a frame in the bundle, in the order they were written
+    def symbols(self):
+        return [table[len(SYMBOLS_PREFIX):] for table in self.tables()
+                if table.startswith(SYMBOLS_PREFIX)]
+
+    # a table with all or some of its columns, the rows of a date indexed table can be
+    # restricted to the dates between start and end (both inclusive)
+    def load_frame(self, table, columns=None, start=None, end=None):
+        layout = self.read_json(f"{table}/{TABLE_MEMBER_NAME}")
+        stored_columns = layout['columns']
+        columns = stored_columns if columns is None else list(columns)
+        missing = [column for column in columns if column not in stored_columns]
+        if missing:
+            raise KeyError(f"{table} has no columns {missing}")
+        rows = slice(None)
+        index = None
+        if layout['index']:
+            index = pd.Index(self.read_array(f"{table}/{INDEX_MEMBER_NAME}"),
+                             name=layout['index_name'])
+            if start is not None or end is not None:
+                first = 0 if start is None else index.searchsorted(start, side='left')
+                last = len(index) if end is None else index.searchsorted(end, side='right')
+                rows = slice(first, last)
+                index = index[rows]
+        elif start is not None or end is not None:
+            raise ValueError(f"{table} has no index to select dates from")
+        data = {column: self.read_array(f"{table}/{stored_columns.index(column)}.npy")[rows]
+                for column in columns}
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def load_symbol(self, symbol, columns=None, start=None, end=None):
+        return self.load_frame(f"{SYMBOLS_PREFIX}{symbol}", columns, start, end)
+
+    def load_portfolio(self, columns=None, start=None, end=None):
+        return self.load_frame('portfolio', columns, start, end)
+
+    def load_trades(self):
+        return self.load_frame('trades')
+
+    def load_round_trips(self):
+        return self.load_frame('round_trips')
+
+    def close(self):
+        self.archive.close()
+
+
+# write everything a backtest run produced into its bundle in one go
+def write_run(results_dir, run_id, meta, frames, symbols, portfolio, trade_table, trips):
+    with ResultsWriter(results_dir, run_id, meta) as writer:
+        for symbol in symbols:
+            writer.write_symbol(symbol, frames[symbol])
+        writer.write_frame('portfolio', portfolio)
+        writer.write_frame('trades', trade_table, index=False)
+        writer.write_frame('round_trips', trips, index=False)
+    return bundle_path(results_dir, run_id)
+
+
+if __name__ == "__main__":
+    for run_id in list_runs():
+        with ResultsReader(RESULTS_DIR_NAME, run_id) as reader:
+            print(f"{run_id}: {len(reader.symbols())} symbols, "
+                  f"{json.dumps({k: v for k, v in reader.meta.items() if k != 'run_id'})}")
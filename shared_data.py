@@ -0,0 +1,82 @@
+# publishes the backtest inputs once into shared memory, so optimizer workers can attach
+# to them by name under both the fork and the spawn start method, instead of receiving
+# pickled copies of the dataframes with every batch of evaluations
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+# inputs of the process this module was attached in, filled by attach
+attached = None
+# shared memory blocks that back the attached inputs, they have to stay open
+attached_blocks = []
+
+
+# copy an array into a new shared memory block, returns the block and its description
+def share_array(values):
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    shared = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    shared[...] = values
+    return block, (block.name, values.shape, values.dtype.str)
+
+
+# publish the per symbol Adj Close and in_universe columns, back to back in symbol order,
+# together with the trading dates and S&P inclusion dates, the prices keep their dtype so
+# compact float32 prices take half the shared memory, returns the manifest workers
+# attach with and the blocks the publisher has to release once the workers are done
+def publish(dfs, all_symbols, mdf, index):
+    lengths = [len(dfs[symbol].index) for symbol in all_symbols]
+    arrays = {
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'dates': np.concatenate([dfs[symbol].index.to_numpy(dtype='datetime64[ns]')
+                                 for symbol in all_symbols]),
+        'adj_close': np.concatenate([dfs[symbol]['Adj Close'].to_numpy()
+                                     for symbol in all_symbols]),
+        'in_universe': np.concatenate([dfs[symbol]['in_universe'].to_numpy(dtype=bool)
+                                       for symbol in all_symbols]),
+        'index': index.to_numpy(dtype='datetime64[ns]'),
+        'date_added_sp': mdf.loc[all_symbols, 'date_added_sp'].to_numpy(dtype='datetime64[ns]')}
+    blocks, manifest = [], {'symbols': list(all_symbols), 'arrays': {}}
+    try:
+        for name, values in arrays.items():
+            block, description = share_array(values)
+            blocks += [block]
+            manifest['arrays'][name] = description
+    except BaseException:
+        # do not leave the blocks published so far behind
+        release(blocks)
+        raise
+    return manifest, blocks
+
+
+# close and remove the shared memory blocks of a publisher
+def release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+# attach to published inputs and rebuild dfs, all_symbols, mdf and index from them,
+# the Adj Close columns are views into shared memory, so nothing big is copied
+def attach(manifest):
+    global attached
+    arrays = {}
+    for name, (block_name, shape, dtype) in manifest['arrays'].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        attached_blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        arrays[name].flags.writeable = False
+
+    all_symbols = manifest['symbols']
+    offsets = arrays['offsets']
+    dfs = {}
+    for j, symbol in enumerate(all_symbols):
+        rows = slice(offsets[j], offsets[j + 1])
+        df = pd.DataFrame(arrays['adj_close'][rows, None], columns=['Adj Close'],
+                          index=pd.DatetimeIndex(arrays['dates'][rows]), copy=False)
+        df['in_universe'] = arrays['in_universe'][rows]
+        dfs[symbol] = df
+    mdf = pd.DataFrame({'date_added_sp': arrays['date_added_sp']},
+                       index=pd.Index(all_symbols, name='symbol'))
+    index = pd.DatetimeIndex(arrays['index'])
+    attached = dfs, all_symbols, mdf, index
+    return attached
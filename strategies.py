@@ -1,5 +1,6 @@
 # defines trading strategies
-import talib
+# the symbol is only used to look the indicators up in indicators.cache
+import indicators
 
 # TREND-FOLLOWING STRATEGIES
 
@@ -7,9 +8,9 @@ import talib
 # buy when faster moving average crosses above the slower moving average,
 # sell when fast ma crosses below slow
 # input: fast_period, slow_period
-def sma_cross(df, params):
-    df['ma_fast'] = df["Adj Close"].rolling(window=params['fast_period']).mean()
-    df['ma_slow'] = df["Adj Close"].rolling(window=params['slow_period']).mean()
+def sma_cross(df, params, symbol=None):
+    df['ma_fast'] = indicators.sma(df["Adj Close"], params['fast_period'], symbol)
+    df['ma_slow'] = indicators.sma(df["Adj Close"], params['slow_period'], symbol)
     df['buy_condition'] = df['ma_fast'] > df['ma_slow']
     df['sell_condition'] = df['ma_fast'] <= df['ma_slow']
     df.dropna(subset=['ma_slow'], inplace=True)
@@ -18,11 +19,12 @@ def sma_cross(df, params):
 
 # buy when the macd line is above the signal line, otherwise sell
 # input: fast_period, slow_period, signal_period
-def macd(df, params):
-    df['macd'], df['signal'], df['hist'] = talib.MACD(df['Adj Close'],
-                                                      fastperiod=params['fast_period'],
-                                                      slowperiod=params['slow_period'],
-                                                      signalperiod=params['signal_period'])
+def macd(df, params, symbol=None):
+    df['macd'], df['signal'], df['hist'] = indicators.macd(df['Adj Close'],
+                                                           params['fast_period'],
+                                                           params['slow_period'],
+                                                           params['signal_period'],
+                                                           symbol)
     df['buy_condition'] = df['macd'] > df['signal']
     df['sell_condition'] = df['macd'] <= df['signal']
     df.dropna(subset=['signal'], inplace=True)
@@ -35,9 +37,9 @@ def macd(df, params):
 # buy when price crosses from below the buy threshold % of the %B oscillator,
 # sell when crosses above sell threshold
 # input: period, buy_threshold, sell_threshold
-def bollinger_bands(df, params):
-    df['ma'] = df['Adj Close'].rolling(window=params['period']).mean()
-    std = df['Adj Close'].rolling(window=params['period']).std()
+def bollinger_bands(df, params, symbol=None):
+    df['ma'] = indicators.sma(df['Adj Close'], params['period'], symbol)
+    std = indicators.rolling_std(df['Adj Close'], params['period'], symbol)
     df['lower_bb'] = df['ma'] - (std * 2)
     df['upper_bb'] = df['ma'] + (std * 2)
     df['percent_b'] = (df['Adj Close'] - df['lower_bb']) / \
@@ -52,9 +54,9 @@ def bollinger_bands(df, params):
 # buy when rsi crosses from below the oversold threshold,
 # sell when price reaches sma
 # input: rsi_period, ma_period, oversold
-def rsi_sma(df, params):
-    df['rsi'] = talib.RSI(df['Adj Close'], timeperiod=params['rsi_period'])
-    df['ma'] = df['Adj Close'].rolling(window=params['ma_period']).mean()
+def rsi_sma(df, params, symbol=None):
+    df['rsi'] = indicators.rsi(df['Adj Close'], params['rsi_period'], symbol)
+    df['ma'] = indicators.sma(df['Adj Close'], params['ma_period'], symbol)
     df['buy_condition'] = (df['rsi'].shift(1) < params['oversold']) & \
                           (df['rsi'] >= params['oversold']) & \
                           (df['Adj Close'] < df['ma'])
@@ -0,0 +1,382 @@
+# incremental signal engine for the end of day signal job, every indicator keeps a small
+# state that is updated in O(1) per bar instead of being recomputed over the whole history,
+# and the engine steps one bar per symbol at a time through the same trading rules as the
+# backtests, the whole engine can be snapshotted to disk and picked up again the next day
+import argparse
+import math
+import os
+import pickle
+from collections import deque
+import numpy as np
+import pandas as pd
+import backtesting
+from helpers import *
+
+
+# rolling mean and sample standard deviation over the last `period` values, with the same
+# online add and remove updates of the mean and the sum of squared deviations that pandas
+# uses for its rolling windows
+class RollingWindow:
+    def __init__(self, period):
+        self.period = period
+        self.values = deque()
+        self.running_mean = 0.0
+        self.squared_deviations = 0.0
+
+    def update(self, value):
+        if len(self.values) == self.period:
+            self.remove(self.values.popleft())
+        self.values.append(value)
+        count = len(self.values)
+        delta = value - self.running_mean
+        self.running_mean += delta / count
+        self.squared_deviations += ((count - 1) * delta * delta) / count
+
+    def remove(self, value):
+        count = len(self.values)
+        if not count:
+            self.running_mean = self.squared_deviations = 0.0
+            return
+        delta = value - self.running_mean
+        self.running_mean -= delta / count
+        self.squared_deviations -= ((count + 1) * delta * delta) / count
+
+    def is_full(self):
+        return len(self.values) == self.period
+
+    def mean(self):
+        if not self.is_full():
+            return math.nan
+        return self.running_mean
+
+    def std(self):
+        if not self.is_full() or self.period < 2:
+            return math.nan
+        return math.sqrt(max(self.squared_deviations / (self.period - 1), 0.0))
+
+
+# mean of the values summed in order, the way ta-lib seeds its moving averages
+def seed_average(values):
+    total = 0.0
+    for value in values:
+        total += value
+    return total / len(values)
+
+
+# macd line, signal line and histogram as computed by talib.MACD: both emas are seeded on
+# the bar the slow one has enough data for, each with the mean of its last period prices,
+# and the signal line is seeded with the mean of the first signal_period macd values
+class Macd:
+    def __init__(self, fast_period, slow_period, signal_period):
+        if slow_period < fast_period:
+            fast_period, slow_period = slow_period, fast_period
+        self.fast_period = fast_period
+        self.slow_period = slow_period
+        self.signal_period = signal_period
+        self.fast_k = 2 / (fast_period + 1)
+        self.slow_k = 2 / (slow_period + 1)
+        self.signal_k = 2 / (signal_period + 1)
+        self.prices = []
+        self.fast_ema = None
+        self.slow_ema = None
+        self.macd_values = []
+        self.signal_ema = None
+
+    def update(self, price):
+        if self.slow_ema is None:
+            self.prices.append(price)
+            if len(self.prices) < self.slow_period:
+                return math.nan, math.nan, math.nan
+            self.slow_ema = seed_average(self.prices)
+            self.fast_ema = seed_average(self.prices[-self.fast_period:])
+            self.prices = None
+        else:
+            self.slow_ema = ((price - self.slow_ema) * self.slow_k) + self.slow_ema
+            self.fast_ema = ((price - self.fast_ema) * self.fast_k) + self.fast_ema
+        macd = self.fast_ema - self.slow_ema
+        if self.signal_ema is None:
+            self.macd_values.append(macd)
+            if len(self.macd_values) < self.signal_period:
+                return math.nan, math.nan, math.nan
+            self.signal_ema = seed_average(self.macd_values)
+            self.macd_values = None
+        else:
+            self.signal_ema = ((macd - self.signal_ema) * self.signal_k) + self.signal_ema
+        return macd, self.signal_ema, macd - self.signal_ema
+
+
+# relative strength index with wilder smoothing, as computed by talib.RSI
+class Rsi:
+    def __init__(self, period):
+        self.period = period
+        self.previous_price = None
+        self.changes = 0
+        self.gain = 0.0
+        self.loss = 0.0
+
+    def update(self, price):
+        if self.previous_price is None:
+            self.previous_price = price
+            return math.nan
+        change = price - self.previous_price
+        self.previous_price = price
+        self.changes += 1
+        # the first averages are plain means of the first period changes
+        if self.changes > self.period:
+            self.gain *= (self.period - 1)
+            self.loss *= (self.period - 1)
+        if change < 0:
+            self.loss -= change
+        else:
+            self.gain += change
+        if self.changes < self.period:
+            return math.nan
+        self.gain /= self.period
+        self.loss /= self.period
+        total = self.gain + self.loss
+        if -1e-8 < total < 1e-8:
+            return 0.0
+        return 100.0 * (self.gain / total)
+
+
+# STREAMING STRATEGIES
+# the same buy and sell conditions as the functions in strategies.py, update takes the
+# next price and returns whether the indicators are warmed up and both conditions
+
+
+class SmaCross:
+    def __init__(self, params):
+        self.fast = RollingWindow(params['fast_period'])
+        self.slow = RollingWindow(params['slow_period'])
+
+    def update(self, price):
+        self.fast.update(price)
+        self.slow.update(price)
+        ma_fast, ma_slow = self.fast.mean(), self.slow.mean()
+        return not math.isnan(ma_slow), ma_fast > ma_slow, ma_fast <= ma_slow
+
+
+class MacdCross:
+    def __init__(self, params):
+        self.macd = Macd(params['fast_period'], params['slow_period'], params['signal_period'])
+
+    def update(self, price):
+        macd, signal, _ = self.macd.update(price)
+        return not math.isnan(signal), macd > signal, macd <= signal
+
+
+class BollingerBands:
+    def __init__(self, params):
+        self.window = RollingWindow(params['period'])
+        self.buy_threshold = params['buy_threshold']
+        self.sell_threshold = params['sell_threshold']
+        self.previous_percent_b = math.nan
+
+    def update(self, price):
+        self.window.update(price)
+        ma, std = self.window.mean(), self.window.std()
+        lower_bb = ma - (std * 2)
+        upper_bb = ma + (std * 2)
+        # numpy division, bands of zero width give inf or nan like in pandas
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent_b = float(np.float64(price - lower_bb) / (upper_bb - lower_bb) * 100)
+        buy_condition = self.previous_percent_b < self.buy_threshold < percent_b
+        self.previous_percent_b = percent_b
+        return not math.isnan(ma), buy_condition, percent_b > self.sell_threshold
+
+
+class RsiSma:
+    def __init__(self, params):
+        self.rsi = Rsi(params['rsi_period'])
+        self.window = RollingWindow(params['ma_period'])
+        self.oversold = params['oversold']
+        self.previous_rsi = math.nan
+
+    def update(self, price):
+        rsi = self.rsi.update(price)
+        self.window.update(price)
+        ma = self.window.mean()
+        buy_condition = self.previous_rsi < self.oversold <= rsi and price < ma
+        self.previous_rsi = rsi
+        return not (math.isnan(ma) or math.isnan(rsi)), buy_condition, price >= ma
+
+
+string_to_streaming_strategy = {'sma': SmaCross,
+                                'macd': MacdCross,
+                                'bb': BollingerBands,
+                                'rsi_sma': RsiSma}
+
+
+# strategy state of one symbol together with the buy condition of its previous warmed up
+# bar, a buy signal is only given when the buy condition changes from false to true
+class SymbolState:
+    def __init__(self, strategy_name, params):
+        self.strategy = string_to_streaming_strategy[strategy_name](params)
+        self.previous_buy_condition = None
+
+    def update(self, price):
+        is_ready, buy_condition, sell_condition = self.strategy.update(price)
+        if not is_ready:
+            return False, False, False
+        buy_signal = self.previous_buy_condition is False and bool(buy_condition)
+        self.previous_buy_condition = bool(buy_condition)
+        return True, buy_signal, bool(sell_condition)
+
+
+# steps the strategy and the portfolio through one day at a time, with the rules of
+# fast_backtesting.simulate, trading starts at start_date and for every symbol once it
+# is an index constituent, the bars before only warm up the indicators
+class SignalEngine:
+    def __init__(self, strategy_name, params, stoploss_percentage, mdf,
+                 start_date=TRADE_START_DATE):
+        self.strategy_name = strategy_name
+        self.params = params
+        self.stoploss_factor = (100 - stoploss_percentage) / 100
+        self.start_date = pd.Timestamp(start_date)
+        self.added_dates = mdf['date_added_sp'].to_dict()
+        self.symbols = {}
+        self.usd = STARTING_CAPITAL
+        # size of the held position and stoploss price of every symbol that is long
+        self.position = {}
+        self.stoploss = {}
+        self.last_date = None
+
+    # whether a symbol can be traded on a date
+    def is_tradable(self, symbol, date):
+        added_date = self.added_dates.get(symbol, pd.NaT)
+        return date >= self.start_date and not (added_date > self.start_date and
+                                                date < added_date)
+
+    # take the close of one new bar per symbol, the symbols in the universe today and the
+    # symbols that are seen for the last time, returns the trades and the portfolio of the day
+    def step(self, date, prices, in_universe, last_day=()):
+        date = pd.Timestamp(date)
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f"Bar for {date} is not after the last bar {self.last_date}")
+        self.last_date = date
+
+        # update the indicators of every symbol that has a bar today
+        signals = {}
+        for symbol in sorted(prices):
+            if symbol not in self.symbols:
+                self.symbols[symbol] = SymbolState(self.strategy_name, self.params)
+            has_row, buy_signal, sell_condition = self.symbols[symbol].update(prices[symbol])
+            if has_row and self.is_tradable(symbol, date):
+                signals[symbol] = buy_signal, sell_condition
+
+        # cash is spent and received in symbol order
+        trades = []
+        for symbol, (buy_signal, sell_condition) in signals.items():
+            price = prices[symbol]
+            has_position = symbol in self.position
+            if not has_position and symbol not in in_universe:
+                continue
+            it_is_the_last_day = symbol in last_day
+
+            # check for buys
+            if not has_position and not it_is_the_last_day and buy_signal and \
+                    self.usd >= POSITION_SIZE_QUOTE:
+                # adjust usd holdings and position size keeping fees in mind
+                self.usd -= POSITION_SIZE_QUOTE
+                self.position[symbol] = (POSITION_SIZE_QUOTE / price) * FEE_FACTOR
+                self.stoploss[symbol] = price * self.stoploss_factor
+                trades += [{'symbol': symbol, 'side': 'buy', 'price': price, 'size': 1,
+                            'date': date}]
+
+            # handle sells
+            if symbol in self.position:
+                trigger_stoploss_sell = self.stoploss[symbol] >= price
+                if trigger_stoploss_sell or it_is_the_last_day or sell_condition:
+                    self.usd += (self.position.pop(symbol) * price) * FEE_FACTOR
+                    del self.stoploss[symbol]
+                    trades += [{'symbol': symbol, 'side': 'sell', 'price': price, 'size': -1,
+                                'date': date}]
+
+        # handle the usd value of owned stock that has a bar today
+        stock_holdings_value = sum(self.position[symbol] * prices[symbol]
+                                   for symbol in signals if symbol in self.position)
+        return {'date': date, 'trades': trades, 'usd_holdings': self.usd,
+                'stock_holdings_value': stock_holdings_value,
+                'total_portfolio_value': self.usd + stock_holdings_value}
+
+
+# write the engine to disk, under a temporary name first so a crash keeps the old snapshot
+def save_snapshot(engine, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(engine, f)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+# feed the bars of the per symbol dataframes after the engine's last bar and up to end_date
+# into the engine day by day, symbols are forced out on their last bar the way the
+# backtests close them, returns the result of every step
+def replay(engine, dfs, all_symbols, end_date=TRADE_END_DATE, force_last_day=True):
+    prices = pd.concat({symbol: dfs[symbol]['Adj Close'] for symbol in all_symbols}, axis=1)
+    in_universe = pd.concat({symbol: dfs[symbol]['in_universe'] for symbol in all_symbols},
+                            axis=1).fillna(False)
+    dates = prices.index[prices.index <= end_date]
+    if engine.last_date is not None:
+        dates = dates[dates > engine.last_date]
+    if not len(dates):
+        return []
+    # the last bar every symbol has up to the last date that is replayed
+    last_bar = prices.loc[:dates[-1]].apply(pd.Series.last_valid_index)
+    symbols = np.array(prices.columns)
+    price_values = prices.loc[dates].to_numpy()
+    universe_values = in_universe.loc[dates].to_numpy(dtype=bool)
+    results = []
+    for i, date in enumerate(dates):
+        has_bar = ~np.isnan(price_values[i])
+        bars = dict(zip(symbols[has_bar], price_values[i, has_bar]))
+        last_day = {symbol for symbol in bars if last_bar[symbol] == date} \
+            if force_last_day else ()
+        results += [engine.step(date, bars, set(symbols[universe_values[i]]), last_day)]
+    return results
+
+
+# end of day job: pick the engine up from its snapshot, or warm it up on the whole history,
+# step it through the bars that are new since then and print the decisions of the last day
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="step the signal engine through the bars "
+                                                 "since its snapshot and print the decisions",
+                                     parents=list(parents))
+    parser.parse_args(argv)
+
+    print_params()
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+
+    snapshot_path = f"{DATA_DIR_NAME}/{SIGNAL_SNAPSHOT_FILE_NAME}"
+    if os.path.isfile(snapshot_path):
+        engine = load_snapshot(snapshot_path)
+        if engine.strategy_name != STRATEGY or engine.params != backtesting.params:
+            raise ValueError("Snapshot was made with a different strategy or parameters")
+        print(f"resuming from the snapshot of {engine.last_date.date()}")
+    else:
+        engine = SignalEngine(STRATEGY, backtesting.params, STOPLOSS_PERCENTAGE, mdf)
+
+    # symbols are not forced out, their next bar may still come
+    results = replay(engine, dfs, all_symbols, force_last_day=False)
+    if not results:
+        print("no new bars since the snapshot")
+    else:
+        save_snapshot(engine, snapshot_path)
+        print(f"stepped through {len(results)} new days")
+        result = results[-1]
+        for trade in result['trades']:
+            print(f"{result['date'].date()}: {trade['side']} {trade['symbol']} "
+                  f"at {trade['price']}")
+        print(f"{result['date'].date()}: usd holdings {result['usd_holdings']}, "
+              f"stock holdings value {result['stock_holdings_value']}, "
+              f"total portfolio value {result['total_portfolio_value']}, "
+              f"{len(engine.position)} open positions")
+
+
+if __name__ == "__main__":
+    main()
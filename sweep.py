@@ -0,0 +1,131 @@
+# backtest several strategies, parameter sets and stoploss levels in one run, the data is
+# loaded and the universe is selected once, then every (strategy, params, stoploss) job is
+# backtested on a process pool that shares the data and the indicator cache, and the
+# metrics of all equity curves are computed together into one table
+import argparse
+import contextlib
+import json
+import backtesting
+import differential_evolution as optimizer
+import fast_backtesting
+import indicators
+import instrumentation
+import ledger
+import metrics
+from helpers import *
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import shared_data
+import shutil
+import tempfile
+
+DEFAULT_STOPLOSS_PERCENTAGES = [5, 10, 15, 20, 25]
+
+
+# backtest one job on the data this worker attached to, returns its equity curve
+# and trade stats, the metrics of all curves are computed together afterwards
+def run_job(strategy_name, params, stoploss_percentage):
+    dfs, all_symbols, mdf, index = shared_data.attached
+    backtest_result = fast_backtesting.backtest(dfs, all_symbols, mdf, None, index,
+                                                string_to_strategy[strategy_name], params,
+                                                stoploss_percentage)
+    sharpe_ratio, portfolio, all_traded_stocks, trades = backtest_result
+    trade_summary = ledger.summary(ledger.round_trips(ledger.trade_ledger(trades)))
+    return {'strategy': strategy_name,
+            'params': json.dumps(params),
+            'stoploss': stoploss_percentage,
+            'trades': trade_summary['trades'],
+            'win_rate': trade_summary['win_rate'],
+            'average_holding_days': trade_summary['average_holding_days']}, \
+        portfolio['total_portfolio_value'].to_numpy()
+
+
+# table of the jobs with the metrics of their equity curves against the benchmark
+def results_table(job_results, benchmark_price):
+    curves = np.vstack([curve for _, curve in job_results])
+    curve_metrics = metrics.evaluate(curves, benchmark_price)
+    results = pd.DataFrame([job for job, _ in job_results])
+    for name in ['sharpe_ratio', 'sortino_ratio', 'alpha', 'beta']:
+        results[name] = curve_metrics[name]
+    results['max_drawdown'] = curve_metrics['max_drawdown'] * 100
+    results['max_drawdown_duration'] = curve_metrics['max_drawdown_duration']
+    results['cagr'] = curve_metrics['cagr'] * 100
+    results['profit'] = (curves[:, -1] / curves[:, 0] - 1) * 100
+    return results.sort_values('sharpe_ratio', ascending=False)
+
+
+# (strategy, params, stoploss) jobs, jobs with the same indicators are next to each other
+def make_jobs(strategy_names, strategy_params, stoploss_percentages):
+    return [(strategy_name, params, stoploss_percentage)
+            for strategy_name in strategy_names
+            for params in strategy_params[strategy_name]
+            for stoploss_percentage in stoploss_percentages]
+
+
+# backtest every job on a process pool, print the table of their metrics and save it
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(
+        description="backtest strategies over several parameter sets and stoploss levels",
+        parents=list(parents))
+    parser.add_argument('--strategies', nargs='+', choices=list(string_to_strategy),
+                        default=list(string_to_strategy))
+    parser.add_argument('--stoplosses', nargs='+', type=float,
+                        default=DEFAULT_STOPLOSS_PERCENTAGES,
+                        help="stoploss percentages every parameter set is backtested with")
+    parser.add_argument('--params', default=None,
+                        help="json file with a list of parameter sets per strategy, "
+                             "the optimized parameters in backtesting.py by default")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrumentation.configure(args.instrument, args.profile)
+
+    strategy_params = {strategy_name: [params]
+                       for strategy_name, params in backtesting.optimized_params.items()}
+    if args.params is not None:
+        with open(args.params) as f:
+            strategy_params.update(json.load(f))
+    jobs = make_jobs(args.strategies, strategy_params, args.stoplosses)
+
+    # load the data and select the universe once for all jobs
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data()
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+    benchmark_price = spdf.loc[index, 'Adj Close']
+
+    # the shared memory and the indicator directory are released even when a job fails
+    with contextlib.ExitStack() as stack:
+        shared_dir = tempfile.mkdtemp(prefix='indicator_cache_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        stack.callback(shutil.rmtree, shared_dir, ignore_errors=True)
+        context = mp.get_context(optimizer.START_METHOD)
+        indicators.cache = indicators.IndicatorCache(shared_dir=shared_dir, context=context)
+        manifest, blocks = shared_data.publish(dfs, all_symbols, mdf, index)
+        stack.callback(shared_data.release, blocks)
+
+        num_workers = min(args.workers, len(jobs))
+        print(f"running {len(jobs)} backtests with {num_workers} workers")
+        with context.Pool(num_workers, initializer=optimizer.init_worker,
+                          initargs=(manifest, indicators.cache, instrumentation.recorder)) as pool:
+            job_results = pool.starmap(run_job, jobs)
+            # let the workers exit on their own, so they write their stage timings
+            pool.close()
+            pool.join()
+        optimizer.print_cache_stats()
+        instrumentation.print_summary()
+
+    results = results_table(job_results, benchmark_price)
+    print('-----')
+    print(results.to_string(index=False))
+    benchmark_metrics = metrics.evaluate(benchmark_price)
+    print(f"S&P 500 sharpe ratio: {benchmark_metrics['sharpe_ratio'][0]}, "
+          f"sortino ratio: {benchmark_metrics['sortino_ratio'][0]}, "
+          f"max drawdown: {benchmark_metrics['max_drawdown'][0] * 100}%, "
+          f"cagr: {benchmark_metrics['cagr'][0] * 100}%")
+    if not os.path.isdir(CSV_OUT_DIR_NAME):
+        os.mkdir(CSV_OUT_DIR_NAME)
+    results.to_csv(f"{CSV_OUT_DIR_NAME}/sweep_results.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# seeded synthetic market data for benchmarks and offline runs: geometric brownian motion
+# prices with opens, highs, lows and volume, daily or intraday bars, written in the layouts
+# that get_data reads
+import os
+import numpy as np
+import pandas as pd
+import price_store
+from constants import *
+
+FIELDS = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume']
+TRADING_DAYS_PER_YEAR = 252
+# regular session of a trading day, the intraday bars are stamped with their start
+SESSION_OPEN = pd.Timedelta(hours=9, minutes=30)
+SESSION_MINUTES = 390
+
+
+# dates of the bars from start to end, one per business day, or one every bar_minutes
+# over the regular session of every business day
+def bar_dates(start_date, end_date, bar_minutes=None):
+    days = pd.bdate_range(start_date, end_date, name='Date')
+    if bar_minutes is None:
+        return days
+    offsets = SESSION_OPEN + pd.to_timedelta(np.arange(0, SESSION_MINUTES, bar_minutes),
+                                             unit='min')
+    return pd.DatetimeIndex((days.to_numpy()[:, None] + offsets.to_numpy()[None, :]).ravel(),
+                            name='Date')
+
+
+# bars of one geometric brownian motion per column, with the given annualized drifts
+# and volatilities, returns the open, high, low, close and volume arrays
+def simulate_bars(rng, n_dates, drift, volatility, start_price, base_volume,
+                  bars_per_year=TRADING_DAYS_PER_YEAR):
+    dt_year = 1 / bars_per_year
+    shape = (n_dates, len(drift))
+    log_returns = (drift - volatility ** 2 / 2) * dt_year + \
+        volatility * np.sqrt(dt_year) * rng.standard_normal(shape)
+    close = start_price * np.exp(np.cumsum(log_returns, axis=0))
+    # opens gap away from the previous close, highs and lows reach out of the body of the bar
+    previous_close = np.vstack([start_price[None, :], close[:-1]])
+    bar_volatility = volatility * np.sqrt(dt_year)
+    open_ = previous_close * np.exp(0.3 * bar_volatility * rng.standard_normal(shape))
+    high = np.maximum(open_, close) * \
+        (1 + 0.5 * bar_volatility * np.abs(rng.standard_normal(shape)))
+    low = np.minimum(open_, close) * \
+        (1 - 0.5 * bar_volatility * np.abs(rng.standard_normal(shape)))
+    # volume scatters around the level of the symbol and rises with the size of the move
+    volume = np.round(base_volume * rng.lognormal(0, 0.4, shape) *
+                      (1 + 20 * np.abs(log_returns)))
+    return open_, high, low, close, volume
+
+
+# stock price bars with (symbol, field) columns like a download, some symbols are listed
+# after the start or delisted before the end, so their first or last bars are missing,
+# daily bars unless bar_minutes is given
+def generate_prices(n_symbols, start_date, end_date, seed=0, bar_minutes=None):
+    rng = np.random.default_rng(seed)
+    dates = bar_dates(start_date, end_date, bar_minutes)
+    bars_per_day = 1 if bar_minutes is None else len(range(0, SESSION_MINUTES, bar_minutes))
+    symbols = [f"SYN{i:04d}" for i in range(n_symbols)]
+    open_, high, low, close, volume = simulate_bars(
+        rng, len(dates),
+        drift=rng.normal(0.07, 0.1, n_symbols),
+        volatility=rng.uniform(0.15, 0.5, n_symbols),
+        start_price=rng.uniform(10, 300, n_symbols),
+        base_volume=np.exp(rng.uniform(np.log(1e5), np.log(5e7), n_symbols)) / bars_per_day,
+        bars_per_year=TRADING_DAYS_PER_YEAR * bars_per_day)
+    bars = np.stack([open_, high, low, close, close, volume], axis=2)
+    listed = rng.random(n_symbols) < 0.2
+    delisted = rng.random(n_symbols) < 0.1
+    for j in np.flatnonzero(listed):
+        bars[:rng.integers(len(dates) // 2), j] = np.nan
+    for j in np.flatnonzero(delisted):
+        bars[len(dates) - rng.integers(1, len(dates) // 2):, j] = np.nan
+    columns = pd.MultiIndex.from_product([symbols, FIELDS])
+    return pd.DataFrame(bars.reshape(len(dates), -1), index=dates, columns=columns)
+
+
+# S&P 500 bars in the layout of sp500_price_data.csv
+def generate_index_prices(start_date, end_date, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    dates = pd.bdate_range(start_date, end_date, name='Date')
+    open_, high, low, close, volume = simulate_bars(
+        rng, len(dates), drift=np.array([0.07]), volatility=np.array([0.18]),
+        start_price=np.array([1000.0]), base_volume=np.array([3e9]))
+    return pd.DataFrame({'Open': open_[:, 0], 'High': high[:, 0], 'Low': low[:, 0],
+                         'Close': close[:, 0], 'Adj Close': close[:, 0],
+                         'Volume': volume[:, 0]}, index=dates)
+
+
+# metadata in the layout of stock_price_metadata.csv, a third of the symbols have been in the
+# S&P 500 for longer than the data goes back, the others are added at random dates
+def generate_metadata(symbols, start_date, end_date, seed=0):
+    rng = np.random.default_rng(seed + 2)
+    dates = pd.bdate_range(start_date, end_date)
+    added = [pd.NaT if rng.random() < 1 / 3 else dates[rng.integers(len(dates))]
+             for _ in symbols]
+    return pd.DataFrame({'date_added_sp': added,
+                         'name_wiki': [f"Synthetic {symbol}" for symbol in symbols],
+                         'name_yf': [f"Synthetic {symbol} ({symbol})" for symbol in symbols],
+                         'currency': 'USD',
+                         'exchange': 'NMS',
+                         'quote_type': 'EQUITY',
+                         'timezone': 'America/New_York'},
+                        index=pd.Index(symbols, name='symbol'))
+
+
+# write a synthetic data directory that get_data can read, run from the directory that
+# holds DATA_DIR_NAME, with the price store next to the csv unless with_store is false,
+# intraday bars of bar_minutes only go into the price store, the S&P 500 bars stay daily
+def write_synthetic_data(n_symbols, start_date, end_date, seed=0, with_store=True,
+                         bar_minutes=None):
+    if not os.path.isdir(DATA_DIR_NAME):
+        os.mkdir(DATA_DIR_NAME)
+    df = generate_prices(n_symbols, start_date, end_date, seed, bar_minutes)
+    if bar_minutes is None:
+        df.to_csv(f"{DATA_DIR_NAME}/{DATA_FILE_NAME}")
+    if with_store or bar_minutes is not None:
+        price_store.write_store(df, f"{DATA_DIR_NAME}/{PRICE_STORE_DIR_NAME}")
+    symbols = list(df.columns.levels[0])
+    generate_metadata(symbols, start_date, end_date, seed).to_csv(
+        f"{DATA_DIR_NAME}/{METADATA_FILE_NAME}")
+    generate_index_prices(start_date, end_date, seed).to_csv(
+        f"{DATA_DIR_NAME}/{SP500_DATA_FILE_NAME}")
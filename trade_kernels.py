@@ -0,0 +1,173 @@
+# trade simulation split into a vectorized per symbol entry and exit kernel and a small
+# sequential cash allocation pass, the exit of every possible entry only depends on that
+# symbol's own prices and signals, so it is resolved for all symbols at once, and only the
+# question which entries the cash allows is answered one date at a time
+import heapq
+import numpy as np
+from constants import *
+
+
+# dates on which a flat symbol would buy if there is enough cash
+def candidate_entries(buy_signal, in_universe, has_row, is_last_day):
+    return has_row & in_universe & buy_signal & ~is_last_day
+
+
+# for every date and symbol, the first date from then on with a sell condition or the
+# forced sale on the symbol's last day, n_dates when there is none
+def next_sell_event(sell_condition, has_row, is_last_day):
+    n_dates = len(has_row)
+    is_event = has_row & (sell_condition | is_last_day)
+    event_rows = np.where(is_event, np.arange(n_dates)[:, None], n_dates)
+    return np.minimum.accumulate(event_rows[::-1], axis=0)[::-1]
+
+
+# range minimum tables of the prices of one symbol, level l holds the minimum of the 2**l
+# prices from each date on, dates without a row never trigger a stoploss so they count as
+# infinite, the tables keep the dtype of the prices
+def min_tables(price, has_row):
+    table = np.where(has_row, price, np.array(np.inf, dtype=price.dtype))
+    tables = [table]
+    width = 1
+    while width < len(price):
+        shifted = np.full(table.shape, np.inf, dtype=table.dtype)
+        shifted[:-width] = table[width:]
+        table = np.minimum(table, shifted)
+        tables += [table]
+        width *= 2
+    return tables
+
+
+# the first date from start_rows on where the price of the symbol drops to its threshold,
+# n_dates when it never does, found by skipping the largest blocks that stay above it
+def first_price_at_or_below(tables, start_rows, thresholds):
+    n_dates = len(tables[0])
+    rows = start_rows.copy()
+    for level in range(len(tables) - 1, -1, -1):
+        inside = rows < n_dates
+        block_min = tables[level][np.minimum(rows, n_dates - 1)]
+        skip = inside & (block_min > thresholds)
+        rows = np.where(skip, np.minimum(rows + 2 ** level, n_dates), rows)
+    return rows
+
+
+# the date each candidate entry would be sold on: its next sell event or the first date
+# from the entry on that the stoploss is hit, whichever comes first, the entry date itself
+# only hits it when stoploss_percentage is 0 or less, as in the date loop
+def exit_rows(price, sell_condition, has_row, is_last_day, entry_rows, entry_cols,
+              stoploss_percentage):
+    stoploss_factor = (100 - stoploss_percentage) / 100
+    sell_event_rows = next_sell_event(sell_condition, has_row, is_last_day)[entry_rows,
+                                                                            entry_cols]
+    thresholds = price[entry_rows, entry_cols] * stoploss_factor
+    # the min tables are built for one symbol with entries at a time, so only a column of
+    # them is in memory instead of a date x symbol matrix per level
+    stoploss_rows = np.empty(len(entry_rows), dtype=entry_rows.dtype)
+    order = np.argsort(entry_cols, kind='stable')
+    cols, starts = np.unique(entry_cols[order], return_index=True)
+    for col, entries in zip(cols, np.split(order, starts[1:])):
+        tables = min_tables(price[:, col], has_row[:, col])
+        stoploss_rows[entries] = first_price_at_or_below(tables, entry_rows[entries],
+                                                         thresholds[entries])
+    return np.minimum(sell_event_rows, stoploss_rows)
+
+
+# the candidate entries of all symbols, sorted by date and then symbol, with their exits
+def detect_trades(price, buy_signal, sell_condition, in_universe, has_row, is_last_day,
+                  stoploss_percentage):
+    entry_rows, entry_cols = np.nonzero(candidate_entries(buy_signal, in_universe, has_row,
+                                                          is_last_day))
+    entry_exit_rows = exit_rows(price, sell_condition, has_row, is_last_day, entry_rows,
+                                entry_cols, stoploss_percentage)
+    return entry_rows, entry_cols, entry_exit_rows
+
+
+# walk the candidate entries (sorted by date, then symbol) and the exits of the positions
+# that were opened, date by date and in symbol order within a date, a flat symbol buys when
+# there is enough cash, returns which entries were taken and the usd holdings of every date
+def allocate_cash(entry_rows, entry_cols, entry_exit_rows, price, n_dates):
+    taken = np.zeros(len(entry_rows), dtype=bool)
+    usd_holdings = np.empty(n_dates)
+    quantity = {}
+    # (exit row, symbol column) of the open positions
+    open_exits = []
+    usd = STARTING_CAPITAL
+    k, n_entries, next_row = 0, len(entry_rows), 0
+    while k < n_entries or open_exits:
+        row = min(entry_rows[k] if k < n_entries else n_dates,
+                  open_exits[0][0] if open_exits else n_dates)
+        if row >= n_dates:
+            break
+        usd_holdings[next_row:row] = usd
+        # the symbols that can trade today, with their candidate entry, None for an exit
+        todays = {}
+        while open_exits and open_exits[0][0] == row:
+            todays[heapq.heappop(open_exits)[1]] = None
+        while k < n_entries and entry_rows[k] == row:
+            todays.setdefault(entry_cols[k], k)
+            k += 1
+
+        for col in sorted(todays):
+            entry = todays[col]
+            symbol_price = price[row, col]
+            if entry is None:
+                # a symbol that is long at the start of the day can only sell
+                usd += (quantity.pop(col) * symbol_price) * FEE_FACTOR
+            elif col not in quantity and usd >= POSITION_SIZE_QUOTE:
+                taken[entry] = True
+                usd -= POSITION_SIZE_QUOTE
+                quantity[col] = (POSITION_SIZE_QUOTE / symbol_price) * FEE_FACTOR
+                if entry_exit_rows[entry] == row:
+                    # sold again on the day it is bought
+                    usd += (quantity.pop(col) * symbol_price) * FEE_FACTOR
+                else:
+                    heapq.heappush(open_exits, (entry_exit_rows[entry], col))
+        usd_holdings[row] = usd
+        next_row = row + 1
+    usd_holdings[next_row:] = usd
+    return taken, usd_holdings
+
+
+# same inputs and outputs as fast_backtesting.simulate
+def simulate(index, all_symbols, price, buy_signal, sell_condition, in_universe,
+             has_row, is_last_day, stoploss_percentage):
+    n_dates = len(price)
+    entry_rows, entry_cols, entry_exit_rows = detect_trades(
+        price, buy_signal, sell_condition, in_universe, has_row, is_last_day,
+        stoploss_percentage)
+    taken, usd_holdings = allocate_cash(entry_rows, entry_cols, entry_exit_rows, price,
+                                        n_dates)
+    # check to make sure there are no long positions open
+    if np.any(entry_exit_rows[taken] >= n_dates):
+        raise ValueError("There are open longs at the end of the backtest")
+    buy_rows, cols, sell_rows = entry_rows[taken], entry_cols[taken], entry_exit_rows[taken]
+
+    # hold every taken position from its buy up to its sell, at most one position per
+    # symbol is open at a time so the running sums are exact
+    quantity = (POSITION_SIZE_QUOTE / price[buy_rows, cols]) * FEE_FACTOR
+    holdings = np.zeros(price.shape)
+    np.add.at(holdings, (buy_rows, cols), quantity)
+    np.add.at(holdings, (sell_rows, cols), -quantity)
+    holdings = np.cumsum(holdings, axis=0)
+    held = has_row & (holdings > 0)
+    stock_holdings_value = np.where(held, holdings * price, 0).sum(axis=1)
+
+    # the trades in the order the event loop makes them: by date, then symbol, buys first
+    position_size = np.full(price.shape, np.nan)
+    position_size[buy_rows, cols] = 1
+    position_size[sell_rows, cols] = -1
+    trade_rows = np.concatenate([buy_rows, sell_rows])
+    trade_cols = np.concatenate([cols, cols])
+    sides = np.repeat([0, 1], len(cols))
+    order = np.lexsort((sides, trade_cols, trade_rows))
+    trade_rows, trade_cols, sides = trade_rows[order], trade_cols[order], sides[order]
+    trades = [{'symbol': all_symbols[col],
+               'side': 'sell' if side else 'buy',
+               'price': symbol_price,
+               'size': -1.0 if side else 1.0,
+               'date': date}
+              for col, side, symbol_price, date in zip(trade_cols.tolist(), sides.tolist(),
+                                                       price[trade_rows, trade_cols],
+                                                       index[trade_rows])]
+    first_buys = np.unique(cols, return_index=True)[1]
+    all_traded_stocks = [all_symbols[col] for col in cols[np.sort(first_buys)]]
+    return usd_holdings, stock_holdings_value, position_size, all_traded_stocks, trades
@@ -0,0 +1,155 @@
+# walk-forward optimization: the history is split into rolling train and test windows,
+# the parameters are optimized on every train window and then backtested out-of-sample on
+# the test window that follows it, the out-of-sample equity curves are stitched together,
+# folds run in parallel on a process pool and share the data, the universe selection and
+# the indicator cache instead of loading and computing them per fold
+import argparse
+import backtesting
+import batch_backtesting
+import contextlib
+import differential_evolution as optimizer
+import fast_backtesting
+import indicators
+from helpers import *
+from scipy.optimize import differential_evolution
+import multiprocessing as mp
+import pandas as pd
+import shared_data
+import shutil
+import tempfile
+
+# first date of the first train window, DATA_START_DATE leaves a year to warm up indicators
+WALK_FORWARD_START_DATE = dt.datetime(year=2010, month=1, day=1)
+TRAIN_YEARS = 4
+TEST_YEARS = 1
+# generations of differential evolution per train window
+MAX_GENERATIONS = 25
+
+
+# rolling (train start, test start, test end) dates, each test window starts where its
+# train window ends and the next fold moves forward by one test window
+def make_folds(start_date, end_date, train_years=TRAIN_YEARS, test_years=TEST_YEARS):
+    folds = []
+    train_start = pd.Timestamp(start_date)
+    while True:
+        test_start = train_start + pd.DateOffset(years=train_years)
+        if test_start >= end_date:
+            return folds
+        test_end = min(test_start + pd.DateOffset(years=test_years), pd.Timestamp(end_date))
+        folds += [(train_start, test_start, test_end)]
+        train_start += pd.DateOffset(years=test_years)
+
+
+# the trading dates of index in [start_date, end_date)
+def window(index, start_date, end_date):
+    return index[(index >= start_date) & (index < end_date)]
+
+
+# optimize the strategy parameters on the dates of index with differential evolution,
+# through the result cache so folds and reruns never backtest a parameter set twice
+def optimize(dfs, all_symbols, mdf, index, param_bounds):
+    results, evaluator = optimizer.open_result_cache(dfs, all_symbols, mdf, index)
+    # the objective is flat between integer parameters, polishing would only re-evaluate them
+    if optimizer.BATCH_EVALUATION and STRATEGY in batch_backtesting.BATCH_STRATEGIES:
+        result = differential_evolution(optimizer.cached_batch_objective_function,
+                                        param_bounds[STRATEGY][1],
+                                        args=(evaluator, dfs, all_symbols, mdf, index,
+                                              param_bounds),
+                                        seed=69420,
+                                        maxiter=MAX_GENERATIONS,
+                                        polish=False,
+                                        vectorized=True,
+                                        updating='deferred')
+    else:
+        args = (dfs, all_symbols, mdf, None, index, string_to_strategy, param_bounds)
+        result = differential_evolution(
+            lambda params: evaluator.evaluate(
+                [params], lambda missing: [optimizer.objective_function(missing[0], *args)])[0],
+            param_bounds[STRATEGY][1],
+            seed=69420,
+            maxiter=MAX_GENERATIONS,
+            polish=False)
+    results.close()
+    param_names = param_bounds[STRATEGY][0]
+    return {param_names[i]: round(param) for i, param in enumerate(result.x)}, -result.fun
+
+
+# optimize one fold on its train window and backtest the winner on its test window,
+# on the data this worker attached to
+def run_fold(fold, param_bounds):
+    train_start, test_start, test_end = fold
+    dfs, all_symbols, mdf, index = shared_data.attached
+    params, train_sharpe_ratio = optimize(dfs, all_symbols, mdf,
+                                          window(index, train_start, test_start), param_bounds)
+    sharpe_ratio, portfolio, _, trades = fast_backtesting.backtest(
+        dfs, all_symbols, mdf, None, window(index, test_start, test_end),
+        string_to_strategy[STRATEGY], params, STOPLOSS_PERCENTAGE)
+    return {'train_start': train_start, 'test_start': test_start, 'test_end': test_end,
+            'params': params, 'train_sharpe_ratio': train_sharpe_ratio,
+            'test_sharpe_ratio': sharpe_ratio, 'test_buy_count': len(trades) // 2,
+            'equity': portfolio['total_portfolio_value']}
+
+
+# chain the out-of-sample equity curves, every test window reinvests what the previous one
+# ended with
+def stitch_equity(fold_results):
+    curves, capital = [], STARTING_CAPITAL
+    for fold_result in fold_results:
+        curve = fold_result['equity'] / STARTING_CAPITAL * capital
+        capital = curve.iloc[-1]
+        curves += [curve]
+    return pd.concat(curves)
+
+
+# optimize every fold on a process pool, print the folds and save the stitched
+# out-of-sample equity curve
+def main(argv=None, parents=()):
+    parser = argparse.ArgumentParser(description="optimize the strategy in constants.py on "
+                                                 "rolling windows and test it out-of-sample",
+                                     parents=list(parents))
+    parser.parse_args(argv)
+
+    print_params()
+    folds = make_folds(WALK_FORWARD_START_DATE, TRADE_END_DATE)
+    print(f"walk-forward over {len(folds)} folds of {TRAIN_YEARS} train "
+          f"and {TEST_YEARS} test years")
+    # load the data and select the universe once, for the dates of all folds
+    dfs, index, all_symbols, mdf, spdf = backtesting.get_data(
+        trade_start_date=WALK_FORWARD_START_DATE)
+    backtesting.filter_universe(dfs, index, all_symbols, mdf)
+
+    # the shared memory and the indicator directory are released even when a fold fails
+    with contextlib.ExitStack() as stack:
+        shared_dir = tempfile.mkdtemp(prefix='indicator_cache_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        stack.callback(shutil.rmtree, shared_dir, ignore_errors=True)
+        context = mp.get_context(optimizer.START_METHOD)
+        indicators.cache = indicators.IndicatorCache(shared_dir=shared_dir, context=context)
+        manifest, blocks = shared_data.publish(dfs, all_symbols, mdf, index)
+        stack.callback(shared_data.release, blocks)
+
+        num_workers = min(os.cpu_count(), len(folds))
+        print(f"running folds with {num_workers} workers")
+        with context.Pool(num_workers, initializer=optimizer.init_worker,
+                          initargs=(manifest, indicators.cache)) as pool:
+            fold_results = pool.starmap(run_fold,
+                                        [(fold, optimizer.param_bounds) for fold in folds])
+        optimizer.print_cache_stats()
+
+    print('-----')
+    for fold_result in fold_results:
+        print(f"train {fold_result['train_start'].date()} - {fold_result['test_start'].date()}, "
+              f"test until {fold_result['test_end'].date()}: params = {fold_result['params']}, "
+              f"in-sample sharpe ratio: {fold_result['train_sharpe_ratio']:.3f}, "
+              f"out-of-sample sharpe ratio: {fold_result['test_sharpe_ratio']:.3f}, "
+              f"{fold_result['test_buy_count']} buys")
+    equity = stitch_equity(fold_results)
+    print(f"out-of-sample sharpe ratio: {get_sharpe_ratio(equity)}, "
+          f"final portfolio value: {equity.iloc[-1]}")
+    if not os.path.isdir(CSV_OUT_DIR_NAME):
+        os.mkdir(CSV_OUT_DIR_NAME)
+    equity.to_frame('total_portfolio_value').to_csv(f"{CSV_OUT_DIR_NAME}/walk_forward.csv")
+
+
+if __name__ == "__main__":
+    main()